@@ -1,6 +1,7 @@
 #! /usr/bin/env python3
 # -*- coding: utf-8 -*-
 import os
+import atexit
 
 import logging
 from logging.handlers import RotatingFileHandler
@@ -9,23 +10,28 @@ from flask import Flask,jsonify
 from flask_cors import CORS
 from dotenv import load_dotenv
 
+# 加载环境变量，需要在导入服务之前，服务模块在导入时读取配置
+load_dotenv()
+
 # 导入路由
-from app.main.routes import health_bp, sessions_dp
+from app.main.routes import health_bp, sessions_dp, metrics_bp, profiles_bp
 from app.api.v1.routes import api_v1_bp
 
 # 导入并初始化服务
 from app.services.session_service import session_service
 from app.services.chat_service import chat_service
-
-# 加载环境变量
-load_dotenv()
+from app.services.anuneko_service import AnuNekoAPI
+from app.services.async_runtime import runtime
+from app.services.session_pool import session_pool
+from app.services.json_codec import FastJSONProvider
 
 # 创建 Flask 应用
 app = Flask(__name__)
 CORS(app)
 
-# 配置 Flask 应用以支持中文显示
+# 配置 Flask 应用以支持中文显示，jsonify 使用最快的可用 JSON 后端
 app.config['JSON_AS_ASCII'] = False
+app.json = FastJSONProvider(app)
 
 # 配置日志
 # 设置日志文件路径
@@ -52,6 +58,10 @@ file_handler.setLevel(logging.INFO)
 app.logger.addHandler(file_handler)
 app.logger.setLevel(logging.INFO)
 
+# 进程退出时先关闭上游连接池，再停止异步运行时（atexit 按注册的逆序执行）
+atexit.register(runtime.stop)
+atexit.register(AnuNekoAPI.close)
+
 # 注册路由
 app.register_blueprint(
     blueprint=health_bp,
@@ -63,6 +73,16 @@ app.register_blueprint(
     url_prefix="/sessions"
 )
 
+app.register_blueprint(
+    blueprint=metrics_bp,
+    url_prefix="/metrics"
+)
+
+app.register_blueprint(
+    blueprint=profiles_bp,
+    url_prefix="/profiles"
+)
+
 # 注册 api-v1 版本路由
 app.register_blueprint(
     blueprint=api_v1_bp,
@@ -96,9 +116,13 @@ if __name__ == "__main__":
     app.logger.info(f"调试模式: {debug}")
     
     # 检查环境变量
-    if not os.environ.get("ANUNEKO_TOKEN"):
+    if not (os.environ.get("ANUNEKO_TOKEN") or os.environ.get("ANUNEKO_TOKENS")
+            or os.environ.get("ANUNEKO_ACCOUNTS_FILE")):
         app.logger.error("⚠️ 警告: 未设置 ANUNEKO_TOKEN 环境变量")
         app.logger.error("请设置 AnuNeko 账号 Token")
     
+    # 预热会话池
+    session_pool.prewarm()
+    
     # 启动服务器
     app.run(host=host, port=port, debug=debug)
\ No newline at end of file
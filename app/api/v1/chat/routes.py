@@ -1,22 +1,51 @@
+import select
+import socket
+
 from flask import Blueprint, request, jsonify
 from app.services.chat_service import chat_service
+from app.services.request_timing import RequestTiming
 
 chat_bp = Blueprint("chat", __name__)
 
+
+def client_disconnected(environ) -> bool:
+    """
+    客户端是否已断开连接
+    
+    只支持开发服务器（werkzeug）提供的 werkzeug.socket；请求体已读取完毕，套接字可读且读不到数据说明对端已关闭
+    """
+    sock = environ.get("werkzeug.socket")
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b""
+    except ValueError:
+        # TLS 套接字不支持 MSG_PEEK，无法判断
+        return False
+    except OSError:
+        return True
+
+
 @chat_bp.route("/completions", methods=["POST"])
 def chat_completions():
     """聊天完成端点"""
+    timing = RequestTiming()
     try:
         request_data = request.get_json()
-        result = chat_service.process_chat_request(request_data)
+        result = chat_service.process_chat_request(
+            request_data, request.headers.get("Cache-Control"), timing, request.headers.get("X-Profile"),
+            request.headers.get("Authorization"), lambda: client_disconnected(request.environ)
+        )
         
-        # 如果结果是元组，说明包含状态码
-        if isinstance(result, tuple) and len(result) == 2:
-            return jsonify(result[0]), result[1]
+        # 如果结果是元组，说明包含状态码，可能还有额外的响应头（如 Retry-After）
+        if isinstance(result, tuple):
+            payload, status, *extra = result
+            return jsonify(payload), status, {**timing.headers(), **(extra[0] if extra else {})}
         
         # 如果结果是字典，说明是正常响应
         if isinstance(result, dict):
-            return jsonify(result)
+            return jsonify(result), 200, timing.headers()
         
         # 如果是Response对象，直接返回（流式响应）
         return result
@@ -0,0 +1,55 @@
+"""
+ASGI 应用
+提供异步原生的服务模式，配合 uvicorn 等 ASGI 服务器以多进程方式运行
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+
+from app.asgi.responses import JSONResponse
+from app.asgi.routes import routes
+from app.services.anuneko_service import AnuNekoAPI
+from app.services.async_runtime import runtime
+from app.services.session_pool import session_pool
+
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    """应用生命周期：共享运行时直接使用服务器的事件循环，退出时关闭上游连接池"""
+    runtime.bind_loop(asyncio.get_running_loop())
+    session_pool.prewarm()
+    yield
+    await AnuNekoAPI.aclose()
+
+
+async def http_exception(request: Request, exc: HTTPException):
+    """HTTP 错误处理，404 与 Flask 模式保持一致"""
+    if exc.status_code == 404:
+        return JSONResponse({
+            "error": {
+                "message": "端点不存在",
+                "type": "invalid_request_error"
+            }
+        }, status_code=404)
+    return JSONResponse({
+        "error": {
+            "message": exc.detail,
+            "type": "invalid_request_error"
+        }
+    }, status_code=exc.status_code)
+
+
+def create_app() -> Starlette:
+    """创建 ASGI 应用"""
+    return Starlette(
+        routes=routes,
+        middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])],
+        exception_handlers={HTTPException: http_exception},
+        lifespan=lifespan
+    )
@@ -0,0 +1,17 @@
+"""
+ASGI 响应
+JSON 响应使用全局编解码器，与 Flask 模式输出一致
+"""
+
+from typing import Any
+
+from starlette.responses import JSONResponse as StarletteJSONResponse
+
+from app.services import json_codec
+
+
+class JSONResponse(StarletteJSONResponse):
+    """使用最快的可用 JSON 后端编码的 JSON 响应"""
+
+    def render(self, content: Any) -> bytes:
+        return json_codec.dumps_bytes(content)
@@ -0,0 +1,145 @@
+"""
+ASGI 路由
+与 Flask 蓝图提供相同的端点，处理函数全部为协程，直接运行在 ASGI 服务器的事件循环中
+"""
+
+import os
+import asyncio
+import inspect
+
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from app.api.v1.models.models import list_models
+from app.asgi.responses import JSONResponse
+from app.main import health, sessions
+from app.main.profiles import NOT_FOUND
+from app.services import json_codec
+from app.services.chat_service import chat_service
+from app.services.metrics import CONTENT_TYPE, metrics_registry
+from app.services.profiler import request_profiler
+from app.services.request_timing import RequestTiming
+
+
+async def index(request: Request):
+    return JSONResponse({
+        "message": "欢迎使用 AnuNeko OpenAI API 兼容服务器"
+    })
+
+
+async def health_check(request: Request):
+    """健康检查端点"""
+    return JSONResponse(health.status())
+
+
+async def metrics_route(request: Request):
+    """Prometheus 指标端点"""
+    return Response(metrics_registry.render(), headers={"Content-Type": CONTENT_TYPE})
+
+
+async def wait_disconnected(request: Request):
+    """等待客户端断开连接，请求体读取完毕后收到的下一条消息只会是 http.disconnect"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def chat_completions(request: Request):
+    """聊天完成端点"""
+    timing = RequestTiming()
+    try:
+        request_data = json_codec.loads(await request.body())
+        work = asyncio.ensure_future(chat_service.aprocess_chat_request(
+            request_data, request.headers.get("cache-control"), timing, request.headers.get("x-profile"),
+            request.headers.get("authorization")
+        ))
+        watcher = asyncio.ensure_future(wait_disconnected(request))
+        try:
+            await asyncio.wait((work, watcher), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            watcher.cancel()
+            abandoned = not work.done()
+            if abandoned:
+                # 客户端在排队、创建会话或等待非流式回复期间断开：取消请求，释放排队位置、会话和上游连接，
+                # 不再为没有人读取的回复继续生成；流式响应开始后由 StreamingResponse 检测断开并关闭生成器。
+                # cancel() 只是请求取消，等任务真正结束后再返回
+                work.cancel()
+                await asyncio.wait((work,))
+        if abandoned:
+            # 取消与完成同时发生时，关闭已经开始的流
+            if not work.cancelled() and work.exception() is None and inspect.isasyncgen(work.result()):
+                await work.result().aclose()
+            return Response(status_code=499)
+        result = work.result()
+
+        # 如果结果是元组，说明包含状态码，可能还有额外的响应头（如 Retry-After）
+        if isinstance(result, tuple):
+            payload, status, *extra = result
+            return JSONResponse(payload, status_code=status, headers={**timing.headers(), **(extra[0] if extra else {})})
+
+        # 如果结果是字典，说明是正常响应
+        if isinstance(result, dict):
+            return JSONResponse(result, headers=timing.headers())
+
+        # 否则是 SSE 数据块的异步生成器（流式响应）
+        return StreamingResponse(
+            result,
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", **timing.headers()}
+        )
+
+    except Exception as e:
+        return JSONResponse({
+            "error": {
+                "message": f"服务器内部错误: {str(e)}",
+                "type": "server_error"
+            }
+        }, status_code=500)
+
+
+async def models_show_all(request: Request):
+    """全部模型列表端点"""
+    payload, status = await list_models()
+    return JSONResponse(payload, status_code=status)
+
+
+async def models_show(request: Request):
+    """单个模型列表端点"""
+    payload, status = await list_models(request.path_params["model_name"])
+    return JSONResponse(payload, status_code=status)
+
+
+async def profile_download(request: Request):
+    """下载性能分析结果"""
+    path = request_profiler.path(request.path_params["profile_id"])
+    if path is None:
+        return JSONResponse(NOT_FOUND, status_code=404)
+    return FileResponse(path, media_type="application/octet-stream", filename=os.path.basename(path))
+
+
+async def list_sessions_route(request: Request):
+    """列出会话"""
+    return JSONResponse(sessions.list_payload())
+
+
+async def delete_session_route(request: Request):
+    """删除会话"""
+    payload, status = sessions.delete_payload(request.path_params["session_id"])
+    return JSONResponse(payload, status_code=status)
+
+
+routes = [
+    Route("/", index, methods=["GET"]),
+    Route("/health", health_check, methods=["GET"]),
+    Route("/health/", health_check, methods=["GET"]),
+    Route("/metrics", metrics_route, methods=["GET"]),
+    Route("/v1/chat/completions", chat_completions, methods=["POST"]),
+    Route("/v1/models", models_show_all, methods=["GET"]),
+    Route("/v1/models/{model_name}", models_show, methods=["GET"]),
+    Route("/profiles/{profile_id}", profile_download, methods=["GET"]),
+    Route("/sessions", list_sessions_route, methods=["GET"]),
+    Route("/sessions/", list_sessions_route, methods=["GET"]),
+    Route("/sessions/{session_id}", delete_session_route, methods=["DELETE"]),
+]
@@ -1,10 +1,42 @@
 from flask import jsonify
 from datetime import datetime
 
-def check():
-    """健康检查端点"""
-    return jsonify({
+from app.services.anuneko_service import AnuNekoAPI
+from app.services.account_pool import account_pool
+from app.services.admission import admission
+from app.services.circuit_breaker import circuit_breakers
+from app.services.conversation_index import conversation_index
+from app.services.model_registry import model_registry
+from app.services.profiler import request_profiler
+from app.services.response_cache import response_cache
+from app.services.retry_policy import retry_policy
+from app.services.single_flight import single_flight
+from app.services.session_pool import session_pool
+from app.services.session_service import session_service
+
+def status() -> dict:
+    """健康状态"""
+    return {
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
-        "version": "1.0.0"
-    })
\ No newline at end of file
+        "version": "1.0.0",
+        "upstream_pool": AnuNekoAPI.pool_stats(),
+        "accounts": account_pool.stats(),
+        "branch_choice": AnuNekoAPI.choice_stats(),
+        "upstream_streams": AnuNekoAPI.stream_stats(),
+        "control_calls": retry_policy.stats(),
+        "circuit_breakers": circuit_breakers.stats(),
+        "model_registry": model_registry.stats(),
+        "session_pool": session_pool.stats(),
+        "session_queue": session_service.queue_stats(),
+        "admission": admission.stats(),
+        "session_store": session_service.store_stats(),
+        "conversation_index": conversation_index.stats(),
+        "response_cache": response_cache.stats(),
+        "request_coalescing": single_flight.stats(),
+        "profiling": request_profiler.stats()
+    }
+
+def check():
+    """健康检查端点"""
+    return jsonify(status())
@@ -0,0 +1,7 @@
+from flask import Response
+
+from app.services.metrics import CONTENT_TYPE, metrics_registry
+
+def show():
+    """Prometheus 指标端点"""
+    return Response(metrics_registry.render(), headers={"Content-Type": CONTENT_TYPE})
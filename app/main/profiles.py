@@ -0,0 +1,18 @@
+from flask import jsonify, send_file
+
+from app.services.profiler import request_profiler
+
+NOT_FOUND = {
+    "error": {
+        "message": "性能分析结果不存在",
+        "type": "invalid_request_error"
+    }
+}
+
+def download(profile_id: str):
+    """下载性能分析结果（pstats 文件）"""
+    path = request_profiler.path(profile_id)
+    if path is None:
+        return jsonify(NOT_FOUND), 404
+    return send_file(path, mimetype="application/octet-stream", as_attachment=True,
+                     download_name=f"{profile_id}.prof")
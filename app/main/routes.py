@@ -1,10 +1,12 @@
 from flask import Blueprint
 # 导入处理函数
-from app.main import health,sessions
+from app.main import health,sessions,metrics,profiles
 
 # 创建蓝图
 health_bp = Blueprint("health", __name__)
 sessions_dp = Blueprint("sessions", __name__)
+metrics_bp = Blueprint("metrics", __name__)
+profiles_bp = Blueprint("profiles", __name__)
 
 
 # 定义路由
@@ -14,6 +16,18 @@ def health_check():
     return health.check()
 
 
+@metrics_bp.route("", methods=["GET"])
+def metrics_route():
+    """Prometheus 指标"""
+    return metrics.show()
+
+
+@profiles_bp.route("/<profile_id>", methods=["GET"])
+def profile_download_route(profile_id: str):
+    """下载性能分析结果"""
+    return profiles.download(profile_id)
+
+
 @sessions_dp.route("", methods=["GET"])
 @sessions_dp.route("/", methods=["GET"])
 def list_sessions_route():
@@ -1,18 +1,28 @@
 from flask import jsonify
+from typing import Dict, Tuple
 from app.services.session_service import session_service
 
-def show():
-    """列出会话"""
+def list_payload() -> Dict:
+    """会话列表响应体"""
     session_list = session_service.list_sessions()
     
-    return jsonify({
+    return {
         "sessions": session_list,
         "total": len(session_list)
-    })
+    }
 
-def delete(session_id: str):
-    """删除会话"""
+def delete_payload(session_id: str) -> Tuple[Dict, int]:
+    """删除会话，返回 (响应体, 状态码)"""
     if session_service.delete_session(session_id):
-        return jsonify({"status": "success", "message": "会话已删除"})
+        return {"status": "success", "message": "会话已删除"}, 200
     else:
-        return jsonify({"status": "error", "message": "会话不存在"}), 404
+        return {"status": "error", "message": "会话不存在"}, 404
+
+def show():
+    """列出会话"""
+    return jsonify(list_payload())
+
+def delete(session_id: str):
+    """删除会话"""
+    payload, status = delete_payload(session_id)
+    return jsonify(payload), status
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+账号池
+管理多个 AnuNeko 账号，新会话分配给负载最低的健康账号，出错或被限流的账号自动冷却
+"""
+
+import os
+import json
+import time
+import hashlib
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional
+
+from app.services.anuneko_service import AnuNekoAPI
+from app.services.circuit_breaker import circuit_breakers
+
+
+class Account:
+    """单个 AnuNeko 账号"""
+
+    def __init__(self, account_id: str, token: str, cookie: Optional[str] = None):
+        self.id = account_id
+        self.api = AnuNekoAPI(token, cookie)
+        # 多账号时不能回退到 ANUNEKO_COOKIE，每个账号只使用自己的 Cookie
+        self.api.cookie = cookie
+        self.api.on_result = self.record
+        self.api.account_id = account_id
+        # 正在进行的对话生成数
+        self.inflight = 0
+        # 固定在该账号上的会话数
+        self.assigned = 0
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.cooldown_until and circuit_breakers.account_available(self.id)
+
+    @property
+    def load(self):
+        return (self.inflight, self.assigned)
+
+    def record(self, ok: bool, status_code: Optional[int] = None):
+        """记录一次上游调用结果，出错或被限流时进入冷却"""
+        self.requests += 1
+        if ok:
+            self.consecutive_failures = 0
+            return
+
+        self.errors += 1
+        if status_code == 429:
+            self.rate_limited += 1
+            self.cooldown(float(os.environ.get("ACCOUNT_RATE_LIMIT_COOLDOWN", "60")))
+            return
+
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= int(os.environ.get("ACCOUNT_FAILURE_THRESHOLD", "3")):
+            self.cooldown(float(os.environ.get("ACCOUNT_ERROR_COOLDOWN", "30")))
+
+    def cooldown(self, seconds: float):
+        """让账号冷却一段时间，期间不再分配新会话"""
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+        self.consecutive_failures = 0
+        print(f"账号 {self.id} 进入冷却 {seconds:.0f} 秒")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "healthy": self.healthy,
+            "inflight": self.inflight,
+            "assigned": self.assigned,
+            "requests": self.requests,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "cooldown_remaining": round(max(0.0, self.cooldown_until - time.monotonic()), 1)
+        }
+
+
+class AccountPool:
+    """账号池"""
+
+    def __init__(self):
+        self._accounts: Optional[Dict[str, Account]] = None
+
+    @staticmethod
+    def account_id(token: str) -> str:
+        """由 Token 生成稳定且不泄露 Token 的账号 ID"""
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()[:12]
+
+    def _load(self) -> Dict[str, Account]:
+        """
+        从配置加载账号，按以下顺序取第一个存在的配置：
+        ANUNEKO_ACCOUNTS_FILE（JSON 列表）、ANUNEKO_TOKENS（逗号分隔）、ANUNEKO_TOKEN
+        """
+        entries: List[Dict[str, Any]] = []
+        accounts_file = os.environ.get("ANUNEKO_ACCOUNTS_FILE")
+        if accounts_file:
+            with open(accounts_file, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        elif os.environ.get("ANUNEKO_TOKENS"):
+            tokens = [t.strip() for t in os.environ["ANUNEKO_TOKENS"].split(",") if t.strip()]
+            # Cookie 中可能包含逗号，使用 || 分隔，与 Token 按顺序一一对应
+            cookies = os.environ.get("ANUNEKO_COOKIES", "").split("||")
+            for index, token in enumerate(tokens):
+                cookie = cookies[index].strip() if index < len(cookies) else ""
+                entries.append({"token": token, "cookie": cookie or None})
+        elif os.environ.get("ANUNEKO_TOKEN"):
+            entries.append({"token": os.environ["ANUNEKO_TOKEN"], "cookie": os.environ.get("ANUNEKO_COOKIE")})
+
+        if not entries:
+            raise ValueError("Token 未提供，请设置 ANUNEKO_TOKEN、ANUNEKO_TOKENS 或 ANUNEKO_ACCOUNTS_FILE")
+
+        accounts = {}
+        for entry in entries:
+            account_id = entry.get("id") or self.account_id(entry["token"])
+            accounts[account_id] = Account(account_id, entry["token"], entry.get("cookie"))
+        print(f"已加载 {len(accounts)} 个 AnuNeko 账号")
+        return accounts
+
+    @property
+    def accounts(self) -> Dict[str, Account]:
+        if self._accounts is None:
+            self._accounts = self._load()
+        return self._accounts
+
+    def pick(self) -> Account:
+        """
+        选择负载最低的健康账号
+
+        所有账号都在冷却时，选择最早结束冷却的账号
+
+        Returns:
+            账号
+        """
+        accounts = list(self.accounts.values())
+        healthy = [account for account in accounts if account.healthy]
+        if healthy:
+            return min(healthy, key=lambda account: account.load)
+        return min(accounts, key=lambda account: account.cooldown_until)
+
+    def get(self, account_id: Optional[str]) -> Account:
+        """
+        获取会话固定的账号
+
+        账号已不在配置中时（如旧会话），退回到负载最低的账号
+
+        Returns:
+            账号
+        """
+        account = self.accounts.get(account_id) if account_id else None
+        return account or self.pick()
+
+    def assign(self, account_id: str):
+        """记录一个新会话固定到该账号"""
+        account = self.accounts.get(account_id)
+        if account is not None:
+            account.assigned += 1
+
+    def release(self, account_id: Optional[str]):
+        """记录一个会话不再固定到该账号"""
+        account = self.accounts.get(account_id) if account_id else None
+        if account is not None and account.assigned > 0:
+            account.assigned -= 1
+
+    @asynccontextmanager
+    async def lease(self, account_id: Optional[str]):
+        """在对话生成期间占用账号的一个负载"""
+        account = self.get(account_id)
+        account.inflight += 1
+        try:
+            yield account
+        finally:
+            account.inflight -= 1
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """账号池统计信息"""
+        return [account.stats() for account in self.accounts.values()]
+
+
+# 全局账号池实例
+account_pool = AccountPool()
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+"""
+准入控制
+限制同时进行的上游生成数（全局、按模型和按 API Key），超出时在有界队列中等待；
+队列已满或等待超过期限时立即拒绝，返回 429 和 Retry-After，避免突发流量时大量上游流同时打开
+
+排队的请求按 API Key 分组，以加权公平队列调度：交互（流式）通道总是先于批量（非流式）通道，
+同一通道内各 Key 按权重分享空出的名额，单个 Key 的批量任务不会占满名额而饿死其他用户
+"""
+
+import os
+import math
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Optional
+
+from app.services import metrics
+from app.services.request_timing import RequestTiming, null_timing
+
+# 调度通道，排在前面的优先
+INTERACTIVE = "interactive"
+BULK = "bulk"
+LANES = (INTERACTIVE, BULK)
+
+# 没有 Authorization 头的请求归入同一组
+ANONYMOUS = "anonymous"
+
+
+class AdmissionRejected(Exception):
+    """上游并发已满，请求被拒绝"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        # 建议客户端重试前等待的秒数
+        self.retry_after = retry_after
+
+
+def parse_limits(value: str, cast: Callable[[str], Any] = int) -> Dict[str, Any]:
+    """解析 "name=value,name=value" 格式的配置"""
+    limits: Dict[str, Any] = {}
+    for item in value.split(","):
+        name, sep, limit = item.rpartition("=")
+        if sep and name.strip() and limit.strip():
+            limits[name.strip()] = cast(limit)
+    return limits
+
+
+def api_key(authorization: Optional[str]) -> str:
+    """从 Authorization 头取出 API Key"""
+    if not authorization:
+        return ANONYMOUS
+    scheme, _, token = authorization.strip().partition(" ")
+    key = token.strip() if scheme.lower() == "bearer" else authorization.strip()
+    return key or ANONYMOUS
+
+
+def mask_key(key: str) -> str:
+    """统计信息中只显示 Key 的首尾几位"""
+    if key == ANONYMOUS or len(key) <= 10:
+        return key
+    return f"{key[:6]}...{key[-4:]}"
+
+
+class AdmissionTicket:
+    """一个请求的调度信息：模型、所属 API Key 和通道"""
+
+    __slots__ = ("model", "key", "lane")
+
+    def __init__(self, model: str, key: str = ANONYMOUS, lane: str = INTERACTIVE):
+        self.model = model
+        self.key = key
+        self.lane = lane
+
+
+class _Waiter:
+    """队列中等待名额的请求"""
+
+    __slots__ = ("ticket", "future", "tag", "enqueued")
+
+    def __init__(self, ticket: AdmissionTicket, future: asyncio.Future, tag: float):
+        self.ticket = ticket
+        self.future = future
+        # 加权公平队列的虚拟完成时间，越小越先执行
+        self.tag = tag
+        self.enqueued = time.monotonic()
+
+
+class _Tenant:
+    """一个 API Key 的调度状态"""
+
+    __slots__ = ("key", "weight", "limit", "active", "finish", "queues")
+
+    def __init__(self, key: str, weight: float, limit: int):
+        self.key = key
+        self.weight = weight
+        self.limit = limit
+        self.active = 0
+        # 最后一个排队请求的虚拟完成时间
+        self.finish = 0.0
+        self.queues: Dict[str, Deque[_Waiter]] = {lane: deque() for lane in LANES}
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    @property
+    def saturated(self) -> bool:
+        return bool(self.limit) and self.active >= self.limit
+
+    @property
+    def idle(self) -> bool:
+        return not self.active and not self.queued
+
+
+class AdmissionController:
+    """
+    上游并发准入控制
+
+    同一通道内按各 Key 请求的虚拟完成时间分配名额，权重越大的 Key 虚拟时间增长越慢；
+    同一个 Key 的请求按到达顺序执行，某个模型或 Key 的名额已满时跳过它，其他请求可以先执行
+    """
+
+    def __init__(self):
+        # 全局同时进行的上游生成数上限，0 表示不限制
+        self.max_concurrency = int(os.environ.get("ADMISSION_MAX_CONCURRENCY", "64"))
+        # 每个模型的默认上限，0 表示不限制；ADMISSION_MODEL_LIMITS 可以为单个模型单独设置
+        self.model_concurrency = int(os.environ.get("ADMISSION_MODEL_CONCURRENCY", "0"))
+        self.model_limits = parse_limits(os.environ.get("ADMISSION_MODEL_LIMITS", ""))
+        # 每个 API Key 的权重和同时进行的生成数上限，0 表示不限制
+        self.key_weight = float(os.environ.get("ADMISSION_KEY_WEIGHT", "1"))
+        self.key_weights = parse_limits(os.environ.get("ADMISSION_KEY_WEIGHTS", ""), float)
+        self.key_concurrency = int(os.environ.get("ADMISSION_KEY_CONCURRENCY", "0"))
+        self.key_limits = parse_limits(os.environ.get("ADMISSION_KEY_LIMITS", ""))
+        # 最多排队的请求数，超出时立即拒绝
+        self.max_queue = int(os.environ.get("ADMISSION_QUEUE_SIZE", "256"))
+        # 排队的最长等待时间（秒）
+        self.queue_timeout = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "10"))
+
+        self._active = 0
+        self._active_by_model: Dict[str, int] = {}
+        self._tenants: Dict[str, _Tenant] = {}
+        self._queued = 0
+        # 加权公平队列的系统虚拟时间，即最近一个开始执行的请求的虚拟完成时间
+        self._virtual = 0.0
+        # 名额平均占用时间（秒）的指数移动平均，用于估算 Retry-After
+        self._hold_time: Optional[float] = None
+        self._stats = {"admitted": 0, "queued": 0, "rejected_full": 0, "rejected_timeout": 0,
+                       "rejected_preempted": 0, "cancelled": 0}
+
+    def ticket(self, model: str, stream: bool, authorization: Optional[str] = None) -> AdmissionTicket:
+        """
+        创建请求的调度信息
+
+        Args:
+            model: 请求的模型名
+            stream: 流式请求进入交互通道，非流式请求进入批量通道
+            authorization: 请求的 Authorization 头，按其中的 API Key 分组
+        """
+        return AdmissionTicket(model, api_key(authorization), INTERACTIVE if stream else BULK)
+
+    def model_limit(self, model: str) -> int:
+        return self.model_limits.get(model, self.model_concurrency)
+
+    def _tenant(self, key: str) -> _Tenant:
+        tenant = self._tenants.get(key)
+        if tenant is None:
+            tenant = _Tenant(key, self.key_weights.get(key, self.key_weight),
+                             self.key_limits.get(key, self.key_concurrency))
+            self._tenants[key] = tenant
+        return tenant
+
+    def _forget(self, tenant: _Tenant):
+        """空闲的 Key 不再保留状态，避免大量不同的 Key 占用内存"""
+        if tenant.idle:
+            self._tenants.pop(tenant.key, None)
+
+    def _global_full(self) -> bool:
+        return bool(self.max_concurrency) and self._active >= self.max_concurrency
+
+    def _model_full(self, model: str) -> bool:
+        limit = self.model_limit(model)
+        return bool(limit) and self._active_by_model.get(model, 0) >= limit
+
+    def _grant(self, ticket: AdmissionTicket):
+        self._active += 1
+        self._active_by_model[ticket.model] = self._active_by_model.get(ticket.model, 0) + 1
+        self._tenant(ticket.key).active += 1
+        self._stats["admitted"] += 1
+
+    def _release(self, ticket: AdmissionTicket, held: Optional[float] = None):
+        self._active -= 1
+        remaining = self._active_by_model.get(ticket.model, 1) - 1
+        if remaining:
+            self._active_by_model[ticket.model] = remaining
+        else:
+            self._active_by_model.pop(ticket.model, None)
+        tenant = self._tenants.get(ticket.key)
+        if tenant is not None:
+            tenant.active -= 1
+            self._forget(tenant)
+        if held is not None:
+            self._hold_time = held if self._hold_time is None else self._hold_time * 0.9 + held * 0.1
+        self._dispatch()
+
+    def _next_waiter(self) -> Optional[_Waiter]:
+        """按通道优先级和虚拟完成时间选出下一个可以执行的请求"""
+        for lane in LANES:
+            best = None
+            for tenant in self._tenants.values():
+                if tenant.saturated:
+                    continue
+                for waiter in tenant.queues[lane]:
+                    if not self._model_full(waiter.ticket.model):
+                        if best is None or waiter.tag < best.tag:
+                            best = waiter
+                        break
+            if best is not None:
+                return best
+        return None
+
+    def _dequeue(self, waiter: _Waiter):
+        tenant = self._tenants.get(waiter.ticket.key)
+        if tenant is None:
+            return
+        try:
+            tenant.queues[waiter.ticket.lane].remove(waiter)
+        except ValueError:
+            return
+        self._queued -= 1
+        metrics.admission_queued.labels(waiter.ticket.lane).dec()
+
+    def _dispatch(self):
+        """把空出的名额分配给等待的请求"""
+        while self._queued and not self._global_full():
+            waiter = self._next_waiter()
+            if waiter is None:
+                break
+            self._dequeue(waiter)
+            self._virtual = max(self._virtual, waiter.tag)
+            self._grant(waiter.ticket)
+            waiter.future.set_result(None)
+
+    def _can_run(self, ticket: AdmissionTicket) -> bool:
+        """没有请求排队且各级名额都有空余时可以直接执行"""
+        if self._queued or self._global_full() or self._model_full(ticket.model):
+            return False
+        tenant = self._tenants.get(ticket.key)
+        return tenant is None or not tenant.saturated
+
+    def _victim(self, ticket: AdmissionTicket) -> Optional[_Waiter]:
+        """
+        队列已满时选出被挤出的请求：优先级更低通道中排队最多的 Key 的最后一个请求，
+        或同一通道中排队数比新请求所属 Key 多出一个以上的 Key 的最后一个请求
+        """
+        own = self._tenants.get(ticket.key)
+        rank = LANES.index(ticket.lane)
+        for lane in reversed(LANES[rank:]):
+            tenant = max(self._tenants.values(), key=lambda t: len(t.queues[lane]), default=None)
+            if tenant is None or not tenant.queues[lane]:
+                continue
+            if lane != ticket.lane:
+                return tenant.queues[lane][-1]
+            own_queued = len(own.queues[lane]) if own is not None else 0
+            if tenant is not own and len(tenant.queues[lane]) > own_queued + 1:
+                return tenant.queues[lane][-1]
+        return None
+
+    def retry_after(self) -> int:
+        """估算排队的请求全部开始执行所需的秒数"""
+        hold = self._hold_time if self._hold_time is not None else 1.0
+        slots = self.max_concurrency or max(1, self._active)
+        return max(1, min(60, math.ceil(hold * (self._queued + 1) / slots)))
+
+    def _reject(self, reason: str, message: str) -> AdmissionRejected:
+        self._stats[f"rejected_{reason}"] += 1
+        metrics.admission_rejections.labels(reason).inc()
+        return AdmissionRejected(message, self.retry_after())
+
+    def check(self, ticket: AdmissionTicket):
+        """
+        在创建会话等准备工作之前检查，需要排队而队列已满且无法挤出其他请求时立即拒绝
+
+        Raises:
+            AdmissionRejected: 需要排队且队列已满
+        """
+        if self._queued >= self.max_queue and not self._can_run(ticket) and self._victim(ticket) is None:
+            raise self._reject("full", "服务器繁忙，排队请求过多，请稍后再试")
+
+    async def acquire(self, ticket: AdmissionTicket):
+        """
+        取得一个上游并发名额
+
+        Raises:
+            AdmissionRejected: 队列已满、等待超时或被更高优先级的请求挤出队列
+        """
+        if self._can_run(ticket):
+            self._grant(ticket)
+            return
+        if self._queued >= self.max_queue:
+            victim = self._victim(ticket)
+            if victim is None:
+                raise self._reject("full", "服务器繁忙，排队请求过多，请稍后再试")
+            self._dequeue(victim)
+            victim.future.set_exception(self._reject("preempted", "服务器繁忙，排队请求过多，请稍后再试"))
+
+        tenant = self._tenant(ticket.key)
+        tenant.finish = max(self._virtual, tenant.finish) + 1 / tenant.weight
+        waiter = _Waiter(ticket, asyncio.get_running_loop().create_future(), tenant.finish)
+        tenant.queues[ticket.lane].append(waiter)
+        self._queued += 1
+        self._stats["queued"] += 1
+        metrics.admission_queued.labels(ticket.lane).inc()
+        # 排在前面的请求可能因模型或 Key 的名额已满而无法执行，新请求可以先执行时立即分配
+        self._dispatch()
+        try:
+            if self.queue_timeout > 0:
+                await asyncio.wait_for(waiter.future, self.queue_timeout)
+            else:
+                await waiter.future
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                # 超时或取消与分配名额同时发生，归还名额
+                self._release(ticket)
+            else:
+                waiter.future.cancel()
+                self._dequeue(waiter)
+                self._forget(tenant)
+            if isinstance(e, asyncio.TimeoutError):
+                raise self._reject("timeout", "服务器繁忙，排队等待超时，请稍后再试")
+            # 客户端在排队期间断开
+            self._stats["cancelled"] += 1
+            raise
+        except AdmissionRejected:
+            self._forget(tenant)
+            raise
+
+    @asynccontextmanager
+    async def slot(self, ticket: AdmissionTicket, timing: RequestTiming = null_timing) -> AsyncIterator[None]:
+        """
+        占用一个上游并发名额执行代码块
+
+        Args:
+            ticket: 请求的调度信息
+            timing: 所属请求的阶段耗时，记录排队时间（admission）
+        """
+        started = time.perf_counter()
+        await self.acquire(ticket)
+        granted = time.perf_counter()
+        timing.add("admission", granted - started, ticket.lane)
+        try:
+            yield
+        finally:
+            self._release(ticket, time.perf_counter() - granted)
+
+    def stats(self) -> Dict[str, Any]:
+        """准入控制统计信息"""
+        stats: Dict[str, Any] = dict(self._stats)
+        stats["active"] = self._active
+        stats["active_by_model"] = dict(self._active_by_model)
+        stats["queue_length"] = self._queued
+        stats["queue_by_lane"] = {
+            lane: sum(len(t.queues[lane]) for t in self._tenants.values()) for lane in LANES
+        }
+        stats["keys"] = {
+            mask_key(t.key): {"weight": t.weight, "limit": t.limit, "active": t.active, "queued": t.queued}
+            for t in list(self._tenants.values())
+        }
+        stats["max_concurrency"] = self.max_concurrency
+        stats["max_queue"] = self.max_queue
+        stats["queue_timeout"] = self.queue_timeout
+        stats["avg_hold_ms"] = round(self._hold_time * 1000, 2) if self._hold_time is not None else None
+        return stats
+
+
+# 全局准入控制实例
+admission = AdmissionController()
@@ -4,21 +4,81 @@ AnuNeko API Python 封装
 基于 send.py 中的 API 调用实现，支持异步操作
 """
 
-import json
 import os
+import time
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+
 import httpx
-from typing import Dict, List, Optional, Union, AsyncGenerator
+from typing import Dict, List, Optional, Union, AsyncGenerator, Any, Callable
+
+from app.services import json_codec
+from app.services import metrics
+from app.services.circuit_breaker import CircuitOpenError, circuit_breakers
+from app.services.request_timing import RequestTiming, null_timing
+from app.services.retry_policy import RetryBudget, retry_policy
+from app.services.stream_parser import ContentDelta, ErrorCode, MessageId, StreamEvent, parse_stream
+
+
+class _PoolTracer:
+    """
+    httpcore trace 回调
+    
+    如果请求过程中出现了新的 TCP 建连，说明没有命中连接池中的空闲连接
+    """
+    
+    def __init__(self):
+        self.connected = False
+    
+    async def __call__(self, event_name: str, info: Dict[str, Any]):
+        if event_name == "connection.connect_tcp.started":
+            self.connected = True
 
 
 class AnuNekoAPI:
     """AnuNeko API 封装类"""
     
-    # API 地址
-    CHAT_API_URL = "https://anuneko.com/api/v1/chat"
-    STREAM_API_URL = "https://anuneko.com/api/v1/msg/{uuid}/stream"
-    MODEL_VIEW_URL = "https://anuneko.com/api/v1/user/view"
-    SELECT_CHOICE_URL = "https://anuneko.com/api/v1/msg/select-choice"
-    SELECT_MODEL_URL = "https://anuneko.com/api/v1/user/select_model"
+    # API 地址，ANUNEKO_BASE_URL 可指向本地模拟服务（benchmarks/mock_upstream.py）
+    BASE_URL = os.environ.get("ANUNEKO_BASE_URL", "https://anuneko.com").rstrip("/")
+    CHAT_API_URL = f"{BASE_URL}/api/v1/chat"
+    STREAM_API_URL = BASE_URL + "/api/v1/msg/{uuid}/stream"
+    MODEL_VIEW_URL = f"{BASE_URL}/api/v1/user/view"
+    SELECT_CHOICE_URL = f"{BASE_URL}/api/v1/msg/select-choice"
+    SELECT_MODEL_URL = f"{BASE_URL}/api/v1/user/select_model"
+    
+    # 上游失败时代替回复返回给客户端的提示
+    FAILURE_REPLY = "请求失败，请稍后再试。"
+    CHOICE_SHOWN_REPLY = "⚠️ 检测到对话分支未选择，请重试或新建会话。"
+    
+    # 进程内共享的上游 HTTP 客户端（连接池），所有实例共用
+    _shared_client: Optional[httpx.AsyncClient] = None
+    _shared_client_loop: Optional[asyncio.AbstractEventLoop] = None
+    _client_lock = threading.Lock()
+    _http2_active = False
+    _pool_stats: Dict[str, int] = {
+        "requests": 0,
+        "hits": 0,
+        "misses": 0,
+        "clients_created": 0
+    }
+    
+    # 后台进行中的分支确认任务（会话 ID -> 任务），保证同一会话的下一轮对话在确认完成后才开始
+    _pending_choices: Dict[str, "asyncio.Task"] = {}
+    _choice_stats: Dict[str, int] = {
+        "scheduled": 0,
+        "confirmed": 0,
+        "failed": 0,
+        "waited": 0
+    }
+    # 上游流式回复统计，cancelled 为客户端断开等原因被提前关闭的流
+    _stream_stats: Dict[str, int] = {
+        "started": 0,
+        "completed": 0,
+        "cancelled": 0,
+        "failed": 0
+    }
     
     def __init__(self, token: str = None, cookie: str = None):
         """
@@ -33,6 +93,16 @@ class AnuNekoAPI:
         
         if not self.token:
             raise ValueError("Token 未提供，请设置 ANUNEKO_TOKEN 环境变量或直接传入 token 参数")
+        
+        # 上游调用结果回调 (是否成功, HTTP 状态码)，账号池用它跟踪账号健康状况
+        self.on_result: Optional[Callable[[bool, Optional[int]], None]] = None
+        # 所属账号的 ID，熔断器按账号分别统计
+        self.account_id: Optional[str] = None
+    
+    def _report(self, ok: bool, status_code: Optional[int] = None):
+        """通知上游调用结果"""
+        if self.on_result is not None:
+            self.on_result(ok, status_code)
     
     def build_headers(self, content_type: str = "application/json") -> Dict[str, str]:
         """
@@ -60,6 +130,191 @@ class AnuNekoAPI:
             headers["Cookie"] = self.cookie
             
         return headers
+
+    @staticmethod
+    def _http2_enabled() -> bool:
+        """是否启用 HTTP/2（需要安装 h2）"""
+        if os.environ.get("ANUNEKO_HTTP2", "False").lower() != "true":
+            return False
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            print("未安装 h2，HTTP/2 已禁用，请执行 pip install httpx[http2]")
+            return False
+        return True
+    
+    @classmethod
+    def _create_client(cls) -> httpx.AsyncClient:
+        """根据环境变量创建带连接池的 HTTP 客户端"""
+        limits = httpx.Limits(
+            max_connections=int(os.environ.get("ANUNEKO_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.environ.get("ANUNEKO_MAX_KEEPALIVE_CONNECTIONS", "20")),
+            keepalive_expiry=float(os.environ.get("ANUNEKO_KEEPALIVE_EXPIRY", "30"))
+        )
+        cls._pool_stats["clients_created"] += 1
+        cls._http2_active = cls._http2_enabled()
+        return httpx.AsyncClient(
+            http2=cls._http2_active,
+            limits=limits,
+            timeout=10,
+            # 不保存上游返回的 Cookie，账号 Cookie 始终通过请求头显式携带
+            cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+        )
+    
+    @classmethod
+    def get_client(cls) -> httpx.AsyncClient:
+        """
+        获取共享的 HTTP 客户端
+        
+        客户端中的连接绑定在创建它的事件循环上（通常是共享运行时的事件循环），
+        事件循环变化时会重新创建
+        
+        Returns:
+            共享的 httpx.AsyncClient
+        """
+        loop = asyncio.get_running_loop()
+        with cls._client_lock:
+            if (cls._shared_client is None
+                    or cls._shared_client.is_closed
+                    or cls._shared_client_loop is not loop):
+                cls._shared_client = cls._create_client()
+                cls._shared_client_loop = loop
+            return cls._shared_client
+    
+    @classmethod
+    async def aclose(cls):
+        """等待后台分支确认完成，然后关闭共享的 HTTP 客户端，释放连接池中的所有连接"""
+        pending = list(cls._pending_choices.values())
+        if pending:
+            await asyncio.wait(pending, timeout=10)
+        with cls._client_lock:
+            client = cls._shared_client
+            cls._shared_client = None
+            cls._shared_client_loop = None
+        if client is not None and not client.is_closed:
+            await client.aclose()
+    
+    @classmethod
+    def close(cls):
+        """同步关闭共享客户端，供进程退出时调用"""
+        loop = cls._shared_client_loop
+        if cls._shared_client is None or loop is None or loop.is_closed():
+            cls._shared_client = None
+            cls._shared_client_loop = None
+            return
+        if loop.is_running():
+            # 客户端属于后台运行时的事件循环，提交到该循环中关闭
+            asyncio.run_coroutine_threadsafe(cls.aclose(), loop).result(timeout=5)
+        else:
+            loop.run_until_complete(cls.aclose())
+    
+    @classmethod
+    def pool_stats(cls) -> Dict[str, Any]:
+        """
+        连接池统计信息
+        
+        Returns:
+            请求数、连接复用命中/未命中次数及命中率
+        """
+        stats = dict(cls._pool_stats)
+        stats["hit_ratio"] = round(stats["hits"] / stats["requests"], 4) if stats["requests"] else 0.0
+        stats["http2"] = cls._http2_active
+        return stats
+    
+    @classmethod
+    def _record_pool_usage(cls, tracer: _PoolTracer):
+        """记录一次请求是否复用了连接池中的连接"""
+        cls._pool_stats["requests"] += 1
+        if tracer.connected:
+            cls._pool_stats["misses"] += 1
+        else:
+            cls._pool_stats["hits"] += 1
+    
+    async def _request(self, method: str, url: str, call: str = "request",
+                       timing: RequestTiming = null_timing, **kwargs) -> httpx.Response:
+        """
+        通过共享客户端发送请求
+        
+        Args:
+            method: HTTP 方法
+            url: 请求地址
+            call: 调用名称，作为指标的 call 标签、请求耗时的阶段名和熔断器的接口名
+            timing: 所属请求的阶段耗时
+        
+        Raises:
+            CircuitOpenError: 该接口在该账号上已熔断
+        """
+        breaker = circuit_breakers.get(call, self.account_id)
+        probe = breaker.acquire()
+        tracer = _PoolTracer()
+        started = time.perf_counter()
+        try:
+            resp = await self.get_client().request(method, url, extensions={"trace": tracer}, **kwargs)
+        except Exception as e:
+            breaker.release(probe, False, isinstance(e, httpx.TimeoutException))
+            metrics.upstream_errors.labels(call, type(e).__name__).inc()
+            self._report(False)
+            raise
+        except BaseException:
+            # 被取消（如落后的对冲请求），结果未知
+            breaker.release(probe, None)
+            raise
+        breaker.release(probe, resp.status_code < 500)
+        elapsed = time.perf_counter() - started
+        metrics.upstream_latency.labels(call).observe(elapsed)
+        timing.add(call, elapsed)
+        if resp.status_code >= 400:
+            metrics.upstream_errors.labels(call, resp.status_code).inc()
+        self._record_pool_usage(tracer)
+        self._report(resp.status_code < 400, resp.status_code)
+        return resp
+    
+    async def _control_request(self, method: str, url: str, call: str,
+                               timing: RequestTiming = null_timing, budget: Optional[RetryBudget] = None,
+                               max_attempts: Optional[int] = None, **kwargs) -> httpx.Response:
+        """发送控制接口请求，幂等接口超过近期 p95 耗时未返回时发送对冲请求，失败时退避重试"""
+        return await retry_policy.call(
+            call, lambda: self._request(method, url, call=call, timing=timing, **kwargs), budget, max_attempts
+        )
+    
+    @asynccontextmanager
+    async def _stream(self, method: str, url: str, call: str = "stream",
+                      timing: RequestTiming = null_timing, **kwargs):
+        """
+        通过共享客户端发送流式请求，耗时记录到收到响应头为止（请求耗时中的 connect 阶段）
+        
+        流完整读完后才向熔断器报告结果，读取过程中的错误和超时也计为失败
+        
+        Raises:
+            CircuitOpenError: 该接口在该账号上已熔断
+        """
+        breaker = circuit_breakers.get(call, self.account_id)
+        probe = breaker.acquire()
+        ok: Optional[bool] = None
+        timed_out = False
+        tracer = _PoolTracer()
+        status_code = None
+        started = time.perf_counter()
+        try:
+            async with self.get_client().stream(method, url, extensions={"trace": tracer}, **kwargs) as resp:
+                elapsed = time.perf_counter() - started
+                metrics.upstream_latency.labels(call).observe(elapsed)
+                timing.add("connect", elapsed)
+                self._record_pool_usage(tracer)
+                status_code = resp.status_code
+                if status_code >= 400:
+                    metrics.upstream_errors.labels(call, status_code).inc()
+                yield resp
+            ok = status_code < 500
+        except Exception as e:
+            ok, timed_out = False, isinstance(e, httpx.TimeoutException)
+            metrics.upstream_errors.labels(call, type(e).__name__).inc()
+            self._report(False, status_code)
+            raise
+        finally:
+            # 客户端断开等原因提前关闭时 ok 为 None，不计入熔断统计
+            breaker.release(probe, ok, timed_out)
+        self._report(status_code is not None and status_code < 400, status_code)
     
     async def model_view(self) -> Dict[str, Union[str, List[str]]]:
     
@@ -71,230 +326,305 @@ class AnuNekoAPI:
         """
         headers = self.build_headers()
         try:
-            async with httpx.AsyncClient(timeout=10) as client:
-                resp = await client.get(self.MODEL_VIEW_URL, headers=headers)
-                resp_json = resp.json()
-                return resp_json
+            resp = await self._control_request("GET", self.MODEL_VIEW_URL, "model_view", headers=headers,
+                                               timeout=10)
+            resp_json = json_codec.loads(resp.content)
+            return resp_json
         except Exception:
             pass
             
         return None
-    async def create_session(self, model: str = "Orange Cat") -> Optional[str]:
+    async def create_session(self, model: str = "Orange Cat", timing: RequestTiming = null_timing) -> Optional[str]:
         """
         创建新会话
         
         Args:
             model: 模型名称，默认为 "Orange Cat"
+            timing: 所属请求的阶段耗时
             
         Returns:
-            会话 ID，如果创建失败则返回 None
+            会话 ID，如果创建会话或切换模型失败则返回 None
+        
+        Raises:
+            CircuitOpenError: 上游已熔断
         """
         headers = self.build_headers()
-        data = json.dumps({"model": model})
+        data = json_codec.dumps({"model": model})
         
         try:
-            async with httpx.AsyncClient(timeout=10) as client:
-                resp = await client.post(self.CHAT_API_URL, headers=headers, content=data)
-                resp_json = resp.json()
-                
-                chat_id = resp_json.get("chat_id") or resp_json.get("id")
-                if chat_id:
-                    # 切换模型以确保一致性
-                    await self.switch_model(chat_id, model)
-                    return chat_id
+            resp = await self._control_request("POST", self.CHAT_API_URL, "create_session", timing,
+                                               headers=headers, content=data, timeout=10)
+            resp_json = json_codec.loads(resp.content)
+            
+            chat_id = resp_json.get("chat_id") or resp_json.get("id")
+            # 切换模型以确保一致性，切换失败的会话不在请求的模型上，视为创建失败
+            if chat_id and await self.switch_model(chat_id, model, timing):
+                return chat_id
+        except CircuitOpenError:
+            raise
         except Exception:
             pass
             
         return None
     
-    async def switch_model(self, chat_id: str, model_name: str) -> bool:
+    async def switch_model(self, chat_id: str, model_name: str, timing: RequestTiming = null_timing) -> bool:
         """
         切换模型
         
         Args:
             chat_id: 会话 ID
             model_name: 模型名称 ("Orange Cat" 或 "Exotic Shorthair")
+            timing: 所属请求的阶段耗时
             
         Returns:
             是否切换成功
+        
+        Raises:
+            CircuitOpenError: 上游已熔断
         """
         headers = self.build_headers()
-        data = json.dumps({"chat_id": chat_id, "model": model_name})
+        data = json_codec.dumps({"chat_id": chat_id, "model": model_name})
         
         try:
-            async with httpx.AsyncClient(timeout=10) as client:
-                resp = await client.post(self.SELECT_MODEL_URL, headers=headers, content=data)
-                return resp.status_code == 200
+            resp = await self._control_request("POST", self.SELECT_MODEL_URL, "switch_model", timing,
+                                               headers=headers, content=data, timeout=10)
+            return resp.status_code == 200
+        except CircuitOpenError:
+            raise
         except:
             pass
             
         return False
     
-    async def send_choice(self, msg_id: str, choice_idx: int = 0) -> bool:
+    async def send_choice(self, msg_id: str, choice_idx: int = 0, timing: RequestTiming = null_timing,
+                          budget: Optional[RetryBudget] = None, max_attempts: Optional[int] = None) -> bool:
         """
         发送选择回复
         
         Args:
             msg_id: 消息 ID
             choice_idx: 选择的回复索引，默认为 0
+            timing: 所属请求的阶段耗时
+            budget: 所属请求的重试预算
+            max_attempts: 最多的尝试次数，默认为 ANUNEKO_CONTROL_MAX_ATTEMPTS
             
         Returns:
             是否发送成功
         """
         headers = self.build_headers()
-        data = json.dumps({"msg_id": msg_id, "choice_idx": choice_idx})
+        data = json_codec.dumps({"msg_id": msg_id, "choice_idx": choice_idx})
         
         try:
-            async with httpx.AsyncClient(timeout=5) as client:
-                resp = await client.post(self.SELECT_CHOICE_URL, headers=headers, content=data)
-                return resp.status_code == 200
+            resp = await self._control_request("POST", self.SELECT_CHOICE_URL, "send_choice", timing, budget,
+                                               max_attempts, headers=headers, content=data, timeout=5)
+            return resp.status_code == 200
         except:
             pass
             
         return False
     
-    async def stream_reply(self, session_uuid: str, text: str) -> str:
+    async def _confirm_choice(self, msg_id: str, timing: RequestTiming = null_timing,
+                              budget: Optional[RetryBudget] = None):
+        """发送分支确认，失败时由控制接口的重试策略退避重试（最多重试 ANUNEKO_CHOICE_RETRIES 次）"""
+        retries = int(os.environ.get("ANUNEKO_CHOICE_RETRIES", "2"))
+        if await self.send_choice(msg_id, timing=timing, budget=budget, max_attempts=retries + 1):
+            self._choice_stats["confirmed"] += 1
+            return
+        self._choice_stats["failed"] += 1
+        print(f"确认对话分支失败: msg_id={msg_id}")
+    
+    def schedule_choice(self, session_uuid: str, msg_id: str, timing: RequestTiming = null_timing,
+                        budget: Optional[RetryBudget] = None):
         """
-        流式发送消息并获取回复
+        在后台确认对话分支，不阻塞当前响应
+        
+        Args:
+            session_uuid: 会话 UUID
+            msg_id: 需要确认的消息 ID
+            timing: 所属请求的阶段耗时
+            budget: 所属请求的重试预算，后台任务与请求共用
+        """
+        task = asyncio.ensure_future(self._confirm_choice(msg_id, timing, budget))
+        self._pending_choices[session_uuid] = task
+        self._choice_stats["scheduled"] += 1
+        
+        def cleanup(done: asyncio.Task):
+            if self._pending_choices.get(session_uuid) is done:
+                del self._pending_choices[session_uuid]
+        
+        task.add_done_callback(cleanup)
+    
+    async def wait_pending_choice(self, session_uuid: str, timing: RequestTiming = null_timing):
+        """如果该会话上一轮的分支确认仍在进行，等待其完成"""
+        task = self._pending_choices.get(session_uuid)
+        if task is not None and not task.done():
+            self._choice_stats["waited"] += 1
+            with timing.phase("choice_wait"):
+                await asyncio.shield(task)
+    
+    async def settle_choice(self, session_uuid: str):
+        """等待本轮在后台进行的分支确认结束（不计入等待次数），用于在流式响应末尾报告其耗时"""
+        task = self._pending_choices.get(session_uuid)
+        if task is not None and not task.done():
+            await asyncio.shield(task)
+    
+    @classmethod
+    def choice_stats(cls) -> Dict[str, int]:
+        """分支确认统计信息"""
+        stats = dict(cls._choice_stats)
+        stats["pending"] = len(cls._pending_choices)
+        return stats
+    
+    @classmethod
+    def failed_reply(cls, reply: str) -> bool:
+        """回复是否为空（上游返回错误状态码时没有内容）或以上游失败的提示结束（流式回复在部分内容之后输出提示）"""
+        return not reply or reply.endswith((cls.FAILURE_REPLY, cls.CHOICE_SHOWN_REPLY))
+    
+    @classmethod
+    def stream_stats(cls) -> Dict[str, int]:
+        """上游流式回复统计信息"""
+        stats = dict(cls._stream_stats)
+        stats["in_flight"] = stats["started"] - stats["completed"] - stats["cancelled"] - stats["failed"]
+        return stats
+    
+    async def _reply_events(self, session_uuid: str, text: str,
+                            timing: RequestTiming = null_timing) -> AsyncGenerator[StreamEvent, None]:
+        """
+        发送消息并解析上游流式响应
+        
+        流正常结束且带有 msg_id 时，在后台确认选择第一个分支
         
         Args:
             session_uuid: 会话 UUID
             text: 要发送的文本
+            timing: 所属请求的阶段耗时
             
-        Returns:
-            AI 的回复文本
+        Yields:
+            流事件
         """
         headers = self.build_headers("text/plain")
         
         url = self.STREAM_API_URL.format(uuid=session_uuid)
-        data = json.dumps({"contents": [text]}, ensure_ascii=False)
+        data = json_codec.dumps({"contents": [text]})
         
-        result = ""
         current_msg_id = None
+        # 第一个事件之前的代码在发起请求的任务中执行，此时取出请求的重试预算，供流结束后的分支确认使用
+        budget = retry_policy.current_budget()
         
+        # 上一轮的分支确认尚未完成时需要先等待，否则上游会返回 chat_choice_shown
+        await self.wait_pending_choice(session_uuid, timing)
+        
+        # 片段数在本地累计，流结束后一次写入指标，不在每个片段上更新
+        started = time.perf_counter()
+        tokens = 0
+        upstream_error = False
+        metrics.streams_in_flight.inc()
+        self._stream_stats["started"] += 1
         try:
-            async with httpx.AsyncClient(timeout=None) as client:
-                async with client.stream("POST", url, headers=headers, content=data) as resp:
-                    async for line in resp.aiter_lines():
-                        if not line:
-                            continue
-                        
-                        # 处理错误响应
-                        if not line.startswith("data: "):
-                            try:
-                                error_json = json.loads(line)
-                                if error_json.get("code") == "chat_choice_shown":
-                                    return "⚠️ 检测到对话分支未选择，请重试或新建会话。"
-                            except:
-                                pass
-                            continue
-                        
-                        # 处理 data: {}
-                        try:
-                            raw_json = line[6:]
-                            if not raw_json.strip():
-                                continue
-                                
-                            j = json.loads(raw_json)
-                            
-                            # 只要出现 msg_id 就更新，流最后一条通常是 assistmsg，也就是我们要的 ID
-                            if "msg_id" in j:
-                                current_msg_id = j["msg_id"]
-                            
-                            # 如果有 'c' 字段，说明是多分支内容
-                            # 格式如: {"c":[{"v":"..."},{"v":"...","c":1}]}
-                            if "c" in j and isinstance(j["c"], list):
-                                for choice in j["c"]:
-                                    # 默认选项 idx=0，可能显式 c=0 或隐式(无 c 字段)
-                                    idx = choice.get("c", 0)
-                                    if idx == 0:
-                                        if "v" in choice:
-                                            result += choice["v"]
-                            
-                            # 常规内容 (兼容旧格式或无分支情况)
-                            elif "v" in j and isinstance(j["v"], str):
-                                result += j["v"]
-                                
-                        except:
-                            continue
+            async with self._stream("POST", url, timing=timing, headers=headers, content=data, timeout=None) as resp:
+                try:
+                    async for event in parse_stream(resp.aiter_bytes()):
+                        if isinstance(event, ContentDelta):
+                            if not tokens:
+                                first_token = time.perf_counter() - started
+                                metrics.time_to_first_token.observe(first_token)
+                                timing.add("first_token", first_token)
+                            tokens += 1
+                        elif isinstance(event, MessageId):
+                            current_msg_id = event.msg_id
+                        elif isinstance(event, ErrorCode):
+                            upstream_error = True
+                            metrics.upstream_errors.labels("stream", event.code).inc()
+                        yield event
+                finally:
+                    metrics.bytes_relayed.inc(resp.num_bytes_downloaded)
+            self._stream_stats["completed"] += 1
+        except (GeneratorExit, asyncio.CancelledError):
+            # 客户端断开时生成器被关闭或任务被取消，退出 _stream 时关闭上游连接，不再继续下载；
+            # 收到上游错误后由调用方主动关闭的不算
+            if upstream_error:
+                self._stream_stats["completed"] += 1
+            else:
+                self._stream_stats["cancelled"] += 1
+                metrics.streams_cancelled.inc()
+            raise
+        except Exception:
+            self._stream_stats["failed"] += 1
+            raise
+        finally:
+            metrics.streams_in_flight.dec()
+            metrics.tokens_relayed.inc(tokens)
+            elapsed = time.perf_counter() - started
+            metrics.stream_duration.observe(elapsed)
+            timing.add("stream", elapsed)
+        
+        # 流结束后，如果有 msg_id，在后台自动确认选择第一项，确保下次对话正常
+        if current_msg_id:
+            self.schedule_choice(session_uuid, current_msg_id, timing, budget)
+    
+    async def stream_reply(self, session_uuid: str, text: str, timing: RequestTiming = null_timing) -> str:
+        """
+        流式发送消息并获取回复
+        
+        Args:
+            session_uuid: 会话 UUID
+            text: 要发送的文本
+            timing: 所属请求的阶段耗时
             
-            # 流结束后，如果有 msg_id，自动确认选择第一项，确保下次对话正常
-            if current_msg_id:
-                await self.send_choice(current_msg_id)
-                
+        Returns:
+            AI 的回复文本
+        
+        Raises:
+            CircuitOpenError: 上游已熔断，不再以失败提示代替回复
+        """
+        # 片段先收集到列表中，最后一次拼接
+        parts: List[str] = []
+        
+        try:
+            events = self._reply_events(session_uuid, text, timing)
+            try:
+                async for event in events:
+                    if isinstance(event, ContentDelta):
+                        parts.append(event.text)
+                    elif isinstance(event, ErrorCode) and event.code == "chat_choice_shown":
+                        return self.CHOICE_SHOWN_REPLY
+            finally:
+                await events.aclose()
+        except CircuitOpenError:
+            raise
         except Exception:
-            return "请求失败，请稍后再试。"
+            return self.FAILURE_REPLY
             
-        return result
+        return "".join(parts)
     
-    async def stream_reply_generator(self, session_uuid: str, text: str) -> AsyncGenerator[str, None]:
+    async def stream_reply_generator(self, session_uuid: str, text: str,
+                                     timing: RequestTiming = null_timing) -> AsyncGenerator[str, None]:
         """
         流式发送消息并生成器方式获取回复
         
         Args:
             session_uuid: 会话 UUID
             text: 要发送的文本
+            timing: 所属请求的阶段耗时
             
         Yields:
             AI 的回复文本片段
-        """
-        headers = self.build_headers("text/plain")
-        
-        url = self.STREAM_API_URL.format(uuid=session_uuid)
-        data = json.dumps({"contents": [text]}, ensure_ascii=False)
-        
-        current_msg_id = None
         
+        Raises:
+            CircuitOpenError: 上游已熔断，不再以失败提示代替回复
+        """
         try:
-            async with httpx.AsyncClient(timeout=None) as client:
-                async with client.stream("POST", url, headers=headers, content=data) as resp:
-                    async for line in resp.aiter_lines():
-                        if not line:
-                            continue
-                        
-                        # 处理错误响应
-                        if not line.startswith("data: "):
-                            try:
-                                error_json = json.loads(line)
-                                if error_json.get("code") == "chat_choice_shown":
-                                    yield "⚠️ 检测到对话分支未选择，请重试或新建会话。"
-                                    return
-                            except:
-                                pass
-                            continue
-                        
-                        # 处理 data: {}
-                        try:
-                            raw_json = line[6:]
-                            if not raw_json.strip():
-                                continue
-                                
-                            j = json.loads(raw_json)
-                            
-                            # 只要出现 msg_id 就更新，流最后一条通常是 assistmsg，也就是我们要的 ID
-                            if "msg_id" in j:
-                                current_msg_id = j["msg_id"]
-                            
-                            # 如果有 'c' 字段，说明是多分支内容
-                            # 格式如: {"c":[{"v":"..."},{"v":"...","c":1}]}
-                            if "c" in j and isinstance(j["c"], list):
-                                for choice in j["c"]:
-                                    # 默认选项 idx=0，可能显式 c=0 或隐式(无 c 字段)
-                                    idx = choice.get("c", 0)
-                                    if idx == 0:
-                                        if "v" in choice:
-                                            yield choice["v"]
-                            
-                            # 常规内容 (兼容旧格式或无分支情况)
-                            elif "v" in j and isinstance(j["v"], str):
-                                yield j["v"]
-                                
-                        except:
-                            continue
-            
-            # 流结束后，如果有 msg_id，自动确认选择第一项，确保下次对话正常
-            if current_msg_id:
-                await self.send_choice(current_msg_id)
-                
+            events = self._reply_events(session_uuid, text, timing)
+            try:
+                async for event in events:
+                    if isinstance(event, ContentDelta):
+                        yield event.text
+                    elif isinstance(event, ErrorCode) and event.code == "chat_choice_shown":
+                        yield self.CHOICE_SHOWN_REPLY
+                        return
+            finally:
+                await events.aclose()
+        except CircuitOpenError:
+            raise
         except Exception:
-            yield "请求失败，请稍后再试。"
\ No newline at end of file
+            yield self.FAILURE_REPLY
\ No newline at end of file
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+异步运行时
+在后台线程中维护一个常驻事件循环，供同步代码（Flask 视图）提交协程和消费异步生成器
+"""
+
+import os
+import time
+import queue
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import CancelledError, Future, TimeoutError
+from typing import Any, AsyncIterator, Callable, Coroutine, Generator, Optional
+
+
+class _Raised:
+    """跨线程传递异步生成器中抛出的异常"""
+
+    __slots__ = ("exc",)
+
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+_END = object()
+
+# 桥接同步生成器时最多缓冲的数据块数，调用方（客户端）读取跟不上时暂停读取上游
+STREAM_BUFFER_CHUNKS = int(os.environ.get("STREAM_BUFFER_CHUNKS", "64"))
+
+# 同步等待协程时检查取消条件（如客户端是否已断开）的间隔（秒）
+CANCEL_POLL_INTERVAL = 0.25
+
+
+class AsyncRuntime:
+    """后台事件循环运行时，每个工作进程一个"""
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """获取运行中的事件循环，必要时启动后台线程"""
+        # fork 之后线程不会被继承，需要在子进程中重新启动
+        if self._loop is None or self._pid != os.getpid():
+            self.start()
+        return self._loop
+
+    def start(self):
+        """启动后台事件循环线程"""
+        with self._lock:
+            if self._loop is not None and self._pid == os.getpid():
+                return
+
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run_loop():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(ready.set)
+                loop.run_forever()
+
+            thread = threading.Thread(target=run_loop, name="anuneko-async-runtime", daemon=True)
+            thread.start()
+            ready.wait()
+
+            self._loop = loop
+            self._thread = thread
+            self._pid = os.getpid()
+
+    def bind_loop(self, loop: asyncio.AbstractEventLoop):
+        """
+        使用外部已运行的事件循环（如 ASGI 服务器的事件循环）作为运行时
+
+        需要在该事件循环所在线程中调用
+        """
+        with self._lock:
+            self._loop = loop
+            self._thread = threading.current_thread()
+            self._pid = os.getpid()
+
+    def in_loop_thread(self) -> bool:
+        """当前线程是否为运行时事件循环所在线程"""
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def run(self, coro: Coroutine, timeout: Optional[float] = None,
+            cancel_when: Optional[Callable[[], bool]] = None) -> Any:
+        """
+        在运行时事件循环中执行协程并阻塞等待结果
+
+        Args:
+            coro: 要执行的协程
+            timeout: 等待超时时间（秒），None 表示不限制
+            cancel_when: 等待期间定期调用，返回 True 时取消协程
+
+        Returns:
+            协程的返回值
+
+        Raises:
+            concurrent.futures.CancelledError: cancel_when 返回 True，协程已被取消
+        """
+        if self.in_loop_thread():
+            coro.close()
+            raise RuntimeError("不能在运行时事件循环线程中同步等待协程")
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if cancel_when is None:
+            return future.result(timeout)
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = CANCEL_POLL_INTERVAL
+            if deadline is not None:
+                wait = min(wait, max(0.0, deadline - time.monotonic()))
+            try:
+                return future.result(wait)
+            except TimeoutError:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+                if cancel_when():
+                    future.cancel()
+                    raise CancelledError()
+
+    def spawn(self, coro: Coroutine) -> Future:
+        """
+        在运行时事件循环中后台执行协程，不等待结果
+
+        协程在空白的上下文中执行，不继承发起它的客户端请求的上下文变量（如重试预算）
+
+        Returns:
+            concurrent.futures.Future
+        """
+        return contextvars.Context().run(asyncio.run_coroutine_threadsafe, coro, self.loop)
+
+    def iterate(self, agen: AsyncIterator, buffer: int = STREAM_BUFFER_CHUNKS) -> Generator[Any, None, None]:
+        """
+        将异步生成器桥接为同步生成器
+
+        异步生成器在运行时事件循环中运行，产出的数据通过线程安全队列交给调用方；
+        队列中未被取走的数据达到 buffer 个时暂停读取，避免客户端读取缓慢或已断开时数据在内存中堆积。
+        调用方提前关闭同步生成器时（如 WSGI 服务器写入失败，检测到客户端断开）取消对应的任务并关闭异步生成器，
+        上游连接随之关闭
+
+        Args:
+            agen: 异步生成器
+            buffer: 最多缓冲的数据块数
+
+        Yields:
+            异步生成器产出的数据
+        """
+        items: "queue.SimpleQueue[Any]" = queue.SimpleQueue()
+        loop = self.loop
+        # 空闲的缓冲位置，在事件循环中创建，调用方取走数据后在事件循环中归还
+        slots: Optional[asyncio.Semaphore] = None
+
+        async def pump():
+            nonlocal slots
+            slots = asyncio.Semaphore(buffer)
+            try:
+                async for item in agen:
+                    items.put(item)
+                    await slots.acquire()
+            except BaseException as e:
+                items.put(_Raised(e))
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+            finally:
+                items.put(_END)
+                # 在等待缓冲位置时被取消的，异步生成器仍停在 yield 处，需要显式关闭
+                aclose = getattr(agen, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+
+        future = asyncio.run_coroutine_threadsafe(pump(), loop)
+        try:
+            while True:
+                item = items.get()
+                if item is _END:
+                    break
+                if isinstance(item, _Raised):
+                    raise item.exc
+                loop.call_soon_threadsafe(slots.release)
+                yield item
+        finally:
+            if not future.done():
+                future.cancel()
+
+    def stop(self):
+        """停止后台事件循环（外部绑定的事件循环由其所有者负责停止）"""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = None
+            self._thread = None
+        if thread is None or thread.name != "anuneko-async-runtime":
+            return
+        if loop is not None and loop.is_running():
+            loop.call_soon_threadsafe(loop.stop)
+            if thread is not None:
+                thread.join(timeout=5)
+
+
+# 全局异步运行时实例
+runtime = AsyncRuntime()
@@ -4,29 +4,39 @@
 处理聊天完成相关的逻辑
 """
 
-import json
 import time
 import uuid
-import asyncio
-from typing import Dict, Any, Generator
+import inspect
+from concurrent.futures import CancelledError
+from contextlib import asynccontextmanager
+from typing import Dict, Any, AsyncGenerator, AsyncIterator, Callable, List, Optional
 
 from flask import Response, stream_with_context
 
 from app.services.anuneko_service import AnuNekoAPI
-from app.services.session_service import session_service
+from app.services.session_service import session_service, SessionBusyError
+from app.services.account_pool import account_pool
+from app.services.admission import admission, AdmissionRejected, AdmissionTicket
+from app.services.circuit_breaker import CircuitOpenError, circuit_breakers
+from app.services.async_runtime import runtime
+from app.services.conversation_index import conversation_index
+from app.services.profiler import request_profiler
+from app.services.request_timing import RequestTiming, null_timing
+from app.services.response_cache import response_cache
+from app.services.retry_policy import retry_policy
+from app.services.single_flight import SharedGeneration, single_flight
+from app.services.sse_writer import SSEWriter
+
+# 不生成回复、直接返回错误状态码的异常：会话繁忙、上游并发已满（429）和上游熔断（503）
+REJECTIONS = (SessionBusyError, AdmissionRejected, CircuitOpenError)
 
 
 class ChatService:
     """聊天服务类"""
     
-    def __init__(self):
-        self._anuneko_api: AnuNekoAPI = None
-    
     def get_anuneko_api(self) -> AnuNekoAPI:
-        """获取 AnuNeko API 实例"""
-        if self._anuneko_api is None:
-            self._anuneko_api = AnuNekoAPI()
-        return self._anuneko_api
+        """获取 AnuNeko API 实例（负载最低的健康账号）"""
+        return session_service.get_anuneko_api()
     
     def format_openai_response(self, model: str, content: str, session_id: str = None) -> Dict[str, Any]:
         """格式化 OpenAI API 响应"""
@@ -54,30 +64,138 @@ class ChatService:
         }
     
     def format_openai_chunk(self, model: str, content: str, session_id: str = None) -> str:
-        """格式化 OpenAI API 流式响应块"""
-        chunk = {
-            "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
-            "object": "chat.completion.chunk",
-            "created": int(time.time()),
-            "model": model,
-            "choices": [
-                {
-                    "index": 0,
-                    "delta": {
-                        "content": content
-                    },
-                    "finish_reason": None
-                }
-            ]
-        }
+        """格式化 OpenAI API 流式响应块（单独的一块，流式响应中使用 SSEWriter）"""
+        return SSEWriter(model, session_id).delta(content)
+    
+    @asynccontextmanager
+    async def upstream_turn(self, session: Dict[str, Any], ticket: AdmissionTicket,
+                            timing: RequestTiming = null_timing) -> AsyncIterator[None]:
+        """
+        在会话队列中排到、并取得上游并发名额后才开始向上游发送消息，生成期间占用会话所属账号的负载
+        
+        先排会话队列再申请名额，同一会话排队的请求不会占用名额
+        """
+        queued = time.perf_counter()
+        async with session_service.chat_turn(session):
+            timing.since("queue", queued)
+            async with admission.slot(ticket, timing), account_pool.lease(session.get("account_id")):
+                yield
+    
+    def format_rejection(self, error: Exception):
+        """会话繁忙、上游并发已满时返回的 429 错误，上游熔断时返回的 503 错误"""
+        if isinstance(error, CircuitOpenError):
+            return ({"error": {"message": str(error), "type": "server_error", "code": "upstream_unavailable"}},
+                    503, {"Retry-After": str(error.retry_after)})
+        if isinstance(error, AdmissionRejected):
+            return ({"error": {"message": str(error), "type": "rate_limit_error", "code": "server_overloaded"}},
+                    429, {"Retry-After": str(error.retry_after)})
+        return {"error": {"message": str(error), "type": "rate_limit_error", "code": "session_busy"}}, 429
+    
+    def record_reply(self, messages: List[Dict[str, Any]], reply: str, session_id: str, cache_key: Optional[str]):
+        """
+        记录本轮历史并缓存回复，客户端带着这段历史再次请求时续接到同一个会话
+        
+        上游失败时回复以失败提示结束，不记录也不缓存，否则下一轮会带着失败提示续接到出错的会话
+        """
+        if AnuNekoAPI.failed_reply(reply):
+            return
+        if messages:
+            conversation_index.remember(messages, reply, session_id)
+        response_cache.put(cache_key, reply)
+    
+    async def stream_chat_chunks(self, api: AnuNekoAPI, session: Dict[str, Any], user_message: str,
+                                 model: str, messages: Optional[List[Dict[str, Any]]] = None,
+                                 cache_key: Optional[str] = None,
+                                 timing: RequestTiming = null_timing,
+                                 ticket: Optional[AdmissionTicket] = None) -> AsyncGenerator[str, None]:
+        """生成 OpenAI 格式的 SSE 数据块"""
+        # 同一次完成的所有数据块共用一个 ID，外层结构只编码一次
+        writer = SSEWriter(model, session["id"])
+        parts = []
+        
+        async with self.upstream_turn(session, ticket or admission.ticket(model, True), timing):
+            pieces = api.stream_reply_generator(session["anuneko_chat_id"], user_message, timing)
+            async for piece in writer.coalesce(pieces):
+                parts.append(piece)
+                yield writer.delta(piece)
         
-        if session_id:
-            chunk["session_id"] = session_id
+        # 完整输出后记录本轮历史
+        self.record_reply(messages, "".join(parts), session["id"], cache_key)
         
-        return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+        # 发送结束块
+        yield writer.end()
+        
+        if timing is not null_timing:
+            # 客户端已收到 [DONE]，等后台的分支确认结束后再输出耗时注释，使其包含 send_choice
+            await api.settle_choice(session["anuneko_chat_id"])
     
-    def process_chat_request(self, request_data: Dict[str, Any]):
-        """处理聊天请求"""
+    async def produce_shared(self, generation: SharedGeneration, request_data: Dict[str, Any],
+                             user_message: str, cache_key: Optional[str], ticket: AdmissionTicket):
+        """为合并的相同请求执行一次上游生成，片段分发给所有等待的请求"""
+        session_id = await session_service.aget_session_for_request(request_data)
+        session = session_service.get_session(session_id)
+        api = session_service.get_anuneko_api(session)
+        generation.start(session_id)
+        
+        async with self.upstream_turn(session, ticket):
+            async for piece in api.stream_reply_generator(session["anuneko_chat_id"], user_message):
+                generation.publish(piece)
+        
+        self.record_reply(request_data.get("messages") or [], generation.text, session_id, cache_key)
+    
+    async def shared_chunks(self, generation: SharedGeneration, model: str) -> AsyncGenerator[str, None]:
+        """以流式格式输出共享生成的回复，先输出已生成的部分"""
+        try:
+            await generation.ready()
+            writer = SSEWriter(model, generation.session_id)
+            async for piece in writer.coalesce(generation.pieces()):
+                yield writer.delta(piece)
+        finally:
+            generation.leave()
+        yield writer.end()
+    
+    async def replay_chunks(self, model: str, reply: str) -> AsyncGenerator[str, None]:
+        """以流式格式输出缓存的回复"""
+        writer = SSEWriter(model)
+        yield writer.delta(reply)
+        yield writer.end()
+    
+    async def aprocess_chat_request(self, request_data: Dict[str, Any], cache_control: Optional[str] = None,
+                                    timing: Optional[RequestTiming] = None, profile: Optional[str] = None,
+                                    authorization: Optional[str] = None):
+        """
+        处理聊天请求
+        
+        Args:
+            request_data: 请求数据
+            cache_control: 请求的 Cache-Control 头，no-cache 重新生成回复，no-store 不使用响应缓存
+            timing: 记录本次请求各阶段耗时，流式响应结束时以 SSE 注释输出
+            profile: 请求的 X-Profile 头，开启性能分析时对本次请求执行 cProfile
+            authorization: 请求的 Authorization 头，上游并发名额按其中的 API Key 公平分配
+        
+        Returns:
+            错误时返回 (错误体, 状态码) 或 (错误体, 状态码, 响应头)，非流式返回响应字典，流式返回 SSE 数据块的异步生成器
+        """
+        if timing is None:
+            timing = RequestTiming()
+        # 本次请求中的控制接口调用共用一份重试预算
+        retry_policy.begin_request()
+        
+        profile_session = request_profiler.start(profile)
+        if profile_session is None:
+            return await self._aprocess_chat_request(request_data, cache_control, timing, authorization)
+        
+        timing.profile_id = profile_session.id
+        result = await profile_session.run(
+            self._aprocess_chat_request(request_data, cache_control, timing, authorization)
+        )
+        if inspect.isasyncgen(result):
+            return profile_session.wrap_stream(result)
+        profile_session.save()
+        return result
+    
+    async def _aprocess_chat_request(self, request_data: Dict[str, Any], cache_control: Optional[str],
+                                     timing: RequestTiming, authorization: Optional[str] = None):
         if not request_data:
             return {"error": {"message": "请求体不能为空", "type": "invalid_request_error"}}, 400
         
@@ -97,75 +215,135 @@ class ChatService:
         
         model = request_data.get("model", "gpt-3.5-turbo")
         stream = request_data.get("stream", False)
+        # 流式请求进入交互通道，先于非流式的批量请求取得上游并发名额
+        ticket = admission.ticket(model, stream, authorization)
         
-        # 获取或创建会话
-        session_id = session_service.get_session_for_request(request_data)
-        session = session_service.get_session(session_id)
+        # 完全相同的请求直接返回缓存的回复，不创建会话也不请求上游
+        cache_key, cached = response_cache.lookup(request_data, cache_control)
+        if cached is not None:
+            timing.add("cache", desc="hit")
+            if stream:
+                return await self.prime_stream(self.replay_chunks(model, cached), timing)
+            return self.format_openai_response(model, cached)
         
-        if stream:
-            # 流式响应
-            def generate():
-                api = self.get_anuneko_api()
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                
+        try:
+            # 上游流式接口已熔断时直接返回 503，不再排队、创建会话或切换模型；熔断结束后放行试探请求
+            circuit_breakers.check("stream", session_service.request_accounts(request_data))
+        except CircuitOpenError as e:
+            return self.format_rejection(e)
+        
+        if single_flight.enabled and not request_data.get("session_id"):
+            # 相同请求正在生成时加入其中，不再单独请求上游
+            generation, started = single_flight.join(
+                cache_key or response_cache.key(model, messages),
+                lambda g: self.produce_shared(g, request_data, user_message, cache_key, ticket)
+            )
+            timing.add("coalesced", desc="leader" if started else "joined")
+            try:
+                if stream:
+                    return await self.prime_stream(self.shared_chunks(generation, model), timing)
                 try:
-                    async def stream_generator():
-                        async for chunk in api.stream_reply_generator(
-                            session["anuneko_chat_id"], user_message
-                        ):
-                            yield self.format_openai_chunk(model, chunk, session_id)
-                        
-                        # 发送结束块
-                        end_chunk = {
-                            "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
-                            "object": "chat.completion.chunk",
-                            "created": int(time.time()),
-                            "model": model,
-                            "choices": [
-                                {
-                                    "index": 0,
-                                    "delta": {},
-                                    "finish_reason": "stop"
-                                }
-                            ]
-                        }
-                        yield f"data: {json.dumps(end_chunk, ensure_ascii=False)}\n\n"
-                        yield "data: [DONE]\n\n"
-                    
-                    # 运行异步生成器
-                    async_gen = stream_generator()
-                    while True:
-                        try:
-                            chunk = loop.run_until_complete(async_gen.__anext__())
-                            yield chunk
-                        except StopAsyncIteration:
-                            break
+                    reply = await generation.result()
                 finally:
-                    loop.close()
+                    generation.leave()
+                return self.format_openai_response(model, reply, generation.session_id)
+            except REJECTIONS as e:
+                return self.format_rejection(e)
+        
+        try:
+            # 上游并发已满且排队已满时，在创建会话之前拒绝
+            admission.check(ticket)
             
+            # 获取或创建会话
+            with timing.phase("session"):
+                session_id = await session_service.aget_session_for_request(request_data, timing)
+            session = session_service.get_session(session_id)
+            api = session_service.get_anuneko_api(session)
+            
+            if stream:
+                # 流式响应
+                return await self.prime_stream(
+                    self.stream_chat_chunks(api, session, user_message, model, messages, cache_key, timing, ticket),
+                    timing
+                )
+            
+            # 非流式响应
+            async with self.upstream_turn(session, ticket, timing):
+                response = await api.stream_reply(session["anuneko_chat_id"], user_message, timing)
+            self.record_reply(messages, response, session_id, cache_key)
+            return self.format_openai_response(model, response, session_id)
+        except REJECTIONS as e:
+            return self.format_rejection(e)
+    
+    async def prime_stream(self, agen: AsyncGenerator[str, None],
+                           timing: RequestTiming = null_timing) -> AsyncGenerator[str, None]:
+        """
+        预先取出流的第一个数据块
+        
+        排队、会话繁忙等错误在返回响应头之前抛出，可以返回正确的状态码；
+        生成器一旦启动，即使之后被丢弃，事件循环也会负责关闭它并释放会话队列
+        
+        Args:
+            agen: SSE 数据块的异步生成器
+            timing: 本次请求的阶段耗时，流正常结束后输出为 SSE 注释
+            
+        Returns:
+            从第一个数据块开始的异步生成器
+        """
+        first = await agen.__anext__()
+        
+        async def primed():
+            try:
+                yield first
+                async for chunk in agen:
+                    yield chunk
+                if timing is not null_timing:
+                    yield timing.sse_comment()
+            finally:
+                await agen.aclose()
+        
+        return primed()
+    
+    def process_chat_request(self, request_data: Dict[str, Any], cache_control: Optional[str] = None,
+                             timing: Optional[RequestTiming] = None, profile: Optional[str] = None,
+                             authorization: Optional[str] = None,
+                             disconnected: Optional[Callable[[], bool]] = None):
+        """
+        处理聊天请求（同步入口，供 Flask 视图使用）
+        
+        disconnected 用于在排队、创建会话或等待非流式回复期间检查客户端是否已断开，断开时取消请求；
+        流式响应开始后由 WSGI 服务器写入失败时关闭生成器
+        """
+        if timing is None:
+            timing = RequestTiming()
+        try:
+            result = runtime.run(
+                self.aprocess_chat_request(request_data, cache_control, timing, profile, authorization),
+                cancel_when=disconnected
+            )
+        except CancelledError:
+            return {
+                "error": {
+                    "message": "客户端已断开连接",
+                    "type": "invalid_request_error",
+                    "code": "client_closed_request"
+                }
+            }, 499
+        
+        if inspect.isasyncgen(result):
             return Response(
-                stream_with_context(generate()),
+                # 异步生成器在共享运行时中执行，通过队列逐块交给 WSGI 线程
+                stream_with_context(runtime.iterate(result)),
                 mimetype="text/plain",
                 headers={
                     "Cache-Control": "no-cache",
                     "Connection": "keep-alive",
-                    "Content-Type": "text/event-stream"
+                    "Content-Type": "text/event-stream",
+                    **timing.headers()
                 }
             )
-        else:
-            # 非流式响应
-            api = self.get_anuneko_api()
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            
-            try:
-                response = loop.run_until_complete(
-                    api.stream_reply(session["anuneko_chat_id"], user_message)
-                )
-                return self.format_openai_response(model, response, session_id)
-            finally:
-                loop.close()
+        
+        return result
 
 
 # 全局聊天服务实例
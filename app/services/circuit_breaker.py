@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+上游熔断
+按接口和账号统计最近的上游调用结果，错误和超时比例过高时熔断：熔断期间直接拒绝请求（返回 503），
+不再占用连接和工作线程等待一个已经不可用的上游；熔断时间结束后放行少量试探请求，全部成功才恢复
+"""
+
+import os
+import math
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, Optional, Tuple
+
+from app.services import metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# 指标中的状态取值
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# 没有指定账号的 API 实例
+DEFAULT_ACCOUNT = "default"
+
+
+class CircuitOpenError(Exception):
+    """上游已熔断，请求被直接拒绝"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        # 建议客户端重试前等待的秒数
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """一个接口在一个账号上的熔断器"""
+
+    def __init__(self, endpoint: str, account: str, registry: "CircuitBreakerRegistry"):
+        self.endpoint = endpoint
+        self.account = account
+        self.config = registry
+        self.state = CLOSED
+        # 最近的调用结果，True 表示失败
+        self._outcomes: Deque[bool] = deque(maxlen=registry.window)
+        self._failures = 0
+        self.opened_at = 0.0
+        # 半开状态下正在进行的试探请求数和已成功的试探请求数
+        self._probes = 0
+        self._probe_successes = 0
+        self._stats = {"requests": 0, "failures": 0, "timeouts": 0, "rejected": 0, "opened": 0}
+
+    def _set_state(self, state: str):
+        self.state = state
+        metrics.circuit_state.labels(self.endpoint, self.account).set(STATE_VALUES[state])
+
+    def _trip(self):
+        """熔断"""
+        self._set_state(OPEN)
+        self.opened_at = time.monotonic()
+        self._outcomes.clear()
+        self._failures = 0
+        self._stats["opened"] += 1
+        metrics.circuit_opened.labels(self.endpoint, self.account).inc()
+        print(f"上游熔断: {self.endpoint} (账号 {self.account})，{self.config.open_seconds:.0f} 秒后试探恢复")
+
+    def _reject(self, retry_after: float) -> CircuitOpenError:
+        self._stats["rejected"] += 1
+        metrics.circuit_rejections.labels(self.endpoint).inc()
+        return CircuitOpenError("上游服务暂时不可用，请稍后再试", max(1, math.ceil(retry_after)))
+
+    @property
+    def available(self) -> bool:
+        """熔断时间是否已经结束（或未熔断）"""
+        return self.state != OPEN or time.monotonic() - self.opened_at >= self.config.open_seconds
+
+    def admits(self) -> Optional[float]:
+        """
+        不占用试探名额地检查现在是否可以发送请求
+
+        Returns:
+            可以发送时返回 None，否则返回建议的重试等待秒数
+        """
+        if self.state == OPEN:
+            remaining = self.config.open_seconds - (time.monotonic() - self.opened_at)
+            # 熔断时间已结束，下一个请求将作为试探请求
+            return remaining if remaining > 0 else None
+        if self.state == HALF_OPEN and self._probes >= self.config.half_open_probes:
+            return 1
+        return None
+
+    def acquire(self) -> bool:
+        """
+        在发送请求之前调用
+
+        Returns:
+            本次请求是否为半开状态下的试探请求
+
+        Raises:
+            CircuitOpenError: 已熔断，或半开状态下的试探请求数已满
+        """
+        if self.state == OPEN:
+            remaining = self.config.open_seconds - (time.monotonic() - self.opened_at)
+            if remaining > 0:
+                raise self._reject(remaining)
+            self._set_state(HALF_OPEN)
+            self._probes = self._probe_successes = 0
+        if self.state == HALF_OPEN:
+            if self._probes >= self.config.half_open_probes:
+                raise self._reject(1)
+            self._probes += 1
+            return True
+        return False
+
+    def release(self, probe: bool, ok: Optional[bool], timed_out: bool = False):
+        """
+        记录请求结果
+
+        Args:
+            probe: acquire 的返回值
+            ok: 是否成功，None 表示请求被取消、结果未知
+            timed_out: 是否因超时失败
+        """
+        if probe:
+            self._probes -= 1
+        if ok is None:
+            return
+
+        self._stats["requests"] += 1
+        if not ok:
+            self._stats["failures"] += 1
+            if timed_out:
+                self._stats["timeouts"] += 1
+
+        if probe and self.state == HALF_OPEN:
+            if not ok:
+                self._trip()
+                return
+            self._probe_successes += 1
+            if self._probe_successes >= self.config.half_open_probes:
+                self._set_state(CLOSED)
+                print(f"上游恢复: {self.endpoint} (账号 {self.account})")
+            return
+
+        if self.state != CLOSED:
+            # 熔断之前发出的请求，只计入统计
+            return
+        if len(self._outcomes) == self._outcomes.maxlen and self._outcomes[0]:
+            self._failures -= 1
+        self._outcomes.append(not ok)
+        if not ok:
+            self._failures += 1
+        if (len(self._outcomes) >= self.config.min_requests
+                and self._failures / len(self._outcomes) >= self.config.failure_rate):
+            self._trip()
+
+    def stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = dict(self._stats)
+        stats["state"] = self.state
+        stats["window_failure_rate"] = round(self._failures / len(self._outcomes), 4) if self._outcomes else 0.0
+        if self.state == OPEN:
+            stats["open_remaining"] = round(max(0.0, self.config.open_seconds - (time.monotonic() - self.opened_at)), 1)
+        return stats
+
+
+class _NullBreaker:
+    """未启用熔断时使用的熔断器"""
+
+    state = CLOSED
+    available = True
+
+    def admits(self) -> Optional[float]:
+        return None
+
+    def acquire(self) -> bool:
+        return False
+
+    def release(self, probe: bool, ok: Optional[bool], timed_out: bool = False):
+        pass
+
+
+_null_breaker = _NullBreaker()
+
+
+class CircuitBreakerRegistry:
+    """按（接口, 账号）管理熔断器"""
+
+    def __init__(self):
+        self.enabled = os.environ.get("CIRCUIT_BREAKER", "True").lower() == "true"
+        # 统计最近多少次调用，至少多少次调用后才可能熔断
+        self.window = int(os.environ.get("CIRCUIT_WINDOW", "20"))
+        self.min_requests = int(os.environ.get("CIRCUIT_MIN_REQUESTS", "10"))
+        # 失败（错误、超时和 5xx）比例达到该值时熔断
+        self.failure_rate = float(os.environ.get("CIRCUIT_FAILURE_RATE", "0.5"))
+        # 熔断持续时间（秒），之后进入半开状态
+        self.open_seconds = float(os.environ.get("CIRCUIT_OPEN_SECONDS", "30"))
+        # 半开状态下放行的试探请求数，全部成功后恢复
+        self.half_open_probes = int(os.environ.get("CIRCUIT_HALF_OPEN_PROBES", "2"))
+
+        self._breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+
+    def get(self, endpoint: str, account: Optional[str] = None):
+        """取得接口在账号上的熔断器"""
+        if not self.enabled:
+            return _null_breaker
+        key = (endpoint, account or DEFAULT_ACCOUNT)
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            breaker = self._breakers[key] = CircuitBreaker(key[0], key[1], self)
+        return breaker
+
+    def check(self, endpoint: str, accounts: Iterable[str]):
+        """
+        在排队和创建会话之前检查是否有账号可以调用该接口
+
+        Args:
+            endpoint: 接口名称
+            accounts: 可能处理本次请求的账号
+
+        Raises:
+            CircuitOpenError: 所有账号的该接口都已熔断（半开状态下试探名额已满也视为熔断）
+        """
+        if not self.enabled:
+            return
+        waits = []
+        for account in accounts:
+            breaker = self.get(endpoint, account)
+            wait = breaker.admits()
+            if wait is None:
+                return
+            waits.append((wait, breaker))
+        if waits:
+            wait, breaker = min(waits, key=lambda item: item[0])
+            raise breaker._reject(wait)
+
+    def account_available(self, account: str) -> bool:
+        """账号的所有接口都没有处于熔断中"""
+        return all(breaker.available for (_, name), breaker in self._breakers.items() if name == account)
+
+    def stats(self) -> Dict[str, Any]:
+        """熔断器统计信息"""
+        breakers: Dict[str, Any] = {}
+        for (endpoint, account), breaker in list(self._breakers.items()):
+            breakers.setdefault(account, {})[endpoint] = breaker.stats()
+        return {
+            "enabled": self.enabled,
+            "failure_rate": self.failure_rate,
+            "open_seconds": self.open_seconds,
+            "breakers": breakers
+        }
+
+
+# 全局熔断器实例
+circuit_breakers = CircuitBreakerRegistry()
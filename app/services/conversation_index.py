@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+对话续接索引
+标准 OpenAI 客户端不会传 session_id，而是每次发送完整的历史消息。
+每轮对话结束后记录"历史消息 + 本轮回复"的指纹到会话的映射，
+下一次请求的历史（最后一条用户消息之前的全部消息）与之相同时继续使用同一个会话
+"""
+
+import os
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.services import json_codec
+
+
+def _content_text(content: Any) -> str:
+    """取出消息内容中的文本，兼容字符串和多段内容（[{"type": "text", "text": ...}]）"""
+    if content is None:
+        return ""
+    if isinstance(content, str):
+        return content.strip()
+    if isinstance(content, list):
+        return "".join(
+            part.get("text", "") for part in content if isinstance(part, dict) and part.get("type") == "text"
+        ).strip()
+    return str(content).strip()
+
+
+def fingerprint(messages: List[Dict[str, Any]]) -> str:
+    """
+    计算消息列表的指纹
+
+    只使用角色和文本内容，忽略客户端附加的 name 等字段和首尾空白
+
+    Args:
+        messages: OpenAI 格式的消息列表
+
+    Returns:
+        十六进制指纹
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for message in messages:
+        digest.update(json_codec.dumps_bytes([message.get("role"), _content_text(message.get("content"))]))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def history_prefix(messages: List[Dict[str, Any]]) -> Optional[List[Dict[str, Any]]]:
+    """
+    取出最后一条用户消息之前的历史消息
+
+    Returns:
+        历史消息，没有用户消息或历史中没有助手回复（新对话）时返回 None
+    """
+    for index in range(len(messages) - 1, -1, -1):
+        if messages[index].get("role") == "user":
+            prefix = messages[:index]
+            if any(message.get("role") == "assistant" for message in prefix):
+                return prefix
+            return None
+    return None
+
+
+class ConversationIndex:
+    """
+    指纹 -> 会话 ID 的有界索引
+
+    按写入顺序保存在 OrderedDict 中，超出容量时淘汰最早的记录，过期记录在查找和写入时清理。
+    查找不会移除记录，本轮失败（排队超时、熔断、客户端断开、上游出错）时客户端重试仍能续接到同一个会话；
+    本轮成功后记录新历史时才移除旧历史的记录：会话已经进入下一轮，从旧历史分叉出的请求不能再续接到该会话
+    """
+
+    def __init__(self):
+        # 最多保存的记录数，0 表示禁用续接
+        self.max_size = int(os.environ.get("CONVERSATION_INDEX_SIZE", "10000"))
+        # 记录的有效时间（秒）
+        self.ttl = float(os.environ.get("CONVERSATION_INDEX_TTL", "3600"))
+        # 指纹 -> (会话 ID, 写入时间)
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0, "expired": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def lookup(self, messages: List[Dict[str, Any]]) -> Optional[str]:
+        """
+        按历史消息查找会话
+
+        Args:
+            messages: 本次请求的完整消息列表
+
+        Returns:
+            产生这段历史的会话 ID，没有找到时返回 None
+        """
+        if not self.enabled:
+            return None
+        prefix = history_prefix(messages)
+        if prefix is None:
+            return None
+
+        self._evict_expired()
+        entry = self._entries.get(fingerprint(prefix))
+        if entry is None:
+            self._stats["misses"] += 1
+            return None
+        self._stats["hits"] += 1
+        return entry[0]
+
+    def remember(self, messages: List[Dict[str, Any]], reply: str, session_id: str):
+        """
+        记录一轮成功的对话结束后的历史，并移除本轮续接的旧历史记录
+
+        Args:
+            messages: 本次请求的完整消息列表
+            reply: 本轮的完整回复
+            session_id: 会话 ID
+        """
+        if not self.enabled or not messages or not reply:
+            return
+        prefix = history_prefix(messages)
+        if prefix is not None:
+            previous = fingerprint(prefix)
+            entry = self._entries.get(previous)
+            if entry is not None and entry[0] == session_id:
+                del self._entries[previous]
+        key = fingerprint(list(messages) + [{"role": "assistant", "content": reply}])
+        self._entries[key] = (session_id, time.monotonic())
+        self._entries.move_to_end(key)
+        self._stats["stored"] += 1
+
+        self._evict_expired()
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self._stats["evicted"] += 1
+
+    def _evict_expired(self):
+        """从最早的记录开始清理过期记录"""
+        deadline = time.monotonic() - self.ttl
+        while self._entries:
+            _, stored_at = next(iter(self._entries.values()))
+            if stored_at > deadline:
+                break
+            self._entries.popitem(last=False)
+            self._stats["expired"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """续接索引统计信息"""
+        stats: Dict[str, Any] = dict(self._stats)
+        stats["size"] = len(self._entries)
+        stats["max_size"] = self.max_size
+        return stats
+
+
+# 全局对话续接索引实例
+conversation_index = ConversationIndex()
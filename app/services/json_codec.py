@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+JSON 编解码
+按 orjson、ujson、标准库的顺序选择已安装的最快后端，上游解析、请求解析和响应编码共用
+"""
+
+import os
+import json
+from typing import Any, Callable, Optional, Union
+
+from flask.json.provider import DefaultJSONProvider
+
+# 按速度从快到慢排列
+BACKENDS = ("orjson", "ujson", "json")
+
+
+class JSONCodec:
+    """
+    一种 JSON 后端的编解码函数
+
+    所有后端的输出都不转义非 ASCII 字符、不带多余空格；格式错误时抛出 ValueError
+    """
+
+    # 解码字符串或 UTF-8 字节，每种后端在初始化时设置
+    loads: Callable[[Union[str, bytes, bytearray]], Any]
+
+    def __init__(self, name: str):
+        self.name = name
+        if name == "orjson":
+            import orjson
+
+            def dumps_bytes(obj: Any, default: Optional[Callable] = None) -> bytes:
+                return orjson.dumps(obj, default=default)
+
+            self.dumps_bytes = dumps_bytes
+            self.loads = orjson.loads
+        elif name == "ujson":
+            import ujson
+
+            def dumps(obj: Any, default: Optional[Callable] = None) -> str:
+                return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False, default=default)
+
+            self.dumps = dumps
+            self.loads = ujson.loads
+        elif name == "json":
+            decoder = json.JSONDecoder()
+            encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+            def dumps(obj: Any, default: Optional[Callable] = None) -> str:
+                if default is None:
+                    return encoder.encode(obj)
+                return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=default)
+
+            def loads(data: Union[str, bytes, bytearray]) -> Any:
+                if not isinstance(data, str):
+                    data = data.decode("utf-8")
+                return decoder.decode(data)
+
+            self.dumps = dumps
+            self.loads = loads
+        else:
+            raise ValueError(f"不支持的 JSON 后端: {name}")
+
+    def dumps(self, obj: Any, default: Optional[Callable] = None) -> str:
+        """编码为字符串"""
+        return self.dumps_bytes(obj, default).decode("utf-8")
+
+    def dumps_bytes(self, obj: Any, default: Optional[Callable] = None) -> bytes:
+        """编码为 UTF-8 字节，用作响应体"""
+        return self.dumps(obj, default).encode("utf-8")
+
+
+def load_codec(backend: Optional[str] = None) -> JSONCodec:
+    """
+    加载 JSON 后端
+
+    Args:
+        backend: orjson、ujson、json 或 auto，默认读取环境变量 JSON_BACKEND；
+            auto 时选择已安装的最快后端
+
+    Returns:
+        编解码器
+    """
+    backend = (backend or os.environ.get("JSON_BACKEND", "auto")).lower()
+    if backend != "auto":
+        return JSONCodec(backend)
+    for name in BACKENDS:
+        try:
+            return JSONCodec(name)
+        except ImportError:
+            continue
+    return JSONCodec("json")
+
+
+# 全局编解码器
+codec = load_codec()
+backend = codec.name
+dumps = codec.dumps
+dumps_bytes = codec.dumps_bytes
+loads = codec.loads
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON 提供者
+
+    jsonify 和 request.get_json 使用全局编解码器，键按插入顺序输出；
+    调试模式下的缩进输出等需要额外参数的情况仍由 Flask 默认实现处理
+    """
+
+    ensure_ascii = False
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return codec.dumps(obj, self.default)
+
+    def loads(self, s: Union[str, bytes], **kwargs: Any) -> Any:
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return codec.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any):
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(codec.dumps_bytes(obj, self.default) + b"\n", mimetype=self.mimetype)
@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+"""
+Prometheus 指标
+进程内的计数器、仪表和直方图，按 Prometheus 文本格式（0.0.4）在 /metrics 输出。
+
+设置 METRICS_DIR 后支持多进程：每个工作进程定期把自己的指标快照写到该目录，
+任意一个工作进程被抓取时合并所有进程的快照。已退出进程的计数器和直方图继续累加，
+仪表（进行中的数量）只统计仍在运行的进程
+"""
+
+import os
+import time
+import atexit
+import threading
+from bisect import bisect_left
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from app.services import json_codec
+
+# 指标输出的 Content-Type
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 上游调用耗时的默认分桶（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 整个流式回复耗时的分桶（秒）
+DURATION_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class _Value:
+    """计数器或仪表的一组标签值对应的样本"""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def sample(self) -> float:
+        return self.value
+
+
+class _HistogramValue:
+    """直方图的一组标签值对应的样本，各分桶分别计数，输出时再累加"""
+
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # 最后一个分桶为 +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def sample(self) -> List[float]:
+        return self.counts + [self.sum]
+
+
+class _Metric:
+    """指标基类，按标签值保存样本"""
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: Optional["MetricsRegistry"] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        (registry or metrics_registry).register(self)
+        # 没有标签的指标直接在自身上记录
+        self._default = None if self.labelnames else self.labels()
+
+    def _new_child(self):
+        return _Value()
+
+    def labels(self, *values: Any, **labels: Any):
+        """
+        取得一组标签值对应的样本
+
+        热路径上应在模块级保存返回的样本对象，避免每次查找
+
+        Returns:
+            可直接调用 inc / observe 等方法的样本对象
+        """
+        if labels:
+            values = tuple(labels[name] for name in self.labelnames)
+        key = tuple(str(value) for value in values)
+        if len(key) != len(self.labelnames):
+            raise ValueError(f"{self.name} 需要标签 {self.labelnames}")
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    def samples(self) -> List[Tuple[Tuple[str, ...], Any]]:
+        return [(key, child.sample()) for key, child in list(self._children.items())]
+
+    def merge(self, total: Any, sample: Any) -> Any:
+        """合并两个进程的同一样本"""
+        return total + sample
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1):
+        self._default.inc(amount)
+
+
+class Gauge(_Metric):
+    """
+    可增可减的仪表
+
+    多进程部署时按 multiprocess_mode 合并各进程的值：sum 求和，max / min 取最大 / 最小值，
+    all 不合并，为每个进程的值加上 pid 标签
+    """
+
+    kind = "gauge"
+    MULTIPROCESS_MODES = ("sum", "max", "min", "all")
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: Optional["MetricsRegistry"] = None, multiprocess_mode: str = "sum"):
+        if multiprocess_mode not in self.MULTIPROCESS_MODES:
+            raise ValueError(f"{name} 的 multiprocess_mode 必须为 {self.MULTIPROCESS_MODES} 之一")
+        self.multiprocess_mode = multiprocess_mode
+        super().__init__(name, documentation, labelnames, registry)
+
+    def merge(self, total: float, sample: float) -> float:
+        if self.multiprocess_mode == "max":
+            return max(total, sample)
+        if self.multiprocess_mode == "min":
+            return min(total, sample)
+        return total + sample
+
+    def inc(self, amount: float = 1):
+        self._default.inc(amount)
+
+    def dec(self, amount: float = 1):
+        self._default.dec(amount)
+
+    def set(self, value: float):
+        self._default.set(value)
+
+
+class Histogram(_Metric):
+    """分桶统计的直方图"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS, registry: Optional["MetricsRegistry"] = None):
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def merge(self, total: List[float], sample: List[float]) -> List[float]:
+        if len(total) != len(sample):
+            # 分桶配置不同（如不同版本的进程），无法合并
+            return total
+        return [a + b for a, b in zip(total, sample)]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+class MetricsRegistry:
+    """
+    指标注册表
+
+    单进程时直接输出本进程的指标；设置 METRICS_DIR 后由后台线程定期写出快照，
+    输出时合并目录下所有进程的快照
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        # 多进程快照目录，为空表示单进程模式
+        self.directory = os.environ.get("METRICS_DIR") or None
+        # 写出快照的间隔（秒）
+        self.flush_interval = float(os.environ.get("METRICS_FLUSH_INTERVAL", "5"))
+        self._writer: Optional[threading.Thread] = None
+        self._write_lock = threading.Lock()
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._start_writer()
+            atexit.register(self.write_snapshot)
+            if hasattr(os, "register_at_fork"):
+                # 以 fork 方式创建的工作进程不会继承父进程的线程
+                os.register_at_fork(after_in_child=self._after_fork)
+
+    def register(self, metric: _Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"指标 {metric.name} 已注册")
+        self._metrics[metric.name] = metric
+
+    def _after_fork(self):
+        # 子进程从零开始计数，父进程的样本已在父进程的快照中
+        for metric in self._metrics.values():
+            for child in metric._children.values():
+                if isinstance(child, _HistogramValue):
+                    child.counts = [0] * len(child.counts)
+                    child.sum = 0.0
+                else:
+                    child.value = 0.0
+        self._writer = None
+        self._write_lock = threading.Lock()
+        self._start_writer()
+
+    def _start_writer(self):
+        if self._writer is not None or self.flush_interval <= 0:
+            return
+        self._writer = threading.Thread(target=self._write_loop, name="metrics-writer", daemon=True)
+        self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.write_snapshot()
+            except Exception as e:
+                print(f"写出指标快照失败: {e}")
+
+    def snapshot(self) -> Dict[str, List[Tuple[Tuple[str, ...], Any]]]:
+        """本进程所有指标的样本"""
+        return {name: metric.samples() for name, metric in self._metrics.items()}
+
+    def _snapshot_path(self, pid: int) -> str:
+        return os.path.join(self.directory, f"metrics_{pid}.json")
+
+    def write_snapshot(self):
+        """把本进程的指标快照写到多进程目录（先写临时文件再替换，读取方不会读到半个文件）"""
+        if not self.directory:
+            return
+        pid = os.getpid()
+        path = self._snapshot_path(pid)
+        data = json_codec.dumps_bytes({"pid": pid, "metrics": self.snapshot()})
+        with self._write_lock:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+    def clear_directory(self):
+        """清空多进程目录中旧的快照，应在启动工作进程之前调用"""
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.startswith("metrics_") and name.endswith((".json", ".tmp")):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def _other_snapshots(self) -> Iterable[Tuple[int, bool, Dict[str, Any]]]:
+        """读取其他进程的快照，返回 (进程 ID, 进程是否存活, 指标样本)"""
+        own = os.getpid()
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if not (name.startswith("metrics_") and name.endswith(".json")):
+                continue
+            try:
+                pid = int(name[len("metrics_"):-len(".json")])
+            except ValueError:
+                continue
+            if pid == own:
+                continue
+            try:
+                with open(os.path.join(self.directory, name), "rb") as f:
+                    data = json_codec.loads(f.read())
+            except (OSError, ValueError):
+                continue
+            yield pid, _pid_alive(pid), data.get("metrics") or {}
+
+    def collect(self) -> Dict[str, Dict[Tuple[str, ...], Any]]:
+        """
+        合并后的样本
+
+        Returns:
+            指标名 -> {标签值: 样本}
+        """
+        merged: Dict[str, Dict[Tuple[str, ...], Any]] = {
+            name: dict(samples) for name, samples in self.snapshot().items()
+        }
+        if not self.directory:
+            return merged
+
+        own = str(os.getpid())
+        for name, samples in merged.items():
+            if self._per_process(self._metrics[name]):
+                merged[name] = {key + (own,): sample for key, sample in samples.items()}
+
+        for pid, alive, metrics in self._other_snapshots():
+            for name, samples in metrics.items():
+                metric = self._metrics.get(name)
+                if metric is None or (metric.kind == "gauge" and not alive):
+                    continue
+                per_process = self._per_process(metric)
+                target = merged[name]
+                for labels, sample in samples:
+                    key = tuple(labels) + ((str(pid),) if per_process else ())
+                    target[key] = metric.merge(target[key], sample) if key in target else sample
+        return merged
+
+    def _per_process(self, metric: _Metric) -> bool:
+        """多进程部署时该指标是否按进程分别输出（带 pid 标签）"""
+        return bool(self.directory) and getattr(metric, "multiprocess_mode", None) == "all"
+
+    def render(self) -> str:
+        """按 Prometheus 文本格式输出所有指标"""
+        lines: List[str] = []
+        for name, samples in self.collect().items():
+            metric = self._metrics[name]
+            labelnames = metric.labelnames + (("pid",) if self._per_process(metric) else ())
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for key in sorted(samples):
+                sample = samples[key]
+                if metric.kind != "histogram":
+                    lines.append(f"{name}{_format_labels(labelnames, key)} {_format_value(sample)}")
+                    continue
+                cumulative = 0
+                bounds = [repr(bound) for bound in metric.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, sample[:-1]):
+                    cumulative += count
+                    labels = _format_labels(metric.labelnames + ("le",), key + (bound,))
+                    lines.append(f"{name}_bucket{labels} {_format_value(cumulative)}")
+                labels = _format_labels(metric.labelnames, key)
+                lines.append(f"{name}_sum{labels} {_format_value(sample[-1])}")
+                lines.append(f"{name}_count{labels} {_format_value(cumulative)}")
+        return "\n".join(lines) + "\n"
+
+
+# 全局指标注册表实例
+metrics_registry = MetricsRegistry()
+
+# 上游调用
+upstream_latency = Histogram(
+    "anuneko_upstream_request_duration_seconds",
+    "上游调用耗时（流式调用为收到响应头的耗时）",
+    ["call"]
+)
+upstream_errors = Counter(
+    "anuneko_upstream_errors_total",
+    "上游调用错误数，code 为 HTTP 状态码、异常类型或上游返回的错误码",
+    ["call", "code"]
+)
+
+# 流式回复
+time_to_first_token = Histogram(
+    "anuneko_time_to_first_token_seconds",
+    "从发送消息到收到第一个回复片段的耗时"
+)
+stream_duration = Histogram(
+    "anuneko_stream_duration_seconds",
+    "从发送消息到上游流结束的耗时",
+    buckets=DURATION_BUCKETS
+)
+streams_in_flight = Gauge(
+    "anuneko_streams_in_flight",
+    "正在进行的上游流式回复数",
+    multiprocess_mode="all"
+)
+streams_cancelled = Counter(
+    "anuneko_streams_cancelled_total",
+    "客户端断开等原因被提前关闭的上游流式回复数"
+)
+tokens_relayed = Counter(
+    "anuneko_tokens_relayed_total",
+    "转发的回复片段数"
+)
+bytes_relayed = Counter(
+    "anuneko_bytes_relayed_total",
+    "从上游流式接口读取的字节数"
+)
+
+# 准入控制
+admission_queued = Gauge(
+    "anuneko_admission_queue_length",
+    "等待上游并发名额的请求数，lane 为 interactive（流式）或 bulk（非流式）",
+    ["lane"],
+    multiprocess_mode="all"
+)
+admission_rejections = Counter(
+    "anuneko_admission_rejections_total",
+    "因上游并发已满被拒绝的请求数，reason 为 full（队列已满）、timeout（等待超时）或 preempted（被挤出队列）",
+    ["reason"]
+)
+
+# 控制接口的对冲与重试
+control_hedges = Counter(
+    "anuneko_control_hedges_total",
+    "超过近期 p95 耗时后发送的对冲请求数",
+    ["call"]
+)
+control_hedge_wins = Counter(
+    "anuneko_control_hedge_wins_total",
+    "对冲请求先于原请求成功返回的次数",
+    ["call"]
+)
+control_retries = Counter(
+    "anuneko_control_retries_total",
+    "控制接口失败后的重试次数",
+    ["call"]
+)
+
+# 上游熔断
+circuit_state = Gauge(
+    "anuneko_circuit_state",
+    "熔断器状态：0 正常，1 半开（试探中），2 熔断，多进程时取各进程中最严重的状态",
+    ["endpoint", "account"],
+    multiprocess_mode="max"
+)
+circuit_opened = Counter(
+    "anuneko_circuit_opened_total",
+    "熔断次数",
+    ["endpoint", "account"]
+)
+circuit_rejections = Counter(
+    "anuneko_circuit_rejections_total",
+    "熔断期间被直接拒绝的上游调用数",
+    ["endpoint"]
+)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+模型注册表
+缓存 AnuNeko 模型列表与 OpenAI 模型名映射，支持 TTL、过期后台刷新和单飞请求
+"""
+
+import os
+import time
+import asyncio
+import contextvars
+from typing import Any, Dict, List, Optional
+
+from app.services.anuneko_service import AnuNekoAPI
+from app.services.account_pool import account_pool
+from app.services.async_runtime import runtime
+
+
+# 无法获取上游模型时使用的默认映射
+DEFAULT_MODEL = "mihoyo-orange_cat"
+DEFAULT_MAPPING = {DEFAULT_MODEL: "Orange Cat"}
+
+
+def to_openai_model(anuneko_model: str) -> str:
+    """将 AnuNeko 模型名转换为 OpenAI 兼容的模型 ID"""
+    return f"mihoyo-{anuneko_model.lower().replace(' ', '_')}"
+
+
+class ModelSnapshot:
+    """某一时刻的模型列表快照，映射内容创建后不再修改"""
+
+    __slots__ = ("mapping", "models", "raw", "source", "fetched_at", "expires_at", "error")
+
+    def __init__(self, mapping: Dict[str, str], models: List[str], raw: Any, source: str,
+                 expires_at: float, error: Optional[str] = None):
+        self.mapping = mapping
+        self.models = models
+        self.raw = raw
+        # upstream: 上游真实数据；default: 从未成功获取过，使用默认映射
+        self.source = source
+        self.fetched_at = int(time.time())
+        self.expires_at = expires_at
+        self.error = error
+
+    @property
+    def fresh(self) -> bool:
+        return time.monotonic() < self.expires_at
+
+
+class ModelRegistry:
+    """模型注册表"""
+
+    def __init__(self):
+        # 模型列表缓存时间（秒）
+        self.ttl = float(os.environ.get("MODEL_CACHE_TTL", "300"))
+        # 上游获取失败后的重试间隔（秒）
+        self.retry_interval = float(os.environ.get("MODEL_CACHE_RETRY", "30"))
+        self._snapshot: Optional[ModelSnapshot] = None
+        self._inflight: Optional[asyncio.Task] = None
+        self._stats = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "refreshes": 0,
+            "refresh_failures": 0
+        }
+
+    def get_anuneko_api(self) -> AnuNekoAPI:
+        """获取 AnuNeko API 实例（使用当前负载最低的健康账号）"""
+        return account_pool.pick().api
+
+    @property
+    def mapping(self) -> Dict[str, str]:
+        """当前的模型映射表（OpenAI 模型名 -> AnuNeko 模型名）"""
+        snapshot = self._snapshot
+        return snapshot.mapping if snapshot is not None else {}
+
+    def peek(self) -> Optional[ModelSnapshot]:
+        """
+        不等待上游，直接返回内存中的快照
+
+        快照过期时在后台触发刷新，没有任何快照时返回 None
+
+        Returns:
+            当前快照或 None
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            return None
+        if snapshot.fresh:
+            self._stats["hits"] += 1
+        else:
+            self._stats["stale_hits"] += 1
+            if self._inflight is None or self._inflight.done():
+                runtime.spawn(self.refresh())
+        return snapshot
+
+    async def get(self) -> ModelSnapshot:
+        """
+        获取模型列表快照
+
+        快照新鲜时直接返回；过期时返回旧快照并在后台刷新；
+        没有任何快照时等待上游获取完成
+
+        Returns:
+            模型列表快照
+        """
+        snapshot = self.peek()
+        if snapshot is not None:
+            return snapshot
+        self._stats["misses"] += 1
+        return await self.refresh()
+
+    async def refresh(self) -> ModelSnapshot:
+        """
+        从上游刷新模型列表，同一时刻只会有一个上游请求
+
+        Returns:
+            刷新后的快照
+        """
+        if self._inflight is None or self._inflight.done():
+            # 刷新由所有等待的请求共享，不使用发起它的请求的重试预算
+            self._inflight = contextvars.Context().run(asyncio.ensure_future, self._fetch())
+        return await asyncio.shield(self._inflight)
+
+    async def _fetch(self) -> ModelSnapshot:
+        """请求上游并生成新快照，失败时保留上一次成功的映射"""
+        self._stats["refreshes"] += 1
+        error = None
+        try:
+            anuneko_models = await self.get_anuneko_api().model_view()
+        except Exception as e:
+            anuneko_models = None
+            error = str(e)
+
+        now = time.monotonic()
+        if anuneko_models and "models" in anuneko_models:
+            mapping = {}
+            for anuneko_model in anuneko_models["models"]:
+                mapping[to_openai_model(anuneko_model)] = anuneko_model
+            self._snapshot = ModelSnapshot(
+                mapping, list(anuneko_models["models"]), anuneko_models, "upstream", now + self.ttl
+            )
+            print(f"已更新模型映射表，共{len(mapping)}个模型")
+            return self._snapshot
+
+        self._stats["refresh_failures"] += 1
+        previous = self._snapshot
+        if previous is not None and previous.source == "upstream":
+            # 保留最近一次成功的映射，稍后重试
+            previous.expires_at = now + self.retry_interval
+            print("无法获取AnuNeko模型，继续使用上一次的模型映射")
+            return previous
+
+        print("无法获取AnuNeko模型，使用默认映射")
+        self._snapshot = ModelSnapshot(
+            dict(DEFAULT_MAPPING), list(DEFAULT_MAPPING.values()), anuneko_models, "default",
+            now + self.retry_interval, error
+        )
+        return self._snapshot
+
+    def stats(self) -> Dict[str, Any]:
+        """注册表统计信息"""
+        snapshot = self._snapshot
+        stats = dict(self._stats)
+        stats["models"] = len(snapshot.mapping) if snapshot else 0
+        stats["source"] = snapshot.source if snapshot else None
+        stats["fresh"] = snapshot.fresh if snapshot else False
+        stats["fetched_at"] = snapshot.fetched_at if snapshot else None
+        return stats
+
+
+# 全局模型注册表实例
+model_registry = ModelRegistry()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+单请求性能分析
+请求带有 X-Profile 头时，只在该请求自己的协程（和流式生成器）每次被调度执行时开启 cProfile，
+同一事件循环上其他请求的代码不会计入。结果保存为 pstats 文件，通过 /profiles/<id> 下载；默认关闭
+"""
+
+import os
+import re
+import uuid
+import cProfile
+from typing import Any, AsyncGenerator, Awaitable, Dict, Optional
+
+_PROFILE_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+class _Profiled:
+    """逐步驱动被包装的协程，每一步执行期间开启分析器"""
+
+    def __init__(self, awaitable: Any, profiler: cProfile.Profile):
+        self._awaitable = awaitable
+        self._profiler = profiler
+
+    def __await__(self):
+        coro, profiler = self._awaitable, self._profiler
+        value, error = None, None
+        while True:
+            profiler.enable()
+            try:
+                yielded = coro.send(value) if error is None else coro.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                profiler.disable()
+            try:
+                value, error = (yield yielded), None
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as e:
+                # 取消等异常交给被包装的协程处理
+                value, error = None, e
+
+
+class ProfileSession:
+    """一次请求的性能分析"""
+
+    def __init__(self, profile_id: str, path: str, on_saved=None):
+        self.id = profile_id
+        self.path = path
+        self.profiler = cProfile.Profile()
+        self._on_saved = on_saved
+
+    def run(self, coro: Awaitable) -> Awaitable:
+        """在分析器下执行协程"""
+        return _Profiled(coro.__await__(), self.profiler)
+
+    async def wrap_stream(self, agen: AsyncGenerator[str, None]) -> AsyncGenerator[str, None]:
+        """在分析器下迭代流式生成器，流结束（或客户端断开）后保存结果"""
+        try:
+            while True:
+                try:
+                    item = await self.run(agen.__anext__())
+                except StopAsyncIteration:
+                    break
+                yield item
+        finally:
+            await agen.aclose()
+            self.save()
+
+    def save(self):
+        """保存 pstats 文件"""
+        try:
+            self.profiler.dump_stats(self.path)
+        except OSError as e:
+            print(f"保存性能分析结果失败: {e}")
+            return
+        if self._on_saved is not None:
+            self._on_saved()
+
+
+class RequestProfiler:
+    """按请求头开启的性能分析"""
+
+    def __init__(self):
+        self.enabled = os.environ.get("PROFILING", "False").lower() == "true"
+        # 设置后 X-Profile 头的值必须与之相同才会开启分析
+        self.token = os.environ.get("PROFILE_TOKEN") or None
+        # 结果保存目录
+        self.directory = os.environ.get("PROFILE_DIR", "profiles")
+        # 最多保留的结果数，超出时删除最早的结果
+        self.max_files = int(os.environ.get("PROFILE_MAX_FILES", "50"))
+        self._stats = {"profiled": 0, "saved": 0, "rejected": 0}
+
+    def start(self, header: Optional[str]) -> Optional[ProfileSession]:
+        """
+        按 X-Profile 头开启一次分析
+
+        Args:
+            header: X-Profile 头的值
+
+        Returns:
+            分析会话，未开启时返回 None
+        """
+        if not header or not self.enabled:
+            return None
+        if self.token is not None and header.strip() != self.token:
+            self._stats["rejected"] += 1
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        profile_id = uuid.uuid4().hex
+        self._stats["profiled"] += 1
+        return ProfileSession(profile_id, os.path.join(self.directory, f"{profile_id}.prof"), self._saved)
+
+    def _saved(self):
+        self._stats["saved"] += 1
+        self._prune()
+
+    def _prune(self):
+        """删除超出数量的最早的结果"""
+        try:
+            entries = [
+                os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".prof")
+            ]
+        except OSError:
+            return
+        if len(entries) <= self.max_files:
+            return
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:len(entries) - self.max_files]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def path(self, profile_id: str) -> Optional[str]:
+        """
+        取得分析结果的文件路径
+
+        Returns:
+            文件路径，ID 不合法、未开启或文件不存在时返回 None
+        """
+        if not self.enabled or not _PROFILE_ID.match(profile_id):
+            return None
+        path = os.path.abspath(os.path.join(self.directory, f"{profile_id}.prof"))
+        return path if os.path.isfile(path) else None
+
+    def stats(self) -> Dict[str, Any]:
+        """性能分析统计信息"""
+        stats: Dict[str, Any] = dict(self._stats)
+        stats["enabled"] = self.enabled
+        return stats
+
+
+# 全局性能分析实例
+request_profiler = RequestProfiler()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+请求耗时分解
+记录一次聊天请求各阶段（会话、排队、上游调用、首个片段等）的耗时，
+以 Server-Timing 响应头返回；流式响应在结束时额外输出一条 SSE 注释
+"""
+
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+class RequestTiming:
+    """一次请求的阶段耗时"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        # (阶段名, 耗时（秒），None 表示只标记不计时, 描述)
+        self.phases: List[Tuple[str, Optional[float], Optional[str]]] = []
+        # 本次请求的性能分析 ID
+        self.profile_id: Optional[str] = None
+
+    def add(self, name: str, seconds: Optional[float] = None, desc: Optional[str] = None):
+        """
+        记录一个阶段
+
+        Args:
+            name: 阶段名，同名阶段可以出现多次（如重试）
+            seconds: 耗时（秒），为 None 时只标记发生过
+            desc: 描述
+        """
+        self.phases.append((name, seconds, desc))
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """记录代码块的耗时"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def since(self, name: str, started: float):
+        """记录从 started（time.perf_counter()）到现在的耗时"""
+        self.add(name, time.perf_counter() - started)
+
+    def header(self) -> str:
+        """Server-Timing 头的值，最后一项 total 为请求开始到现在的耗时"""
+        entries = []
+        for name, seconds, desc in self.phases:
+            entry = name
+            if seconds is not None:
+                entry += f";dur={seconds * 1000:.1f}"
+            if desc:
+                entry += f';desc="{desc}"'
+            entries.append(entry)
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(entries)
+
+    def headers(self) -> Dict[str, str]:
+        """附加到响应上的头"""
+        headers = {"Server-Timing": self.header()}
+        if self.profile_id:
+            headers["X-Profile-Id"] = self.profile_id
+        return headers
+
+    def sse_comment(self) -> str:
+        """流式响应结束时输出的 SSE 注释，客户端会忽略注释行"""
+        return f": server-timing {self.header()}\n\n"
+
+
+class _NullTiming(RequestTiming):
+    """不记录任何阶段，未传入 RequestTiming 时使用"""
+
+    def add(self, name: str, seconds: Optional[float] = None, desc: Optional[str] = None):
+        pass
+
+
+# 不记录耗时的共享实例
+null_timing = _NullTiming()
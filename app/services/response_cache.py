@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+响应缓存
+对完全相同的请求（模型 + 消息列表）直接返回缓存的回复，不再请求上游；默认关闭
+"""
+
+import os
+import sys
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.services.anuneko_service import AnuNekoAPI
+from app.services.conversation_index import fingerprint
+
+# 每条缓存除回复文本外的固定内存开销（OrderedDict 节点、元组、键）的估算值
+_ENTRY_OVERHEAD = 200
+
+
+class ResponseCache:
+    """
+    完全匹配的响应缓存
+
+    按最近使用顺序保存在 OrderedDict 中，总内存超过预算时淘汰最久未使用的回复；
+    过期的回复在被查找到时移除
+    """
+
+    def __init__(self):
+        self.enabled = os.environ.get("RESPONSE_CACHE", "False").lower() == "true"
+        # 回复的有效时间（秒）
+        self.ttl = float(os.environ.get("RESPONSE_CACHE_TTL", "300"))
+        # 缓存占用内存的上限（字节）
+        self.max_bytes = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+        # 键 -> (回复, 写入时间, 占用字节数)
+        self._entries: "OrderedDict[str, Tuple[str, float, int]]" = OrderedDict()
+        self._bytes = 0
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "bypassed": 0,
+            "refreshed": 0,
+            "stored": 0,
+            "evicted": 0,
+            "expired": 0
+        }
+
+    @staticmethod
+    def key(model: str, messages: List[Dict[str, Any]]) -> str:
+        """由规范化的模型名和消息列表生成缓存键"""
+        model_key = (model or "").strip().lower().encode("utf-8")
+        return hashlib.blake2b(model_key + b"\n" + fingerprint(messages).encode("ascii"), digest_size=16).hexdigest()
+
+    def lookup(self, request_data: Dict[str, Any], cache_control: Optional[str] = None
+               ) -> Tuple[Optional[str], Optional[str]]:
+        """
+        按请求查找缓存
+
+        Cache-Control 包含 no-store 时既不读取也不写入缓存；包含 no-cache 时不读取缓存，
+        重新生成后覆盖旧的回复。指定了 session_id 的请求需要上游会话推进，不使用缓存
+
+        Args:
+            request_data: 请求数据
+            cache_control: 请求的 Cache-Control 头
+
+        Returns:
+            (缓存键, 缓存的回复)。缓存键为 None 表示本次回复不写入缓存，回复为 None 表示未命中
+        """
+        if not self.enabled or request_data.get("session_id"):
+            return None, None
+
+        directives = {d.strip().lower() for d in (cache_control or "").split(",")}
+        if "no-store" in directives:
+            self._stats["bypassed"] += 1
+            return None, None
+
+        key = self.key(request_data.get("model", ""), request_data.get("messages") or [])
+        if "no-cache" in directives:
+            self._stats["refreshed"] += 1
+            return key, None
+
+        return key, self.get(key)
+
+    def get(self, key: str) -> Optional[str]:
+        """读取缓存的回复"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self._stats["misses"] += 1
+            return None
+        if time.monotonic() - entry[1] >= self.ttl:
+            self._remove(key)
+            self._stats["expired"] += 1
+            self._stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self._stats["hits"] += 1
+        return entry[0]
+
+    def put(self, key: Optional[str], reply: str):
+        """
+        写入回复，上游失败时的提示不会被缓存
+
+        Args:
+            key: 缓存键，为 None 时忽略
+            reply: 完整回复
+        """
+        if key is None or AnuNekoAPI.failed_reply(reply):
+            return
+        size = sys.getsizeof(reply) + _ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+
+        self._remove(key)
+        self._entries[key] = (reply, time.monotonic(), size)
+        self._bytes += size
+        self._stats["stored"] += 1
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self._stats["evicted"] += 1
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def stats(self) -> Dict[str, Any]:
+        """响应缓存统计信息"""
+        stats: Dict[str, Any] = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["enabled"] = self.enabled
+        stats["entries"] = len(self._entries)
+        stats["bytes"] = self._bytes
+        stats["max_bytes"] = self.max_bytes
+        return stats
+
+
+# 全局响应缓存实例
+response_cache = ResponseCache()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+上游控制接口的重试与对冲请求
+幂等的 switch_model、model_view 和 send_choice 一次尝试超过该接口近期的 p95 耗时仍未返回时，
+并发发送第二次尝试（对冲），先成功返回的结果生效；create_session 每次都会在上游创建新会话，不对冲。
+尝试失败时按带抖动的指数退避重试。每个客户端请求的额外尝试次数受重试预算限制，避免上游变慢时请求量成倍放大
+"""
+
+import os
+import time
+import random
+import asyncio
+import contextvars
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+import httpx
+
+from app.services import metrics
+from app.services.circuit_breaker import CircuitOpenError
+
+# 可以对冲的幂等接口，重复发送不会在上游产生多余的数据
+IDEMPOTENT_CALLS = frozenset({"switch_model", "model_view", "send_choice"})
+
+
+class LatencyTracker:
+    """一个接口近期成功尝试的耗时，用于估算对冲延迟"""
+
+    def __init__(self, window: int):
+        self._samples: Deque[float] = deque(maxlen=window)
+        # 排序后的样本，新增样本后懒惰地重新排序
+        self._sorted: Optional[List[float]] = None
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+        self._sorted = None
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        if self._sorted is None:
+            self._sorted = sorted(self._samples)
+        return self._sorted[min(len(self._sorted) - 1, int(len(self._sorted) * q / 100))]
+
+
+class RetryBudget:
+    """一个客户端请求可以使用的额外尝试（重试和对冲）次数"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+
+    def take(self) -> bool:
+        if self.used >= self.limit:
+            return False
+        self.used += 1
+        return True
+
+
+# 当前客户端请求的重试预算。异步生成器在迭代它的任务的上下文中执行，流式回复期间和后台任务中的调用
+# 需要在请求的上下文中用 current_budget() 取出预算后显式传入
+_current_budget: contextvars.ContextVar[Optional[RetryBudget]] = contextvars.ContextVar(
+    "retry_budget", default=None
+)
+
+
+class RetryPolicy:
+    """控制接口的对冲与重试策略"""
+
+    def __init__(self):
+        # 是否发送对冲请求
+        self.hedging = os.environ.get("ANUNEKO_HEDGING", "True").lower() == "true"
+        # 对冲延迟取近期耗时的该百分位数，样本不足时使用初始延迟，且不低于最小延迟（秒）
+        self.hedge_percentile = float(os.environ.get("ANUNEKO_HEDGE_PERCENTILE", "95"))
+        self.hedge_initial_delay = float(os.environ.get("ANUNEKO_HEDGE_INITIAL_DELAY", "1"))
+        self.hedge_min_delay = float(os.environ.get("ANUNEKO_HEDGE_MIN_DELAY", "0.05"))
+        self.min_samples = int(os.environ.get("ANUNEKO_HEDGE_MIN_SAMPLES", "20"))
+        self.window = int(os.environ.get("ANUNEKO_HEDGE_WINDOW", "200"))
+        # 单次调用最多的尝试次数（含首次尝试和对冲）
+        self.max_attempts = int(os.environ.get("ANUNEKO_CONTROL_MAX_ATTEMPTS", "3"))
+        # 每个客户端请求最多的额外尝试次数
+        self.request_budget = int(os.environ.get("ANUNEKO_RETRY_BUDGET", "3"))
+        # 重试退避的初始值和上限（秒），实际等待时间在 0 到退避值之间随机
+        self.backoff_base = float(os.environ.get("ANUNEKO_RETRY_BACKOFF", "0.1"))
+        self.backoff_max = float(os.environ.get("ANUNEKO_RETRY_BACKOFF_MAX", "2"))
+
+        self._trackers: Dict[str, LatencyTracker] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    def begin_request(self):
+        """为当前客户端请求（所在的异步任务）设置新的重试预算"""
+        _current_budget.set(RetryBudget(self.request_budget))
+
+    @staticmethod
+    def current_budget() -> Optional[RetryBudget]:
+        """当前客户端请求的重试预算，不在请求中时为 None"""
+        return _current_budget.get()
+
+    def _tracker(self, call: str) -> LatencyTracker:
+        tracker = self._trackers.get(call)
+        if tracker is None:
+            tracker = self._trackers[call] = LatencyTracker(self.window)
+        return tracker
+
+    def _count(self, call: str, name: str):
+        stats = self._stats.get(call)
+        if stats is None:
+            stats = self._stats[call] = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0,
+                                         "budget_exhausted": 0, "failures": 0}
+        stats[name] += 1
+
+    def _spend(self, call: str, budget: Optional[RetryBudget]) -> bool:
+        """从请求的预算中取一次额外尝试，不在请求中（如后台刷新）时只受单次调用的次数限制"""
+        if budget is None or budget.take():
+            return True
+        self._count(call, "budget_exhausted")
+        return False
+
+    def hedge_delay(self, call: str) -> float:
+        tracker = self._tracker(call)
+        if len(tracker) < self.min_samples:
+            return self.hedge_initial_delay
+        return max(self.hedge_min_delay, tracker.percentile(self.hedge_percentile))
+
+    def backoff(self, retry: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** retry))
+
+    @staticmethod
+    def retryable(resp: httpx.Response) -> bool:
+        return resp.status_code == 429 or resp.status_code >= 500
+
+    async def _attempt(self, call: str, send: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        started = time.perf_counter()
+        resp = await send()
+        if not self.retryable(resp):
+            self._tracker(call).observe(time.perf_counter() - started)
+        return resp
+
+    async def call(self, call: str, send: Callable[[], Awaitable[httpx.Response]],
+                   budget: Optional[RetryBudget] = None, max_attempts: Optional[int] = None) -> httpx.Response:
+        """
+        执行一次控制接口调用
+
+        Args:
+            call: 接口名称，各接口分别统计耗时
+            send: 发送一次尝试的协程函数
+            budget: 所属请求的重试预算，默认取当前上下文中的预算
+            max_attempts: 本次调用最多的尝试次数，默认为 ANUNEKO_CONTROL_MAX_ATTEMPTS
+
+        Returns:
+            第一个成功（非 429、非 5xx）的响应；所有尝试都失败时返回最后一个响应或抛出最后一个异常
+
+        Raises:
+            CircuitOpenError: 上游已熔断，不重试
+        """
+        self._count(call, "calls")
+        if budget is None:
+            budget = _current_budget.get()
+        if max_attempts is None:
+            max_attempts = self.max_attempts
+        inflight: Dict[asyncio.Task, bool] = {}
+        attempts = retries = 0
+        hedge_at: Optional[float] = None
+        last_resp: Optional[httpx.Response] = None
+        last_error: Optional[BaseException] = None
+
+        def launch(hedge: bool = False):
+            nonlocal attempts
+            attempts += 1
+            inflight[asyncio.ensure_future(self._attempt(call, send))] = hedge
+
+        launch()
+        if self.hedging and call in IDEMPOTENT_CALLS and max_attempts > 1:
+            hedge_at = time.perf_counter() + self.hedge_delay(call)
+        try:
+            while True:
+                timeout = None if hedge_at is None else max(0.0, hedge_at - time.perf_counter())
+                done: Set[asyncio.Task]
+                done, _ = await asyncio.wait(inflight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 超过对冲延迟仍未返回，再发送一次，只对冲一次
+                    hedge_at = None
+                    if attempts < max_attempts and self._spend(call, budget):
+                        self._count(call, "hedges")
+                        metrics.control_hedges.labels(call).inc()
+                        launch(hedge=True)
+                    continue
+
+                for task in done:
+                    hedge = inflight.pop(task)
+                    if isinstance(task.exception(), CircuitOpenError):
+                        # 已熔断，不再重试
+                        if not inflight:
+                            raise task.exception()
+                        continue
+                    if task.exception() is not None:
+                        last_error, last_resp = task.exception(), None
+                        continue
+                    resp = task.result()
+                    if self.retryable(resp):
+                        last_error, last_resp = None, resp
+                        continue
+                    if hedge:
+                        self._count(call, "hedge_wins")
+                        metrics.control_hedge_wins.labels(call).inc()
+                    return resp
+                if inflight:
+                    continue
+
+                # 所有进行中的尝试都失败，退避后重试
+                hedge_at = None
+                if attempts >= max_attempts or not self._spend(call, budget):
+                    break
+                self._count(call, "retries")
+                metrics.control_retries.labels(call).inc()
+                await asyncio.sleep(self.backoff(retries))
+                retries += 1
+                launch()
+        finally:
+            # 取消落后的尝试；同时结束的尝试取出其异常，避免未处理异常的警告
+            for task in inflight:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()
+
+        self._count(call, "failures")
+        if last_resp is not None:
+            return last_resp
+        raise last_error
+
+    def stats(self) -> Dict[str, Any]:
+        """各接口的对冲与重试统计信息"""
+        calls: Dict[str, Any] = {}
+        for call, counts in self._stats.items():
+            tracker = self._tracker(call)
+            p95 = tracker.percentile(self.hedge_percentile)
+            calls[call] = dict(counts)
+            hedges = counts["hedges"]
+            calls[call]["hedge_win_rate"] = round(counts["hedge_wins"] / hedges, 4) if hedges else None
+            calls[call]["p95_ms"] = round(p95 * 1000, 2) if p95 is not None else None
+            calls[call]["hedge_delay_ms"] = round(self.hedge_delay(call) * 1000, 2)
+        return {
+            "hedging": self.hedging,
+            "max_attempts": self.max_attempts,
+            "request_budget": self.request_budget,
+            "calls": calls
+        }
+
+
+# 全局控制接口重试策略实例
+retry_policy = RetryPolicy()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+会话预热池
+按模型预先创建好 AnuNeko 会话，新对话可以直接使用，省去 create_session 和 switch_model 两次往返
+"""
+
+import os
+import time
+import asyncio
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+from app.services.account_pool import account_pool
+from app.services.async_runtime import runtime
+
+# 补充全部失败后的重试间隔（秒），连续失败时翻倍，不超过维护间隔
+REFILL_BACKOFF = 1.0
+
+
+class SessionPool:
+    """会话预热池"""
+
+    def __init__(self):
+        # 池中会话数低于低水位时开始补充，补充到高水位为止；高水位为 0 时禁用预热池（默认）
+        self.low_watermark = int(os.environ.get("SESSION_POOL_LOW", "1"))
+        self.high_watermark = int(os.environ.get("SESSION_POOL_HIGH", "0"))
+        # 预热会话的最长保留时间（秒），超过后丢弃
+        self.max_age = float(os.environ.get("SESSION_POOL_MAX_AGE", "600"))
+        # 启动时预热的 AnuNeko 模型，逗号分隔；其他模型在第一次使用后开始预热
+        self.prewarm_models: List[str] = [
+            m.strip() for m in os.environ.get("SESSION_POOL_MODELS", "").split(",") if m.strip()
+        ]
+        # AnuNeko 模型名 -> [(会话 ID, 创建会话的账号 ID, 创建时间)]
+        self._pools: Dict[str, Deque[Tuple[str, str, float]]] = {}
+        self._refilling: Set[str] = set()
+        # 每个模型连续补充失败的次数和下次允许补充的时间
+        self._refill_failures: Dict[str, int] = {}
+        self._next_refill: Dict[str, float] = {}
+        self._maintenance: Optional[asyncio.Future] = None
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "created": 0,
+            "create_failures": 0,
+            "expired": 0,
+            "discarded": 0,
+            "skipped": 0
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.high_watermark > 0
+
+    def prewarm(self):
+        """为配置的模型预热会话，并启动后台维护任务"""
+        if not self.enabled:
+            return
+        for model in self.prewarm_models:
+            self._pools.setdefault(model, deque())
+            self._schedule_refill(model)
+        self._ensure_maintenance()
+
+    async def acquire(self, model: str) -> Optional[Tuple[str, str]]:
+        """
+        从预热池中取出一个会话，优先选择负载最低的健康账号创建的会话
+
+        Args:
+            model: AnuNeko 模型名
+
+        Returns:
+            (会话 ID, 账号 ID)，池为空时返回 None
+        """
+        if not self.enabled:
+            return None
+
+        pool = self._pools.setdefault(model, deque())
+        self._evict_expired()
+
+        best = None
+        for entry in list(pool):
+            account = account_pool.accounts.get(entry[1])
+            if account is None:
+                # 账号已不在配置中，会话无法再使用
+                pool.remove(entry)
+                self._stats["discarded"] += 1
+                continue
+            # 账号冷却或熔断中的会话暂不取出，账号恢复后仍可使用
+            if not account.healthy:
+                continue
+            if best is None or account.load < best[0].load:
+                best = (account, entry)
+
+        if best is not None:
+            pool.remove(best[1])
+            self._stats["hits"] += 1
+        else:
+            self._stats["misses"] += 1
+
+        self._schedule_refill(model)
+        self._ensure_maintenance()
+        return (best[1][0], best[1][1]) if best is not None else None
+
+    def _schedule_refill(self, model: str):
+        """池中会话低于低水位时在后台补充；上一轮补充全部失败后退避，所有账号都在冷却或熔断中时暂停补充"""
+        pool = self._pools.get(model)
+        if pool is None or model in self._refilling or len(pool) >= self.low_watermark:
+            return
+        if (time.monotonic() < self._next_refill.get(model, 0.0)
+                or not any(account.healthy for account in account_pool.accounts.values())):
+            self._stats["skipped"] += 1
+            return
+        self._refilling.add(model)
+        runtime.spawn(self._refill(model))
+
+    async def _refill(self, model: str):
+        """并发创建会话，将池补充到高水位"""
+        try:
+            pool = self._pools[model]
+            need = self.high_watermark - len(pool)
+            if need <= 0:
+                return
+            # 每个会话都分配给当时负载最低的健康账号
+            accounts = []
+            for _ in range(need):
+                account = account_pool.pick()
+                account.assigned += 1
+                accounts.append(account)
+            try:
+                chat_ids = await asyncio.gather(
+                    *[account.api.create_session(model) for account in accounts], return_exceptions=True
+                )
+            finally:
+                for account in accounts:
+                    account.assigned -= 1
+            created = 0
+            for account, chat_id in zip(accounts, chat_ids):
+                if isinstance(chat_id, str) and chat_id:
+                    pool.append((chat_id, account.id, time.monotonic()))
+                    created += 1
+                else:
+                    self._stats["create_failures"] += 1
+            self._stats["created"] += created
+            if created:
+                self._refill_failures.pop(model, None)
+                self._next_refill.pop(model, None)
+            else:
+                failures = self._refill_failures[model] = self._refill_failures.get(model, 0) + 1
+                backoff = min(REFILL_BACKOFF * 2 ** (failures - 1), self._interval)
+                self._next_refill[model] = time.monotonic() + backoff
+        finally:
+            self._refilling.discard(model)
+
+    def _evict_expired(self):
+        """丢弃超过最长保留时间的会话"""
+        now = time.monotonic()
+        for pool in self._pools.values():
+            while pool and now - pool[0][2] >= self.max_age:
+                pool.popleft()
+                self._stats["expired"] += 1
+
+    def _ensure_maintenance(self):
+        """启动后台维护任务"""
+        if self._maintenance is None or self._maintenance.done():
+            self._maintenance = runtime.spawn(self._maintain())
+
+    @property
+    def _interval(self) -> float:
+        """后台维护间隔（秒）"""
+        return max(self.max_age / 4, 1.0)
+
+    async def _maintain(self):
+        """定期清理过期会话并补充预热池"""
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                self._evict_expired()
+                for model in list(self._pools):
+                    self._schedule_refill(model)
+            except Exception as e:
+                print(f"会话预热池维护失败: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        """预热池统计信息"""
+        stats: Dict[str, Any] = dict(self._stats)
+        stats["enabled"] = self.enabled
+        stats["sizes"] = {model: len(pool) for model, pool in self._pools.items()}
+        return stats
+
+
+# 全局会话预热池实例
+session_pool = SessionPool()
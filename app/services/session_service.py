@@ -5,76 +5,114 @@
 """
 
 import os
+import time
 import uuid
 import asyncio
+from contextlib import asynccontextmanager
 from datetime import datetime
 from typing import Dict, List, Optional, Any
 
 from app.services.anuneko_service import AnuNekoAPI
+from app.services.account_pool import account_pool
+from app.services.async_runtime import runtime
+from app.services.conversation_index import conversation_index
+from app.services.model_registry import model_registry
+from app.services.request_timing import RequestTiming, null_timing
+from app.services.session_pool import session_pool
+from app.services.session_store import SessionStore, create_session_store
+
+
+class SessionBusyError(Exception):
+    """会话排队已满或等待超时"""
+    pass
+
+
+class ChatTurnQueue:
+    """单个 AnuNeko 会话的对话轮次队列，同一会话的请求按先后顺序依次执行"""
+    
+    def __init__(self):
+        # asyncio.Lock 的等待者按 FIFO 顺序被唤醒
+        self.lock = asyncio.Lock()
+        self.waiting = 0
+        self.turns = 0
+        self.rejected = 0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": self.waiting,
+            "active": self.lock.locked(),
+            "turns": self.turns,
+            "rejected": self.rejected,
+            "last_wait_ms": round(self.last_wait * 1000, 2),
+            "max_wait_ms": round(self.max_wait * 1000, 2)
+        }
 
 
 class SessionService:
     """会话管理服务类"""
     
     def __init__(self):
-        # 全局变量存储会话信息
-        self.sessions: Dict[str, Dict[str, Any]] = {}
-        # 动态模型映射表
-        self.MODEL_MAPPING: Dict[str, str] = {}
-        # AnuNeko API 实例
-        self._anuneko_api: Optional[AnuNekoAPI] = None
-    
-    def get_anuneko_api(self) -> AnuNekoAPI:
-        """获取 AnuNeko API 实例"""
-        if self._anuneko_api is None:
-            self._anuneko_api = AnuNekoAPI()
-        return self._anuneko_api
+        # 会话存储，后端由 SESSION_STORE 决定（memory 或 sqlite）
+        self.sessions: SessionStore = create_session_store()
+        self.sessions.on_evict = self._forget
+        # 会话空闲过期时间（秒），0 表示不过期
+        self.session_ttl = float(os.environ.get("SESSION_TTL", "3600"))
+        # 后台清理过期会话的间隔（秒）
+        self.sweep_interval = float(os.environ.get("SESSION_SWEEP_INTERVAL", "60"))
+        self._sweeper: Optional[asyncio.Future] = None
+        # 每个 AnuNeko 会话的对话轮次队列
+        self._turn_queues: Dict[str, ChatTurnQueue] = {}
+        # 单个会话最多排队的请求数（不含正在执行的请求）
+        self.queue_max_depth = int(os.environ.get("SESSION_QUEUE_MAX_DEPTH", "8"))
+        # 排队等待的超时时间（秒），0 表示不限制
+        self.queue_timeout = float(os.environ.get("SESSION_QUEUE_TIMEOUT", "0"))
+    
+    def get_anuneko_api(self, session: Optional[Dict[str, Any]] = None) -> AnuNekoAPI:
+        """
+        获取 AnuNeko API 实例
+        
+        Args:
+            session: 会话信息，传入时返回创建该会话的账号，否则返回负载最低的健康账号
+        """
+        if session is not None:
+            return account_pool.get(session.get("account_id")).api
+        return account_pool.pick().api
+    
+    @property
+    def MODEL_MAPPING(self) -> Dict[str, str]:
+        """动态模型映射表，由模型注册表维护"""
+        return model_registry.mapping
     
     def update_model_mapping(self):
-        """动态更新模型映射表"""
-        try:
-            api = self.get_anuneko_api()
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            
-            try:
-                anuneko_models = loop.run_until_complete(api.model_view())
-            finally:
-                loop.close()
-            
-            if anuneko_models and "models" in anuneko_models:
-                # 清空现有映射
-                self.MODEL_MAPPING.clear()
-                
-                # 为每个AnuNeko模型创建映射
-                for anuneko_model in anuneko_models["models"]:
-                    # 生成模型ID
-                    openai_model = f"mihoyo-{anuneko_model.lower().replace(' ', '_')}"
-                    self.MODEL_MAPPING[openai_model] = anuneko_model
-                
-                print(f"已更新模型映射表，共{len(self.MODEL_MAPPING)}个模型")
-            else:
-                # 如果无法获取，设置默认映射
-                self.MODEL_MAPPING.clear()
-                self.MODEL_MAPPING["mihoyo-orange_cat"] = "Orange Cat"
-                print("无法获取AnuNeko模型，使用默认映射")
-                
-        except Exception as e:
-            print(f"更新模型映射失败: {str(e)}")
-            # 设置默认映射作为后备
-            self.MODEL_MAPPING.clear()
-            self.MODEL_MAPPING["mihoyo-orange_cat"] = "Orange Cat"
+        """强制从上游刷新模型映射表（同步入口）"""
+        runtime.run(self.aupdate_model_mapping())
+    
+    async def aupdate_model_mapping(self):
+        """强制从上游刷新模型映射表"""
+        await model_registry.refresh()
+    
+    def request_accounts(self, request_data: Dict[str, Any]) -> List[str]:
+        """可能处理该请求的账号：指定了已有会话时为会话所在的账号，否则为所有账号"""
+        session_id = request_data.get("session_id")
+        session = self.sessions.get(session_id) if session_id else None
+        if session is not None and session.get("account_id") in account_pool.accounts:
+            return [session["account_id"]]
+        return list(account_pool.accounts)
     
     def get_session_for_request(self, request_data: Dict[str, Any]) -> str:
-        """根据请求获取或创建会话"""
+        """根据请求获取或创建会话（同步入口）"""
+        return runtime.run(self.aget_session_for_request(request_data))
+    
+    async def aget_session_for_request(self, request_data: Dict[str, Any],
+                                       timing: RequestTiming = null_timing) -> str:
+        """根据请求获取或创建会话，切换模型和创建会话的上游耗时记录到 timing"""
         model = request_data.get("model", "mihoyo-orange_cat")
         
-        # 确保模型映射是最新的
-        if not self.MODEL_MAPPING:
-            self.update_model_mapping()
-        
-        # 从动态映射表中获取AnuNeko模型名
-        anuneko_model = self.MODEL_MAPPING.get(model)
+        # 从模型注册表中获取AnuNeko模型名（缓存过期时在后台刷新）
+        snapshot = await model_registry.get()
+        anuneko_model = snapshot.mapping.get(model)
         
         if not anuneko_model:
             # 如果映射中没有，默认使用Orange Cat
@@ -83,65 +121,187 @@ class SessionService:
         
         # 尝试从请求中获取会话ID（如果有的话）
         session_id = request_data.get("session_id")
+        if not session_id:
+            # 标准 OpenAI 客户端不传 session_id，按历史消息找到产生这段历史的会话
+            session_id = conversation_index.lookup(request_data.get("messages") or [])
         
-        if session_id and session_id in self.sessions:
-            session = self.sessions[session_id]
+        self._ensure_sweeper()
+        session = self.sessions.get(session_id) if session_id else None
+        if session is not None:
+            self.sessions.touch(session_id)
             # 检查模型是否匹配，如果不匹配则切换模型
             if session.get("model") != anuneko_model:
-                api = self.get_anuneko_api()
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                try:
-                    success = loop.run_until_complete(
-                        api.switch_model(session["anuneko_chat_id"], anuneko_model)
-                    )
-                    if success:
-                        session["model"] = anuneko_model
-                finally:
-                    loop.close()
+                api = self.get_anuneko_api(session)
+                success = await api.switch_model(session["anuneko_chat_id"], anuneko_model, timing)
+                if success:
+                    session["model"] = anuneko_model
+                    # 重新写入存储，持久化后端才能保存修改
+                    self.sessions[session_id] = session
             return session_id
         
-        # 创建新会话
-        api = self.get_anuneko_api()
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        # 创建新会话，优先使用预热池中已就绪的会话，否则由负载最低的健康账号创建
+        pooled = await session_pool.acquire(anuneko_model)
+        if pooled:
+            anuneko_chat_id, account_id = pooled
+            timing.add("session_pool", desc="hit")
+        else:
+            account = account_pool.pick()
+            account_id = account.id
+            anuneko_chat_id = await account.api.create_session(anuneko_model, timing)
+        if anuneko_chat_id:
+            new_session_id = str(uuid.uuid4())
+            self.sessions[new_session_id] = {
+                "id": new_session_id,
+                "anuneko_chat_id": anuneko_chat_id,
+                # 会话固定在创建它的账号上
+                "account_id": account_id,
+                "model": anuneko_model,
+                "openai_model": model,
+                "created_at": datetime.now().isoformat(),
+                "has_anuneko_chat": True
+            }
+            account_pool.assign(account_id)
+            return new_session_id
+        
+        raise Exception("无法创建会话")
+    
+    @asynccontextmanager
+    async def chat_turn(self, session: Dict[str, Any]):
+        """
+        在会话的对话轮次队列中排队，轮到时执行
+        
+        同一 AnuNeko 会话的请求按 FIFO 顺序串行执行，不同会话之间完全并行。
+        队列只在本进程内，多个工作进程之间不串行
+        
+        Args:
+            session: 会话信息
+            
+        Raises:
+            SessionBusyError: 排队请求数已达上限或等待超时
+        """
+        chat_id = session["anuneko_chat_id"]
+        queue = self._turn_queues.get(chat_id)
+        if queue is None:
+            queue = self._turn_queues[chat_id] = ChatTurnQueue()
+        
+        if queue.lock.locked() and queue.waiting >= self.queue_max_depth:
+            queue.rejected += 1
+            raise SessionBusyError(f"会话 {session['id']} 排队请求过多，请稍后再试")
+        
+        started = time.monotonic()
+        queue.waiting += 1
+        if not await self._acquire_turn(queue):
+            queue.rejected += 1
+            raise SessionBusyError(f"会话 {session['id']} 排队等待超时，请稍后再试")
+        
+        queue.last_wait = time.monotonic() - started
+        queue.max_wait = max(queue.max_wait, queue.last_wait)
+        queue.turns += 1
         try:
-            anuneko_chat_id = loop.run_until_complete(api.create_session(anuneko_model))
-            if anuneko_chat_id:
-                new_session_id = str(uuid.uuid4())
-                self.sessions[new_session_id] = {
-                    "id": new_session_id,
-                    "anuneko_chat_id": anuneko_chat_id,
-                    "model": anuneko_model,
-                    "openai_model": model,
-                    "created_at": datetime.now().isoformat(),
-                    "has_anuneko_chat": True
-                }
-                return new_session_id
+            yield
         finally:
-            loop.close()
+            queue.lock.release()
+    
+    async def _acquire_turn(self, queue: ChatTurnQueue) -> bool:
+        """
+        在排队超时内获取会话锁
         
-        raise Exception("无法创建会话")
+        获取到锁的同时离开排队计数，排队深度只统计仍在等待的请求；
+        超时或被取消时放弃等待，锁恰好在同一时刻被获取的立即释放，不会留下无人释放的锁
+        
+        Returns:
+            是否获取到锁
+        """
+        granted = False
+        
+        async def take():
+            nonlocal granted
+            await queue.lock.acquire()
+            granted = True
+            queue.waiting -= 1
+        
+        acquire = asyncio.ensure_future(take())
+        proceed = False
+        try:
+            await asyncio.wait((acquire,), timeout=self.queue_timeout if self.queue_timeout > 0 else None)
+            proceed = granted
+            return proceed
+        finally:
+            if not proceed:
+                if granted:
+                    queue.lock.release()
+                else:
+                    # 取消后 take() 不会再获取到锁
+                    acquire.cancel()
+                    queue.waiting -= 1
+    
+    def queue_stats(self) -> Dict[str, Any]:
+        """会话排队统计信息"""
+        queues = list(self._turn_queues.values())
+        return {
+            "queued": sum(q.waiting for q in queues),
+            "active": sum(1 for q in queues if q.lock.locked()),
+            "rejected": sum(q.rejected for q in queues),
+            "max_depth": self.queue_max_depth,
+            "timeout": self.queue_timeout
+        }
     
     def list_sessions(self) -> List[Dict[str, Any]]:
         """列出会话"""
         session_list = []
         for session_id, session_data in self.sessions.items():
+            queue = self._turn_queues.get(session_data["anuneko_chat_id"])
             session_list.append({
                 "id": session_data["id"],
                 "model": session_data["openai_model"],
                 "created_at": session_data["created_at"],
-                "has_anuneko_chat": session_data["has_anuneko_chat"]
+                "has_anuneko_chat": session_data["has_anuneko_chat"],
+                "queue": (queue or ChatTurnQueue()).stats()
             })
         return session_list
     
     def delete_session(self, session_id: str) -> bool:
         """删除会话"""
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            self._forget(session_id, session)
             return True
         return False
     
+    def _forget(self, session_id: str, session: Dict[str, Any]):
+        """会话被删除或淘汰后释放账号负载和空闲的排队队列"""
+        account_pool.release(session.get("account_id"))
+        queue = self._turn_queues.get(session["anuneko_chat_id"])
+        if queue is not None and not queue.lock.locked() and queue.waiting == 0:
+            del self._turn_queues[session["anuneko_chat_id"]]
+    
+    def _ensure_sweeper(self):
+        """启动后台过期会话清理任务"""
+        if self.sweep_interval <= 0:
+            return
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = runtime.spawn(self._sweep_loop())
+    
+    async def _sweep_loop(self):
+        """定期淘汰空闲过期和超出容量的会话，数据库操作在线程池中执行，不阻塞请求处理"""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                evicted = await asyncio.to_thread(self.sessions.sweep, self.session_ttl)
+                for session_id, session in evicted:
+                    self._forget(session_id, session)
+                if evicted:
+                    print(f"已淘汰 {len(evicted)} 个会话")
+            except Exception as e:
+                print(f"会话清理失败: {str(e)}")
+    
+    def store_stats(self) -> Dict[str, Any]:
+        """会话存储统计信息"""
+        stats = self.sessions.stats()
+        stats["ttl"] = self.session_ttl
+        stats["sweep_interval"] = self.sweep_interval
+        return stats
+    
     def get_session(self, session_id: str) -> Optional[Dict[str, Any]]:
         """获取会话信息"""
         return self.sessions.get(session_id)
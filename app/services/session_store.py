@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+会话存储
+提供可替换的会话存储后端：进程内字典（默认）和可被多个本地工作进程共享的 SQLite（WAL）
+两种后端都按最近使用时间维护会话顺序，支持空闲过期和容量上限（LRU 淘汰）
+"""
+
+import os
+import time
+import atexit
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from app.services import json_codec
+
+
+class SessionStore(MutableMapping, ABC):
+    """
+    会话存储接口
+
+    以字典的方式按会话 ID 存取会话信息。会话信息修改后需要重新赋值
+    (store[session_id] = session) 才能保证写入持久化后端
+
+    读取不会刷新会话的最近使用时间，会话被对话使用时需要调用 touch()
+    """
+
+    def __init__(self, max_size: int = 0):
+        # 最多保留的会话数，0 表示不限制
+        self.max_size = max_size
+        # 会话因超出容量被淘汰时的回调 (会话 ID, 会话信息)
+        self.on_evict: Optional[Callable[[str, Dict[str, Any]], None]] = None
+        self._evictions = {"evicted_idle": 0, "evicted_capacity": 0}
+
+    @abstractmethod
+    def touch(self, session_id: str):
+        """刷新会话的最近使用时间"""
+
+    @abstractmethod
+    def sweep(self, ttl: float) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        淘汰空闲超过 ttl 秒的会话，以及超出容量上限的最久未使用的会话
+
+        Args:
+            ttl: 空闲过期时间（秒），0 表示不按空闲时间淘汰
+
+        Returns:
+            被淘汰的 [(会话 ID, 会话信息)]
+        """
+
+    def close(self):
+        """关闭存储，写入所有未保存的数据"""
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        """存储统计信息"""
+        stats: Dict[str, Any] = {"backend": self.backend, "sessions": len(self), "max_size": self.max_size}
+        stats.update(self._evictions)
+        return stats
+
+
+class MemorySessionStore(SessionStore):
+    """
+    进程内字典存储，重启后会话丢失，不能在多个工作进程之间共享
+
+    会话按最近使用时间排列在 OrderedDict 中（最久未使用的在最前），
+    刷新、按容量淘汰都是 O(1)，按空闲时间淘汰只需从头部扫描到第一个未过期的会话
+    """
+
+    backend = "memory"
+
+    def __init__(self, max_size: int = 0):
+        super().__init__(max_size)
+        # 会话 ID -> (会话信息, 最近使用时间)
+        self._data: "OrderedDict[str, Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, session_id: str) -> Dict[str, Any]:
+        return self._data[session_id][0]
+
+    def __setitem__(self, session_id: str, session: Dict[str, Any]):
+        evicted = []
+        with self._lock:
+            self._data[session_id] = (session, time.monotonic())
+            self._data.move_to_end(session_id)
+            while self.max_size > 0 and len(self._data) > self.max_size:
+                evicted_id, (evicted_session, _) = self._data.popitem(last=False)
+                self._evictions["evicted_capacity"] += 1
+                evicted.append((evicted_id, evicted_session))
+        if self.on_evict is not None:
+            for evicted_id, evicted_session in evicted:
+                self.on_evict(evicted_id, evicted_session)
+
+    def __delitem__(self, session_id: str):
+        with self._lock:
+            del self._data[session_id]
+
+    def __iter__(self) -> Iterator[str]:
+        with self._lock:
+            return iter(list(self._data))
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, session_id) -> bool:
+        return session_id in self._data
+
+    def touch(self, session_id: str):
+        with self._lock:
+            entry = self._data.get(session_id)
+            if entry is not None:
+                self._data[session_id] = (entry[0], time.monotonic())
+                self._data.move_to_end(session_id)
+
+    def sweep(self, ttl: float) -> List[Tuple[str, Dict[str, Any]]]:
+        evicted = []
+        if ttl <= 0:
+            return evicted
+        deadline = time.monotonic() - ttl
+        with self._lock:
+            while self._data:
+                session_id, (session, last_access) = next(iter(self._data.items()))
+                if last_access > deadline:
+                    break
+                del self._data[session_id]
+                self._evictions["evicted_idle"] += 1
+                evicted.append((session_id, session))
+        return evicted
+
+
+# 待写入队列中表示删除的标记
+_DELETED = object()
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    SQLite 存储
+
+    使用 WAL 模式，多个本地工作进程可以共享同一个数据库文件；
+    写入先进入内存队列，由后台线程批量提交。读取使用单独的只读连接，WAL 模式下读取不等待写事务，
+    事件循环中的读取不会被正在提交的批量写入阻塞。
+    最近使用时间保存在带索引的 last_access 列中，容量上限在每次 sweep() 时统一执行
+    """
+
+    backend = "sqlite"
+
+    def __init__(self, path: str, flush_interval: float = 0.05, batch_size: int = 256, max_size: int = 0):
+        super().__init__(max_size)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL, last_access REAL NOT NULL DEFAULT 0)"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(sessions)")]
+        if "last_access" not in columns:
+            # 旧版本创建的数据库，以最后修改时间作为最近使用时间
+            self._conn.execute("ALTER TABLE sessions ADD COLUMN last_access REAL NOT NULL DEFAULT 0")
+            self._conn.execute("UPDATE sessions SET last_access = updated_at")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions (last_access)")
+        self._db_lock = threading.Lock()
+        # 只读连接，与写入连接不共用锁
+        self._reader = sqlite3.connect(path, timeout=1, check_same_thread=False, isolation_level=None)
+        self._reader.execute("PRAGMA query_only=ON")
+        self._read_lock = threading.Lock()
+
+        # 尚未提交的写入：会话 ID -> 会话信息或删除标记
+        self._pending: Dict[str, Any] = {}
+        # 正在提交的写入，提交完成前读取仍以其为准
+        self._inflight: Dict[str, Any] = {}
+        # 尚未提交的最近使用时间：会话 ID -> 时间戳
+        self._pending_touches: Dict[str, float] = {}
+        self._pending_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._stats = {"flushes": 0, "written": 0}
+
+        self._writer = threading.Thread(target=self._write_loop, name="session-store-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _unflushed(self) -> Dict[str, Any]:
+        """尚未提交完成的写入，待写入的覆盖正在提交的"""
+        with self._pending_lock:
+            return {**self._inflight, **self._pending}
+
+    def __getitem__(self, session_id: str) -> Dict[str, Any]:
+        with self._pending_lock:
+            pending = self._pending.get(session_id, self._inflight.get(session_id))
+        if pending is _DELETED:
+            raise KeyError(session_id)
+        if pending is not None:
+            return pending
+
+        with self._read_lock:
+            row = self._reader.execute("SELECT data FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None:
+            raise KeyError(session_id)
+        return json_codec.loads(row[0])
+
+    def __setitem__(self, session_id: str, session: Dict[str, Any]):
+        with self._pending_lock:
+            self._pending[session_id] = session
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def __delitem__(self, session_id: str):
+        if session_id not in self:
+            raise KeyError(session_id)
+        with self._pending_lock:
+            self._pending[session_id] = _DELETED
+            self._pending_touches.pop(session_id, None)
+
+    def touch(self, session_id: str):
+        with self._pending_lock:
+            self._pending_touches[session_id] = time.time()
+
+    def __contains__(self, session_id) -> bool:
+        try:
+            self[session_id]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self) -> Iterator[str]:
+        # 不等待写入提交，在数据库的结果上合并待写入的修改，尚未提交的新会话排在最后
+        pending = self._unflushed()
+        with self._read_lock:
+            rows = self._reader.execute("SELECT id FROM sessions ORDER BY last_access").fetchall()
+        ids = [row[0] for row in rows if pending.get(row[0]) is not _DELETED]
+        stored = {row[0] for row in rows}
+        ids.extend(session_id for session_id, session in pending.items()
+                   if session is not _DELETED and session_id not in stored)
+        return iter(ids)
+
+    def __len__(self) -> int:
+        pending = self._unflushed()
+        with self._read_lock:
+            count = self._reader.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            stored = set()
+            if pending:
+                ids = list(pending)
+                for start in range(0, len(ids), 500):
+                    chunk = ids[start:start + 500]
+                    rows = self._reader.execute(
+                        f"SELECT id FROM sessions WHERE id IN ({','.join('?' * len(chunk))})", chunk
+                    ).fetchall()
+                    stored.update(row[0] for row in rows)
+        for session_id, session in pending.items():
+            if session is _DELETED:
+                count -= session_id in stored
+            else:
+                count += session_id not in stored
+        return count
+
+    def flush(self):
+        """将待写入的数据在一个事务中提交"""
+        with self._pending_lock:
+            if not self._pending and not self._pending_touches:
+                return
+            pending, self._pending = self._pending, {}
+            touches, self._pending_touches = self._pending_touches, {}
+            self._inflight.update(pending)
+
+        now = time.time()
+        upserts = []
+        deletes = []
+        for session_id, session in pending.items():
+            if session is _DELETED:
+                deletes.append((session_id,))
+            else:
+                upserts.append((session_id, json_codec.dumps(session), now, now))
+
+        try:
+            with self._db_lock:
+                self._commit(upserts, touches, deletes)
+        except Exception:
+            # 提交失败时放回队列，等待下次重试（不覆盖期间新的写入）
+            with self._pending_lock:
+                for session_id, session in pending.items():
+                    self._pending.setdefault(session_id, session)
+                for session_id, at in touches.items():
+                    self._pending_touches.setdefault(session_id, at)
+            raise
+        finally:
+            with self._pending_lock:
+                for session_id, session in pending.items():
+                    if self._inflight.get(session_id) is session:
+                        del self._inflight[session_id]
+
+        self._stats["flushes"] += 1
+        self._stats["written"] += len(pending)
+
+    def _commit(self, upserts: List[tuple], touches: Dict[str, float], deletes: List[tuple]):
+        """在一个写事务中执行批量写入，调用方持有 _db_lock"""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            if upserts:
+                self._conn.executemany(
+                    "INSERT INTO sessions (id, data, updated_at, last_access) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at, "
+                    "last_access = excluded.last_access",
+                    upserts
+                )
+            if touches:
+                self._conn.executemany(
+                    "UPDATE sessions SET last_access = MAX(last_access, ?) WHERE id = ?",
+                    [(at, session_id) for session_id, at in touches.items()]
+                )
+            if deletes:
+                self._conn.executemany("DELETE FROM sessions WHERE id = ?", deletes)
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def sweep(self, ttl: float) -> List[Tuple[str, Dict[str, Any]]]:
+        self.flush()
+        evicted = []
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if ttl > 0:
+                    rows = self._conn.execute(
+                        "DELETE FROM sessions WHERE last_access <= ? RETURNING id, data", (time.time() - ttl,)
+                    ).fetchall()
+                    self._evictions["evicted_idle"] += len(rows)
+                    evicted.extend(rows)
+                if self.max_size > 0:
+                    excess = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] - self.max_size
+                    if excess > 0:
+                        # 按 last_access 索引取最久未使用的会话
+                        rows = self._conn.execute(
+                            "DELETE FROM sessions WHERE id IN "
+                            "(SELECT id FROM sessions ORDER BY last_access LIMIT ?) RETURNING id, data",
+                            (excess,)
+                        ).fetchall()
+                        self._evictions["evicted_capacity"] += len(rows)
+                        evicted.extend(rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [(session_id, json_codec.loads(data)) for session_id, data in evicted]
+
+    def _write_loop(self):
+        """后台批量写入线程"""
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"会话写入 SQLite 失败: {str(e)}")
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._writer.join(timeout=5)
+        self.flush()
+        with self._db_lock:
+            self._conn.close()
+        with self._read_lock:
+            self._reader.close()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        stats.update(self._stats)
+        with self._pending_lock:
+            stats["pending"] = len(self._pending)
+        return stats
+
+
+def create_session_store(backend: Optional[str] = None) -> SessionStore:
+    """
+    根据配置创建会话存储
+
+    Args:
+        backend: memory 或 sqlite，默认读取环境变量 SESSION_STORE
+
+    Returns:
+        会话存储
+    """
+    backend = (backend or os.environ.get("SESSION_STORE", "memory")).lower()
+    max_size = int(os.environ.get("SESSION_MAX_COUNT", "10000"))
+    if backend == "memory":
+        return MemorySessionStore(max_size=max_size)
+    if backend == "sqlite":
+        return SQLiteSessionStore(
+            os.environ.get("SESSION_DB_PATH", "data/sessions.db"),
+            flush_interval=float(os.environ.get("SESSION_DB_FLUSH_INTERVAL", "0.05")),
+            max_size=max_size
+        )
+    raise ValueError(f"不支持的会话存储类型: {backend}")
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+相同请求合并
+多个客户端同时发送完全相同的请求（模型 + 消息列表，且未指定会话）时只向上游生成一次，
+生成的回复片段分发给所有等待的请求；后加入的请求先收到已生成的部分
+"""
+
+import os
+import asyncio
+from typing import Any, AsyncIterator, Callable, Coroutine, Dict, List, Optional, Tuple
+
+
+class SharedGeneration:
+    """一次被多个请求共享的上游生成"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.session_id: Optional[str] = None
+        self.parts: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Future] = None
+        # 每次状态变化时触发并替换为新的事件，等待者取消时不会影响其他等待者
+        self._changed = asyncio.Event()
+        self._on_idle: Optional[Callable[["SharedGeneration"], None]] = None
+
+    @property
+    def started(self) -> bool:
+        return self.session_id is not None or self.done
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def start(self, session_id: str):
+        """会话已就绪，开始生成"""
+        self.session_id = session_id
+        self._notify()
+
+    def publish(self, piece: str):
+        """分发一个回复片段"""
+        if piece:
+            self.parts.append(piece)
+            self._notify()
+
+    def finish(self, error: Optional[BaseException] = None):
+        """生成结束"""
+        self.done = True
+        self.error = error
+        self._notify()
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    async def _wait(self, ready: Callable[[], bool]):
+        while not ready():
+            await self._changed.wait()
+        if self.error is not None:
+            raise self.error
+
+    async def ready(self):
+        """等待会话就绪（或生成失败）"""
+        await self._wait(lambda: self.started)
+
+    async def pieces(self) -> AsyncIterator[str]:
+        """
+        从第一个片段开始读取回复片段，直到生成结束
+
+        Yields:
+            回复片段
+        """
+        index = 0
+        while True:
+            await self._wait(lambda: index < len(self.parts) or self.done)
+            if index >= len(self.parts):
+                return
+            # 一次取出所有已生成的片段
+            pieces = self.parts[index:]
+            index = len(self.parts)
+            for piece in pieces:
+                yield piece
+
+    async def result(self) -> str:
+        """等待生成结束，返回完整回复"""
+        await self._wait(lambda: self.done)
+        return self.text
+
+    def leave(self):
+        """请求离开（完成或断开），所有请求都离开后取消尚未完成的生成"""
+        self.subscribers -= 1
+        if self.subscribers == 0 and self._on_idle is not None:
+            self._on_idle(self)
+
+
+class SingleFlight:
+    """进行中的共享生成"""
+
+    def __init__(self):
+        self.enabled = os.environ.get("REQUEST_COALESCING", "False").lower() == "true"
+        self._inflight: Dict[str, SharedGeneration] = {}
+        self._stats = {"generations": 0, "joined": 0, "cancelled": 0}
+
+    def join(self, key: str, produce: Callable[[SharedGeneration], Coroutine[Any, Any, None]]
+             ) -> Tuple[SharedGeneration, bool]:
+        """
+        加入相同请求正在进行的生成，没有时启动一个新的生成
+
+        生成在独立的任务中执行，发起请求的客户端断开后其他请求仍能继续收到回复；
+        每个加入的请求结束时都必须调用 leave()，所有请求都离开后取消生成
+
+        Args:
+            key: 请求的缓存键
+            produce: 执行生成的协程函数，负责调用 start、publish，出错时直接抛出
+
+        Returns:
+            (共享生成, 是否为新启动的生成)
+        """
+        generation = self._inflight.get(key)
+        if generation is not None:
+            generation.subscribers += 1
+            self._stats["joined"] += 1
+            return generation, False
+
+        generation = SharedGeneration(key)
+        generation.subscribers = 1
+        generation._on_idle = self._cancel_idle
+        self._inflight[key] = generation
+        self._stats["generations"] += 1
+        generation.task = asyncio.ensure_future(self._run(generation, produce))
+        return generation, True
+
+    async def _run(self, generation: SharedGeneration,
+                   produce: Callable[[SharedGeneration], Coroutine[Any, Any, None]]):
+        try:
+            await produce(generation)
+        except asyncio.CancelledError:
+            # 不能把 CancelledError 交给等待者，否则会被当作等待者自己被取消
+            generation.finish(RuntimeError("上游生成已取消"))
+            raise
+        except Exception as e:
+            generation.finish(e)
+        else:
+            generation.finish()
+        finally:
+            if self._inflight.get(generation.key) is generation:
+                del self._inflight[generation.key]
+
+    def _cancel_idle(self, generation: SharedGeneration):
+        """所有请求都已离开，取消尚未完成的生成"""
+        if generation.done or generation.task is None:
+            return
+        if self._inflight.get(generation.key) is generation:
+            del self._inflight[generation.key]
+        generation.task.cancel()
+        self._stats["cancelled"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """请求合并统计信息"""
+        stats: Dict[str, Any] = dict(self._stats)
+        stats["enabled"] = self.enabled
+        stats["inflight"] = len(self._inflight)
+        return stats
+
+
+# 全局请求合并实例
+single_flight = SingleFlight()
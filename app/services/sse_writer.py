@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+SSE 输出
+按 OpenAI 流式格式输出聊天完成的数据块，同一次完成中所有数据块使用相同的 ID
+"""
+
+import os
+import time
+import uuid
+import asyncio
+from json.encoder import encode_basestring
+from typing import AsyncIterator, Optional
+
+from app.services import json_codec
+
+# 预编码时占位的内容，生成后按它切分出前缀和后缀
+_PLACEHOLDER = "\x00content\x00"
+
+
+class SSEWriter:
+    """
+    单次聊天完成的 SSE 输出
+
+    数据块的外层结构（ID、时间戳、模型名等）在创建时只编码一次，
+    之后每个数据块只需要转义回复片段并拼接到前缀和后缀之间
+    """
+
+    def __init__(self, model: str, session_id: Optional[str] = None,
+                 coalesce_ms: Optional[float] = None, coalesce_bytes: Optional[int] = None):
+        self.id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
+        self.created = int(time.time())
+        # 合并窗口（毫秒），0 表示每个上游片段单独输出
+        if coalesce_ms is None:
+            coalesce_ms = float(os.environ.get("SSE_COALESCE_MS", "0"))
+        # 合并的片段达到该字节数时立即输出
+        if coalesce_bytes is None:
+            coalesce_bytes = int(os.environ.get("SSE_COALESCE_BYTES", "1024"))
+        self.coalesce_window = coalesce_ms / 1000
+        self.coalesce_bytes = coalesce_bytes
+
+        chunk = {
+            "id": self.id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": {
+                        "content": _PLACEHOLDER
+                    },
+                    "finish_reason": None
+                }
+            ]
+        }
+        if session_id:
+            chunk["session_id"] = session_id
+        encoded = f"data: {json_codec.dumps(chunk)}\n\n"
+        # 回复片段使用标准库的 C 转义函数，各 JSON 后端对字符串的转义结果相同
+        self._prefix, self._suffix = encoded.split(encode_basestring(_PLACEHOLDER))
+
+        end_chunk = {
+            "id": self.id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": {},
+                    "finish_reason": "stop"
+                }
+            ]
+        }
+        # 结束块和 [DONE] 合并为一次写入
+        self._end = f"data: {json_codec.dumps(end_chunk)}\n\ndata: [DONE]\n\n"
+
+    def delta(self, content: str) -> str:
+        """编码一个回复片段"""
+        return self._prefix + encode_basestring(content) + self._suffix
+
+    def end(self) -> str:
+        """编码结束块和 [DONE]"""
+        return self._end
+
+    async def coalesce(self, pieces: AsyncIterator[str]) -> AsyncIterator[str]:
+        """
+        合并上游回复片段
+
+        从收到第一个片段开始计时，合并窗口结束或累计字节数达到阈值时输出一次；
+        上游停顿时窗口到期也会输出，不会等到下一个片段。未启用合并时原样返回
+
+        Args:
+            pieces: 上游回复片段
+
+        Yields:
+            合并后的回复片段
+        """
+        if self.coalesce_window <= 0:
+            async for piece in pieces:
+                yield piece
+            return
+
+        buffer = []
+        size = 0
+        deadline = 0.0
+        loop = asyncio.get_running_loop()
+        iterator = pieces.__aiter__()
+        # 只有合并窗口未到期时才需要带超时等待，此时把取下一个片段包装成任务；
+        # 窗口到期时该任务不能取消，否则会关闭上游生成器，留到下一轮继续等待
+        pending: Optional[asyncio.Future] = None
+        try:
+            while True:
+                if buffer or pending is not None:
+                    if pending is None:
+                        pending = asyncio.ensure_future(iterator.__anext__())
+                    timeout = max(deadline - loop.time(), 0) if buffer else None
+                    done, _ = await asyncio.wait((pending,), timeout=timeout)
+                    if not done:
+                        yield "".join(buffer)
+                        buffer.clear()
+                        size = 0
+                        continue
+
+                    fetched, pending = pending, None
+                    try:
+                        piece = fetched.result()
+                    except StopAsyncIteration:
+                        break
+                else:
+                    # 缓冲区为空时没有截止时间，直接等待下一个片段
+                    try:
+                        piece = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        break
+
+                if not buffer:
+                    deadline = loop.time() + self.coalesce_window
+                buffer.append(piece)
+                size += len(piece.encode("utf-8"))
+                if size >= self.coalesce_bytes:
+                    yield "".join(buffer)
+                    buffer.clear()
+                    size = 0
+
+            if buffer:
+                yield "".join(buffer)
+        finally:
+            if pending is not None:
+                pending.cancel()
+                try:
+                    await pending
+                except (asyncio.CancelledError, Exception):
+                    pass
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
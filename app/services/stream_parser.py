@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+上游流式响应解析
+以原始字节块为输入增量解析 AnuNeko 的 SSE 流，输出带类型的事件
+"""
+
+from typing import Any, AsyncIterable, AsyncIterator, Dict, List, NamedTuple, Union
+
+from app.services import json_codec
+
+
+class ContentDelta(NamedTuple):
+    """默认分支（第 0 项）的回复片段"""
+    text: str
+
+
+class BranchDelta(NamedTuple):
+    """其他分支的回复片段"""
+    index: int
+    text: str
+
+
+class MessageId(NamedTuple):
+    """消息 ID，流最后一条通常是回复消息的 ID，用于确认分支选择"""
+    msg_id: str
+
+
+class ErrorCode(NamedTuple):
+    """上游返回的错误，如 chat_choice_shown"""
+    code: str
+    payload: Dict[str, Any]
+
+
+StreamEvent = Union[ContentDelta, BranchDelta, MessageId, ErrorCode]
+
+
+class StreamParser:
+    """
+    增量 SSE 解析器
+
+    字节块可以在任意位置切分（包括多字节字符中间），只有遇到换行才解析完整的一行；
+    每个字节只扫描一次，整体为线性时间
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # 缓冲区中已确认不含换行的长度，下次从这里继续查找
+        self._scanned = 0
+        self.lines = 0
+        self.malformed = 0
+
+    def feed(self, chunk: bytes) -> List[StreamEvent]:
+        """
+        输入一个字节块
+
+        Returns:
+            本次解析出的事件
+        """
+        events: List[StreamEvent] = []
+        buffer = self._buffer
+        buffer += chunk
+        end = buffer.rfind(b"\n", self._scanned)
+        if end < 0:
+            self._scanned = len(buffer)
+            return events
+
+        # 一次取出所有完整的行，由 bytes.split 在 C 层切分
+        lines = bytes(buffer[:end]).split(b"\n")
+        del buffer[:end + 1]
+        self._scanned = len(buffer)
+        parse_line = self._parse_line
+        for line in lines:
+            # SSE 事件之间的空行占一半，直接跳过
+            if line:
+                parse_line(line, events)
+        return events
+
+    def close(self) -> List[StreamEvent]:
+        """流结束，解析最后一行（没有换行结尾时）"""
+        events: List[StreamEvent] = []
+        if self._buffer:
+            self._parse_line(bytes(self._buffer), events)
+            self._buffer.clear()
+            self._scanned = 0
+        return events
+
+    def _parse_line(self, line: bytes, events: List[StreamEvent]):
+        """解析一行"""
+        if line[-1:] == b"\r":
+            line = line[:-1]
+        if not line:
+            return
+        self.lines += 1
+
+        if line[:6] == b"data: ":
+            raw_json = line[6:]
+        elif line[:5] == b"data:":
+            raw_json = line[5:]
+        else:
+            # 错误响应不是 SSE 格式，而是整行 JSON，如 {"code":"chat_choice_shown",...}
+            if line[:1] == b"{":
+                payload = self._loads(line)
+                if isinstance(payload, dict) and "code" in payload:
+                    events.append(ErrorCode(payload["code"], payload))
+            return
+
+        try:
+            payload = json_codec.loads(raw_json)
+        except ValueError:
+            if raw_json.strip():
+                self.malformed += 1
+            return
+        if payload.__class__ is not dict:
+            return
+
+        # 只要出现 msg_id 就更新，流最后一条通常是 assistmsg，也就是我们要的 ID
+        if "msg_id" in payload:
+            events.append(MessageId(payload["msg_id"]))
+
+        # 如果有 'c' 字段，说明是多分支内容
+        # 格式如: {"c":[{"v":"..."},{"v":"...","c":1}]}
+        choices = payload.get("c")
+        if choices.__class__ is list:
+            for choice in choices:
+                if choice.__class__ is not dict:
+                    continue
+                text = choice.get("v")
+                if text.__class__ is not str:
+                    continue
+                # 默认选项 idx=0，可能显式 c=0 或隐式(无 c 字段)
+                index = choice.get("c", 0)
+                events.append(ContentDelta(text) if index == 0 else BranchDelta(index, text))
+            return
+
+        # 常规内容 (兼容旧格式或无分支情况)
+        text = payload.get("v")
+        if text.__class__ is str:
+            events.append(ContentDelta(text))
+
+    def _loads(self, raw: bytes) -> Any:
+        """解析 JSON，空行和格式错误的行计数后忽略"""
+        try:
+            return json_codec.loads(raw)
+        except ValueError:
+            if raw.strip():
+                self.malformed += 1
+            return None
+
+
+async def parse_stream(chunks: AsyncIterable[bytes]) -> AsyncIterator[StreamEvent]:
+    """
+    解析上游字节流
+
+    Args:
+        chunks: 原始字节块，如 httpx 响应的 aiter_bytes()
+
+    Yields:
+        流事件
+    """
+    parser = StreamParser()
+    async for chunk in chunks:
+        for event in parser.feed(chunk):
+            yield event
+    for event in parser.close():
+        yield event
@@ -0,0 +1,74 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ASGI 服务入口（生产环境推荐）
+
+    python asgi.py
+    uvicorn asgi:app --host 0.0.0.0 --port 8000 --workers 4
+"""
+import os
+import tempfile
+
+import logging
+from logging.handlers import RotatingFileHandler
+
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+# 多进程模式下 /metrics 需要合并所有工作进程的指标，未设置共享目录时使用临时目录。
+# 必须在导入应用（创建指标注册表）之前设置，工作进程通过环境变量继承同一个目录
+if int(os.environ.get("WORKERS", "1")) > 1 and not os.environ.get("METRICS_DIR"):
+    os.environ["METRICS_DIR"] = os.path.join(
+        tempfile.gettempdir(), f"anuneko-metrics-{os.environ.get('FLASK_PORT', '8000')}"
+    )
+
+from app.asgi import create_app
+
+# 创建 ASGI 应用
+app = create_app()
+
+# 配置日志
+logger = logging.getLogger("anuneko-openai")
+log_path = os.environ.get("LOG_PATH", "logs")
+log_name = os.environ.get("LOG_NAME", "anuneko-openai")
+os.makedirs(log_path, exist_ok=True)
+
+file_handler = RotatingFileHandler(
+    f'{log_path}/{log_name}.log',
+    maxBytes=10240000,  # 10MB
+    backupCount=10
+)
+file_handler.setFormatter(logging.Formatter(
+    '[%(asctime)s] [%(levelname)s] %(message)s [in %(pathname)s:%(lineno)d]'
+))
+file_handler.setLevel(logging.INFO)
+logger.addHandler(file_handler)
+logger.setLevel(logging.INFO)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # 从环境变量获取配置
+    host = os.environ.get("FLASK_HOST", "0.0.0.0")
+    port = int(os.environ.get("FLASK_PORT", "8000"))
+    workers = int(os.environ.get("WORKERS", "1"))
+
+    logger.info('启动 OpenAI API 兼容服务器（ASGI）...')
+    logger.info(f"地址: http://{host}:{port}")
+    logger.info(f"工作进程数: {workers}")
+
+    # 检查环境变量
+    if not (os.environ.get("ANUNEKO_TOKEN") or os.environ.get("ANUNEKO_TOKENS")
+            or os.environ.get("ANUNEKO_ACCOUNTS_FILE")):
+        logger.error("⚠️ 警告: 未设置 ANUNEKO_TOKEN 环境变量")
+        logger.error("请设置 AnuNeko 账号 Token")
+
+    # 清理上次运行留下的多进程指标快照
+    from app.services.metrics import metrics_registry
+    metrics_registry.clear_directory()
+
+    # 多进程模式下每个工作进程各自导入应用，拥有独立的事件循环和上游连接池
+    uvicorn.run("asgi:app", host=host, port=port, workers=workers, log_level="info")
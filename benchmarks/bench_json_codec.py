@@ -0,0 +1,92 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+JSON 后端性能测试
+
+在真实的数据形状上对比已安装的 JSON 后端：上游 SSE 片段的解析、
+流式数据块和完整聊天响应的编码，输出每次操作的平均耗时
+
+    python benchmarks/bench_json_codec.py
+    python benchmarks/bench_json_codec.py --number 200000
+"""
+
+import os
+import sys
+import time
+import uuid
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.json_codec import BACKENDS, load_codec
+
+SESSION_ID = str(uuid.uuid4())
+
+# 上游 SSE 的 data 部分
+UPSTREAM_DELTA = '{"v":"喵～今天天气真好，"}'.encode("utf-8")
+UPSTREAM_BRANCHES = '{"c":[{"v":"喵～今天天气真好，"},{"v":"今天也要加油哦","c":1}]}'.encode("utf-8")
+
+# 流式数据块
+CHUNK = {
+    "id": "chatcmpl-1a2b3c4d",
+    "object": "chat.completion.chunk",
+    "created": 1700000000,
+    "model": "mihoyo-orange_cat",
+    "choices": [{"index": 0, "delta": {"content": "喵～今天天气真好，"}, "finish_reason": None}],
+    "session_id": SESSION_ID
+}
+
+# 完整的非流式响应
+RESPONSE = {
+    "id": "chatcmpl-1a2b3c4d",
+    "object": "chat.completion",
+    "created": 1700000000,
+    "model": "mihoyo-orange_cat",
+    "choices": [{
+        "index": 0,
+        "message": {"role": "assistant", "content": "喵～今天天气真好，一起出去晒太阳吧！" * 40},
+        "finish_reason": "stop"
+    }],
+    "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    "session_id": SESSION_ID
+}
+
+CASES = [
+    ("解析上游片段", "loads", UPSTREAM_DELTA),
+    ("解析上游多分支片段", "loads", UPSTREAM_BRANCHES),
+    ("编码流式数据块", "dumps_bytes", CHUNK),
+    ("编码完整响应", "dumps_bytes", RESPONSE),
+]
+
+
+def measure(func, arg, number: int) -> float:
+    """返回每次操作的耗时（微秒），取三轮中最好的一轮"""
+    best = float("inf")
+    for _ in range(3):
+        started = time.perf_counter()
+        for _ in range(number):
+            func(arg)
+        best = min(best, time.perf_counter() - started)
+    return best / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON 后端性能测试")
+    parser.add_argument("--number", type=int, default=50000, help="每轮操作次数")
+    args = parser.parse_args()
+
+    codecs = []
+    for name in BACKENDS:
+        try:
+            codecs.append(load_codec(name))
+        except ImportError:
+            print(f"{name}: 未安装，跳过")
+
+    print(f"{'':<20}" + "".join(f"{codec.name:>12}" for codec in codecs))
+    for title, method, arg in CASES:
+        timings = [measure(getattr(codec, method), arg, args.number) for codec in codecs]
+        print(f"{title:<16}" + "".join(f"{t:>10.2f}µs" for t in timings))
+
+
+if __name__ == "__main__":
+    main()
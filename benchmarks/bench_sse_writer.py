@@ -0,0 +1,101 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SSE 编码性能测试
+
+对比每个片段都完整 json.dumps 的旧实现和预编码外层结构的 SSEWriter，
+输出每个片段的平均耗时，以及开启合并后的写入次数
+
+    python benchmarks/bench_sse_writer.py
+    python benchmarks/bench_sse_writer.py --tokens 100000 --interval-ms 2 --coalesce-ms 20
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.sse_writer import SSEWriter
+
+MODEL = "mihoyo-orange_cat"
+SESSION_ID = str(uuid.uuid4())
+
+
+def legacy_chunk(model: str, content: str, session_id: str) -> str:
+    """旧实现：每个片段生成新的 ID 和时间戳并完整编码"""
+    chunk = {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "delta": {
+                    "content": content
+                },
+                "finish_reason": None
+            }
+        ]
+    }
+    if session_id:
+        chunk["session_id"] = session_id
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+
+def bench_encode(tokens):
+    """返回 (旧实现, SSEWriter) 每个片段的耗时（微秒）"""
+    started = time.perf_counter()
+    for token in tokens:
+        legacy_chunk(MODEL, token, SESSION_ID)
+    legacy = (time.perf_counter() - started) / len(tokens) * 1e6
+
+    started = time.perf_counter()
+    writer = SSEWriter(MODEL, SESSION_ID, coalesce_ms=0)
+    for token in tokens:
+        writer.delta(token)
+    current = (time.perf_counter() - started) / len(tokens) * 1e6
+    return legacy, current
+
+
+async def bench_coalesce(tokens, interval_ms: float, coalesce_ms: float):
+    """按固定间隔产生片段，返回 (写入次数, 输出字节数)"""
+    async def upstream():
+        for token in tokens:
+            yield token
+            await asyncio.sleep(interval_ms / 1000)
+
+    writer = SSEWriter(MODEL, SESSION_ID, coalesce_ms=coalesce_ms)
+    writes = 0
+    size = 0
+    async for piece in writer.coalesce(upstream()):
+        writes += 1
+        size += len(writer.delta(piece).encode("utf-8"))
+    return writes, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SSE 编码性能测试")
+    parser.add_argument("--tokens", type=int, default=100000, help="编码测试的片段数")
+    parser.add_argument("--stream-tokens", type=int, default=500, help="合并测试的片段数")
+    parser.add_argument("--interval-ms", type=float, default=2, help="合并测试中上游片段的间隔（毫秒）")
+    parser.add_argument("--coalesce-ms", type=float, default=20, help="合并窗口（毫秒）")
+    args = parser.parse_args()
+
+    tokens = [f"喵～第 {i} 个 token\n" for i in range(args.tokens)]
+    legacy, current = bench_encode(tokens)
+    print(f"每个片段编码耗时: 旧实现 {legacy:.2f} µs，SSEWriter {current:.2f} µs（{legacy / current:.1f}x）")
+
+    stream_tokens = tokens[:args.stream_tokens]
+    for coalesce_ms in (0, args.coalesce_ms):
+        writes, size = asyncio.run(bench_coalesce(stream_tokens, args.interval_ms, coalesce_ms))
+        print(f"合并窗口 {coalesce_ms:g} ms: {len(stream_tokens)} 个片段 -> {writes} 次写入，{size / 1024:.1f} KB")
+
+
+if __name__ == "__main__":
+    main()
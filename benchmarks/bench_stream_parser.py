@@ -0,0 +1,121 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游流解析性能测试
+
+生成模拟的 AnuNeko SSE 流，按固定大小切成字节块后交给解析器，输出吞吐量（MB/s）。
+同时给出 aiter_lines 逐行解析、字符串拼接的旧实现作为对照
+
+    python benchmarks/bench_stream_parser.py
+    python benchmarks/bench_stream_parser.py --events 50000 --chunk-size 1024
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.stream_parser import ContentDelta, parse_stream
+
+
+def build_stream(events: int, branches: bool) -> bytes:
+    """生成模拟的上游 SSE 流"""
+    lines = []
+    for i in range(events):
+        text = f"喵～这是第 {i} 段回复 token "
+        if branches:
+            payload = {"c": [{"v": text}, {"v": text, "c": 1}]}
+        else:
+            payload = {"v": text}
+        lines.append("data: " + json.dumps(payload, ensure_ascii=False))
+        lines.append("")
+    lines.append("data: " + json.dumps({"msg_id": "00000000-0000-0000-0000-000000000000"}))
+    lines.append("")
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def split_chunks(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class ChunkStream(httpx.AsyncByteStream):
+    """按给定字节块返回的响应流，模拟上游网络读取"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+async def run_parser(chunks) -> str:
+    """当前实现：aiter_bytes + 增量解析器 + 列表拼接"""
+    resp = httpx.Response(200, stream=ChunkStream(chunks))
+    parts = []
+    async for event in parse_stream(resp.aiter_bytes()):
+        if isinstance(event, ContentDelta):
+            parts.append(event.text)
+    return "".join(parts)
+
+
+async def run_legacy(chunks) -> str:
+    """旧实现：aiter_lines 逐行处理，字符串逐段拼接"""
+    resp = httpx.Response(200, stream=ChunkStream(chunks))
+    result = ""
+    async for line in resp.aiter_lines():
+        if not line:
+            continue
+        if not line.startswith("data: "):
+            continue
+        try:
+            raw_json = line[6:]
+            if not raw_json.strip():
+                continue
+            j = json.loads(raw_json)
+            if "c" in j and isinstance(j["c"], list):
+                for choice in j["c"]:
+                    if choice.get("c", 0) == 0 and "v" in choice:
+                        result += choice["v"]
+            elif "v" in j and isinstance(j["v"], str):
+                result += j["v"]
+        except:
+            continue
+    return result
+
+
+def measure(func, chunks, size: int, repeat: int) -> float:
+    """返回最好一次的吞吐量（MB/s）"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        asyncio.run(func(chunks))
+        best = min(best, time.perf_counter() - started)
+    return size / best / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="上游流解析性能测试")
+    parser.add_argument("--events", type=int, default=20000, help="回复片段数")
+    parser.add_argument("--chunk-size", type=int, default=4096, help="字节块大小")
+    parser.add_argument("--repeat", type=int, default=5, help="重复次数，取最好一次")
+    parser.add_argument("--branches", action="store_true", help="使用多分支格式")
+    args = parser.parse_args()
+
+    data = build_stream(args.events, args.branches)
+    chunks = split_chunks(data, args.chunk_size)
+    assert asyncio.run(run_parser(chunks)) == asyncio.run(run_legacy(chunks))
+
+    print(f"流大小: {len(data) / 1024 / 1024:.2f} MB，{args.events} 个片段，块大小 {args.chunk_size} 字节")
+    print(f"StreamParser: {measure(run_parser, chunks, len(data), args.repeat):8.1f} MB/s")
+    print(f"旧实现:       {measure(run_legacy, chunks, len(data), args.repeat):8.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
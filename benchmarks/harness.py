@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+性能测试公共工具
+
+启动模拟上游与代理进程、读取进程 CPU / 内存、以 OpenAI 客户端的方式发送请求并记录耗时
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import tempfile
+import subprocess
+from typing import Any, Dict, List, Optional, Sequence
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL = "mihoyo-orange_cat"
+
+
+def free_port() -> int:
+    """取得一个空闲的本地端口"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(url: str, process: subprocess.Popen, timeout: float = 30):
+    """轮询直到地址可以访问"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"进程已退出（{process.returncode}）：{' '.join(process.args)}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"等待 {url} 超时")
+
+
+def start_mock(port: int, mock_args: Sequence[str] = ()) -> subprocess.Popen:
+    """启动模拟上游"""
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "benchmarks", "mock_upstream.py"), "--port", str(port), *mock_args],
+        cwd=ROOT
+    )
+    wait_ready(f"http://127.0.0.1:{port}/mock/stats", process)
+    return process
+
+
+def start_proxy(server: str, port: int, upstream: str, env: Optional[Dict[str, str]] = None) -> subprocess.Popen:
+    """
+    启动指向模拟上游的代理
+
+    Args:
+        server: asgi（uvicorn 单进程）或 flask（Flask 开发服务器）
+        port: 监听端口
+        upstream: 模拟上游地址
+        env: 额外的环境变量
+    """
+    proxy_env = dict(os.environ)
+    proxy_env.update({
+        "ANUNEKO_BASE_URL": upstream,
+        "ANUNEKO_TOKEN": proxy_env.get("ANUNEKO_TOKEN") or "mock",
+        "FLASK_HOST": "127.0.0.1",
+        "FLASK_PORT": str(port),
+        # 日志写到临时目录，不在仓库中留下文件
+        "LOG_PATH": os.path.join(tempfile.gettempdir(), "anuneko-benchmark-logs"),
+    })
+    proxy_env.update(env or {})
+    if server == "asgi":
+        command = [sys.executable, "-m", "uvicorn", "asgi:app", "--host", "127.0.0.1", "--port", str(port),
+                   "--log-level", "warning"]
+    elif server == "flask":
+        command = [sys.executable, "app.py"]
+    else:
+        raise ValueError(f"未知的服务器类型: {server}")
+    process = subprocess.Popen(command, cwd=ROOT, env=proxy_env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_ready(f"http://127.0.0.1:{port}/health", process)
+    return process
+
+
+def stop(process: Optional[subprocess.Popen]):
+    """结束进程"""
+    if process is None or process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def cpu_seconds(pid: int) -> Optional[float]:
+    """进程累计使用的 CPU 时间（用户态 + 内核态），仅支持 Linux"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    # 去掉 pid 和进程名后，utime、stime 为第 12、13 个字段
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def memory_kb(pid: int) -> Dict[str, Optional[int]]:
+    """进程当前和峰值常驻内存（KB），仅支持 Linux"""
+    usage: Dict[str, Optional[int]] = {"rss_kb": None, "peak_rss_kb": None}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    usage["rss_kb"] = int(line.split()[1])
+                elif line.startswith("VmHWM:"):
+                    usage["peak_rss_kb"] = int(line.split()[1])
+    except OSError:
+        pass
+    return usage
+
+
+def percentile(values: Sequence[float], q: float) -> Optional[float]:
+    """线性插值的百分位数，q 取 0-100"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(values: Sequence[float], scale: float = 1000) -> Dict[str, Optional[float]]:
+    """p50 / p95 / p99 / 平均值，默认把秒换算为毫秒"""
+    def scaled(value: Optional[float]) -> Optional[float]:
+        return None if value is None else round(value * scale, 3)
+
+    return {
+        "p50": scaled(percentile(values, 50)),
+        "p95": scaled(percentile(values, 95)),
+        "p99": scaled(percentile(values, 99)),
+        "mean": scaled(sum(values) / len(values)) if values else None,
+        "count": len(values)
+    }
+
+
+async def chat_completion(client: httpx.AsyncClient, base_url: str, content: str, stream: bool,
+                          model: str = MODEL) -> Dict[str, Any]:
+    """
+    以 OpenAI 客户端的方式发送一次聊天请求
+
+    流式请求在收到 data: [DONE] 时结束计时并断开，与常见客户端的行为一致
+
+    Returns:
+        ok、status、ttft（秒，非流式为完整耗时）、latency（秒）、gaps（相邻数据块的间隔，秒）、chunks、error
+    """
+    payload = {"model": model, "stream": stream, "messages": [{"role": "user", "content": content}]}
+    url = f"{base_url}/v1/chat/completions"
+    result: Dict[str, Any] = {"ok": False, "status": None, "ttft": None, "latency": None, "gaps": [],
+                              "chunks": 0, "error": None}
+    started = time.perf_counter()
+    try:
+        if not stream:
+            resp = await client.post(url, json=payload)
+            result["status"] = resp.status_code
+            result["latency"] = result["ttft"] = time.perf_counter() - started
+            result["ok"] = resp.status_code == 200
+            if result["ok"]:
+                result["chunks"] = 1
+            else:
+                result["error"] = f"HTTP {resp.status_code}"
+            return result
+
+        async with client.stream("POST", url, json=payload) as resp:
+            result["status"] = resp.status_code
+            if resp.status_code != 200:
+                await resp.aread()
+                result["error"] = f"HTTP {resp.status_code}"
+                return result
+            last = None
+            gaps: List[float] = result["gaps"]
+            async for line in resp.aiter_lines():
+                if line == "data: [DONE]":
+                    result["ok"] = True
+                    break
+                if not line.startswith("data: ") or '"content"' not in line:
+                    continue
+                now = time.perf_counter()
+                if last is None:
+                    result["ttft"] = now - started
+                else:
+                    gaps.append(now - last)
+                last = now
+                result["chunks"] += 1
+            else:
+                result["error"] = "流在 [DONE] 之前结束"
+            result["latency"] = time.perf_counter() - started
+    except httpx.HTTPError as e:
+        result["error"] = type(e).__name__
+        result["latency"] = time.perf_counter() - started
+    return result
+
+
+async def closed_loop(make_request, total: int, concurrency: int) -> List[Dict[str, Any]]:
+    """
+    固定并发发送请求：concurrency 个客户端各自在上一个请求结束后立即发送下一个
+
+    Args:
+        make_request: 协程函数，参数为请求序号，返回 chat_completion 的结果
+        total: 请求总数
+        concurrency: 并发客户端数
+    """
+    results: List[Dict[str, Any]] = []
+    indexes = iter(range(total))
+
+    async def client():
+        for index in indexes:
+            results.append(await make_request(index))
+
+    await asyncio.gather(*(client() for _ in range(max(1, min(concurrency, total)))))
+    return results
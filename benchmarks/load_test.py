@@ -0,0 +1,241 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+并发负载测试
+
+以 OpenAI 客户端的方式向服务器发送流式和非流式请求，支持两种负载模型：
+
+- 开环（--rate）：按固定到达率发送请求，不等待之前的请求完成，能反映排队造成的延迟
+- 闭环（--concurrency）：固定数量的客户端，每个客户端在上一个请求结束后立即发送下一个
+
+输出每一档负载的 TTFT、相邻数据块间隔和完整耗时的 p50/p95/p99、错误率和实际吞吐，
+给出多档负载（--sweep）时找出饱和点：错误率超标、p99 TTFT 超过 --slo-ttft-ms、
+开环实际吞吐低于到达率的 90% 或闭环吞吐不再增长的第一档
+
+    python benchmarks/load_test.py --url http://127.0.0.1:8000 --rate 20 --duration 30
+    python benchmarks/load_test.py --url http://127.0.0.1:8000 --concurrency 50 --stream-ratio 0.5
+    python benchmarks/load_test.py --mock --sweep 10,20,40,80 --duration 15 --slo-ttft-ms 500
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import chat_completion, free_port, start_mock, start_proxy, stop, summarize
+
+# 开环模式下实际吞吐低于到达率的该比例即视为饱和
+OPEN_LOOP_SATURATION = 0.9
+# 闭环模式下吞吐增长低于该比例即视为饱和
+CLOSED_LOOP_MIN_GAIN = 0.05
+
+
+class LoadTest:
+    """一次负载测试"""
+
+    def __init__(self, args: argparse.Namespace, base_url: str):
+        self.args = args
+        self.base_url = base_url
+        self.run_id = uuid.uuid4().hex[:8]
+        self._sequence = 0
+
+    def _content(self) -> str:
+        self._sequence += 1
+        if self.args.same_prompt:
+            return "load test"
+        # 每个请求内容不同，避免命中响应缓存或被合并
+        return f"load test {self.run_id} {self._sequence}"
+
+    async def _one(self, client: httpx.AsyncClient) -> Dict[str, Any]:
+        stream = random.random() < self.args.stream_ratio
+        result = await chat_completion(client, self.base_url, self._content(), stream, self.args.model)
+        result["stream"] = stream
+        return result
+
+    async def open_loop(self, client: httpx.AsyncClient, rate: float) -> Dict[str, Any]:
+        """按固定到达率（或 --poisson 时的泊松到达）发送请求，持续 duration 秒"""
+        duration = self.args.duration
+        tasks: List[asyncio.Task] = []
+        skipped = 0
+        started = time.perf_counter()
+        next_arrival = 0.0
+        while next_arrival < duration:
+            delay = started + next_arrival - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            inflight = sum(1 for task in tasks if not task.done())
+            if inflight >= self.args.max_inflight:
+                # 客户端自身的上限，超出时记为未发送，避免压测进程被拖垮
+                skipped += 1
+            else:
+                tasks.append(asyncio.ensure_future(self._one(client)))
+            next_arrival += random.expovariate(rate) if self.args.poisson else 1 / rate
+        sent_wall = time.perf_counter() - started
+        results = await asyncio.gather(*tasks)
+        wall = time.perf_counter() - started
+        summary = self.summarize(results, wall)
+        summary.update({"offered_rps": rate, "sent_seconds": round(sent_wall, 3), "skipped": skipped})
+        return summary
+
+    async def closed_loop(self, client: httpx.AsyncClient, concurrency: int) -> Dict[str, Any]:
+        """concurrency 个客户端持续发送请求 duration 秒"""
+        deadline = time.perf_counter() + self.args.duration
+        results: List[Dict[str, Any]] = []
+
+        async def user():
+            while time.perf_counter() < deadline:
+                results.append(await self._one(client))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user() for _ in range(concurrency)))
+        summary = self.summarize(results, time.perf_counter() - started)
+        summary["concurrency"] = concurrency
+        return summary
+
+    def summarize(self, results: List[Dict[str, Any]], wall: float) -> Dict[str, Any]:
+        ok = [r for r in results if r["ok"]]
+        streams = [r for r in ok if r["stream"]]
+        errors: Dict[str, int] = {}
+        for r in results:
+            if not r["ok"]:
+                key = r.get("error") or "unknown"
+                errors[key] = errors.get(key, 0) + 1
+        return {
+            "requests": len(results),
+            "stream_requests": sum(1 for r in results if r["stream"]),
+            "errors": len(results) - len(ok),
+            "error_rate": round((len(results) - len(ok)) / len(results), 4) if results else 0.0,
+            "error_types": errors,
+            "wall_seconds": round(wall, 3),
+            "throughput_rps": round(len(ok) / wall, 2) if wall else 0.0,
+            "ttft_ms": summarize([r["ttft"] for r in streams if r["ttft"] is not None]),
+            "inter_chunk_gap_ms": summarize([gap for r in streams for gap in r["gaps"]]),
+            "latency_ms": summarize([r["latency"] for r in ok]),
+            "stream_latency_ms": summarize([r["latency"] for r in streams]),
+            "json_latency_ms": summarize([r["latency"] for r in ok if not r["stream"]]),
+        }
+
+    def saturated(self, summary: Dict[str, Any], previous: Optional[Dict[str, Any]]) -> Optional[str]:
+        """判断一档负载是否已饱和，返回原因"""
+        args = self.args
+        if summary["error_rate"] > args.max_error_rate:
+            return f"错误率 {summary['error_rate']:.2%} 超过 {args.max_error_rate:.2%}"
+        p99 = summary["ttft_ms"]["p99"]
+        if args.slo_ttft_ms and p99 is not None and p99 > args.slo_ttft_ms:
+            return f"p99 TTFT {p99} ms 超过 {args.slo_ttft_ms} ms"
+        if "offered_rps" in summary:
+            if summary["skipped"] or summary["throughput_rps"] < summary["offered_rps"] * OPEN_LOOP_SATURATION:
+                return f"实际吞吐 {summary['throughput_rps']} req/s 低于到达率 {summary['offered_rps']} req/s"
+        elif previous is not None and previous["throughput_rps"]:
+            gain = summary["throughput_rps"] / previous["throughput_rps"] - 1
+            if gain < CLOSED_LOOP_MIN_GAIN:
+                return f"吞吐仅增长 {gain:.1%}"
+        return None
+
+    async def run(self) -> Dict[str, Any]:
+        args = self.args
+        open_loop = not args.concurrency
+        if args.sweep:
+            steps = [float(step) if open_loop else int(step) for step in args.sweep.split(",")]
+        else:
+            steps = [args.rate if open_loop else args.concurrency]
+
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=args.max_inflight)
+        report: Dict[str, Any] = {"steps": [], "saturation": None, "max_sustainable": None}
+        previous = None
+        async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(args.timeout)) as client:
+            for step in steps:
+                if open_loop:
+                    summary = await self.open_loop(client, step)
+                else:
+                    summary = await self.closed_loop(client, step)
+                reason = self.saturated(summary, previous)
+                summary["saturated"] = reason
+                report["steps"].append(summary)
+                print_step(summary)
+                if reason:
+                    report["saturation"] = {"step": step, "reason": reason}
+                    break
+                report["max_sustainable"] = step
+                previous = summary
+        report["model"] = "open" if open_loop else "closed"
+        return report
+
+
+def print_step(summary: Dict[str, Any]):
+    load = (f"到达率 {summary['offered_rps']} req/s" if "offered_rps" in summary
+            else f"并发 {summary['concurrency']}")
+    ttft, gap, latency = summary["ttft_ms"], summary["inter_chunk_gap_ms"], summary["latency_ms"]
+    print(f"{load}: 吞吐 {summary['throughput_rps']} req/s，请求 {summary['requests']}，"
+          f"错误率 {summary['error_rate']:.2%}")
+    print(f"  TTFT      p50 {ttft['p50']}  p95 {ttft['p95']}  p99 {ttft['p99']} ms")
+    print(f"  片段间隔  p50 {gap['p50']}  p95 {gap['p95']}  p99 {gap['p99']} ms")
+    print(f"  完整耗时  p50 {latency['p50']}  p95 {latency['p95']}  p99 {latency['p99']} ms")
+    if summary["saturated"]:
+        print(f"  已饱和：{summary['saturated']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI 兼容服务器的并发负载测试")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="被测服务器地址，如 http://127.0.0.1:8000")
+    target.add_argument("--mock", action="store_true", help="自动启动本地模拟上游和指向它的服务器")
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument("--rate", type=float, help="开环：每秒到达的请求数")
+    load.add_argument("--concurrency", type=int, help="闭环：并发客户端数")
+    parser.add_argument("--sweep", help="逐档增加的负载，逗号分隔；配合 --concurrency 时为并发数，否则为到达率")
+    parser.add_argument("--duration", type=float, default=30, help="每档负载的持续时间（秒）")
+    parser.add_argument("--poisson", action="store_true", help="开环模式按泊松过程到达，默认为固定间隔")
+    parser.add_argument("--stream-ratio", type=float, default=1.0, help="流式请求的比例（0-1）")
+    parser.add_argument("--model", default="mihoyo-orange_cat")
+    parser.add_argument("--same-prompt", action="store_true", help="所有请求使用相同内容（测试响应缓存与请求合并）")
+    parser.add_argument("--timeout", type=float, default=120, help="单个请求的超时（秒）")
+    parser.add_argument("--max-inflight", type=int, default=1000, help="开环模式下客户端同时进行的请求上限")
+    parser.add_argument("--max-error-rate", type=float, default=0.01, help="判断饱和的错误率上限")
+    parser.add_argument("--slo-ttft-ms", type=float, default=None, help="判断饱和的 p99 TTFT 上限（毫秒）")
+    parser.add_argument("--server", choices=("asgi", "flask"), default="asgi", help="--mock 时启动的服务器模式")
+    parser.add_argument("--mock-args", default="", help="--mock 时传给模拟上游的参数，如 \"--tokens 100\"")
+    parser.add_argument("--output", help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+    if not args.rate and not args.concurrency and not args.sweep:
+        parser.error("需要 --rate、--concurrency 或 --sweep")
+
+    mock = proxy = None
+    try:
+        if args.mock:
+            mock_port, proxy_port = free_port(), free_port()
+            mock = start_mock(mock_port, args.mock_args.split())
+            proxy = start_proxy(args.server, proxy_port, f"http://127.0.0.1:{mock_port}")
+            base_url = f"http://127.0.0.1:{proxy_port}"
+        else:
+            base_url = args.url.rstrip("/")
+        report = asyncio.run(LoadTest(args, base_url).run())
+    finally:
+        stop(proxy)
+        stop(mock)
+
+    if report["saturation"]:
+        print(f"\n饱和点：{report['saturation']['step']}（{report['saturation']['reason']}），"
+              f"最大可持续负载：{report['max_sustainable']}")
+    else:
+        print(f"\n未达到饱和，最大测试负载：{report['max_sustainable']}")
+
+    if args.output:
+        report["config"] = {key: value for key, value in vars(args).items() if key != "output"}
+        report["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
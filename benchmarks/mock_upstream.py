@@ -0,0 +1,189 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地模拟 AnuNeko 上游
+
+提供创建会话、流式消息、选择分支、切换模型和模型列表接口，
+用于在不访问 anuneko.com 的情况下测量代理自身的开销。服务器通过 ANUNEKO_BASE_URL 指向它：
+
+    python benchmarks/mock_upstream.py --port 8900 --tokens 50 --tokens-per-second 100
+    ANUNEKO_BASE_URL=http://127.0.0.1:8900 ANUNEKO_TOKEN=mock python asgi.py
+
+可配置控制接口延迟（及按比例出现的慢响应）、首个片段延迟、输出速度、多分支（c）片段和错误：
+--error-code 为数字时返回该 HTTP 状态码，否则在流中返回 {"code": ...} 错误行（如 chat_choice_shown）
+"""
+
+import os
+import sys
+import time
+import uuid
+import random
+import asyncio
+import argparse
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+
+from app.services import json_codec
+
+MODELS = ["Orange Cat", "Exotic Shorthair"]
+# 可以注入错误的接口
+CALLS = ("chat", "stream", "select_choice", "select_model", "view")
+
+
+class MockConfig:
+    """模拟上游的行为配置"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.latency = args.latency_ms / 1000
+        self.slow_rate = args.slow_rate
+        self.slow = args.slow_ms / 1000
+        self.first_token = (args.first_token_ms if args.first_token_ms is not None else args.latency_ms) / 1000
+        self.tokens = args.tokens
+        self.tokens_per_second = args.tokens_per_second
+        self.token_text = args.token_text
+        self.branch_every = args.branch_every
+        self.error_rate = args.error_rate
+        self.error_code = args.error_code
+        self.error_calls = set(args.error_calls.split(","))
+        self.stats: Dict[str, int] = {call: 0 for call in CALLS}
+        self.stats["errors"] = 0
+        self.stats["slow"] = 0
+        self.stats["tokens"] = 0
+
+    def control_delay(self) -> float:
+        """控制接口的延迟，按 slow_rate 的概率返回慢响应的延迟"""
+        if self.slow_rate > 0 and random.random() < self.slow_rate:
+            self.stats["slow"] += 1
+            return self.slow
+        return self.latency
+
+    def should_fail(self, call: str) -> bool:
+        if self.error_rate <= 0 or call not in self.error_calls or random.random() >= self.error_rate:
+            return False
+        self.stats["errors"] += 1
+        return True
+
+    @property
+    def http_error(self) -> bool:
+        return self.error_code.isdigit()
+
+
+def json_response(payload: Any, status_code: int = 200) -> Response:
+    return Response(json_codec.dumps_bytes(payload), status_code=status_code, media_type="application/json")
+
+
+def error_response(config: MockConfig) -> Response:
+    if config.http_error:
+        return json_response({"code": int(config.error_code), "msg": "mock error"}, int(config.error_code))
+    return json_response({"code": config.error_code, "msg": "mock error"})
+
+
+def build_app(config: MockConfig) -> Starlette:
+    """创建模拟上游应用"""
+
+    async def control(call: str, payload: Any) -> Response:
+        config.stats[call] += 1
+        delay = config.control_delay()
+        if delay:
+            await asyncio.sleep(delay)
+        if config.should_fail(call):
+            return error_response(config)
+        return json_response(payload)
+
+    async def create_chat(request: Request):
+        await request.body()
+        return await control("chat", {"chat_id": uuid.uuid4().hex})
+
+    async def select_model(request: Request):
+        await request.body()
+        return await control("select_model", {"code": 0})
+
+    async def select_choice(request: Request):
+        await request.body()
+        return await control("select_choice", {"code": 0})
+
+    async def user_view(request: Request):
+        return await control("view", {"models": MODELS})
+
+    async def stream(request: Request):
+        config.stats["stream"] += 1
+        await request.body()
+        if config.should_fail("stream"):
+            if config.http_error:
+                return error_response(config)
+            body = json_codec.dumps_bytes({"code": config.error_code, "msg": "mock error"}) + b"\n"
+            return Response(body, media_type="text/event-stream")
+        return StreamingResponse(generate(), media_type="text/event-stream")
+
+    async def generate():
+        """按 tokens_per_second 的速度输出片段，落后于计划时一次输出所有到期的片段"""
+        token = config.token_text
+        if config.first_token:
+            await asyncio.sleep(config.first_token)
+        started = time.perf_counter()
+        interval = 1 / config.tokens_per_second if config.tokens_per_second > 0 else 0
+        sent = 0
+        while sent < config.tokens:
+            due = config.tokens if not interval else min(
+                config.tokens, int((time.perf_counter() - started) / interval) + 1
+            )
+            lines: List[bytes] = []
+            while sent < due:
+                sent += 1
+                if config.branch_every and sent % config.branch_every == 0:
+                    payload = {"c": [{"v": token}, {"v": token, "c": 1}]}
+                else:
+                    payload = {"v": token}
+                lines.append(b"data: " + json_codec.dumps_bytes(payload) + b"\n\n")
+            config.stats["tokens"] += len(lines)
+            yield b"".join(lines)
+            if sent < config.tokens and interval:
+                await asyncio.sleep(max(0.0, started + sent * interval - time.perf_counter()))
+        yield b"data: " + json_codec.dumps_bytes({"msg_id": uuid.uuid4().hex}) + b"\n\n"
+
+    async def mock_stats(request: Request):
+        return json_response(config.stats)
+
+    return Starlette(routes=[
+        Route("/api/v1/chat", create_chat, methods=["POST"]),
+        Route("/api/v1/msg/select-choice", select_choice, methods=["POST"]),
+        Route("/api/v1/msg/{uuid}/stream", stream, methods=["POST"]),
+        Route("/api/v1/user/select_model", select_model, methods=["POST"]),
+        Route("/api/v1/user/view", user_view, methods=["GET"]),
+        Route("/mock/stats", mock_stats, methods=["GET"]),
+    ])
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="本地模拟 AnuNeko 上游")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency-ms", type=float, default=20, help="控制接口（创建会话、切换模型等）的延迟")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="控制接口返回慢响应的概率（0-1）")
+    parser.add_argument("--slow-ms", type=float, default=2000, help="慢响应的延迟")
+    parser.add_argument("--first-token-ms", type=float, default=None, help="首个片段的延迟，默认与 --latency-ms 相同")
+    parser.add_argument("--tokens", type=int, default=50, help="每次回复的片段数")
+    parser.add_argument("--tokens-per-second", type=float, default=100, help="输出速度，0 表示一次输出全部片段")
+    parser.add_argument("--token-text", default="喵", help="每个片段的文本")
+    parser.add_argument("--branch-every", type=int, default=0, help="每隔多少个片段输出一次多分支（c）片段，0 表示不输出")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="注入错误的概率（0-1）")
+    parser.add_argument("--error-code", default="500", help="HTTP 状态码，或流中返回的上游错误码如 chat_choice_shown")
+    parser.add_argument("--error-calls", default="stream", help=f"注入错误的接口，逗号分隔：{','.join(CALLS)}")
+    return parser.parse_args(argv)
+
+
+def main():
+    import uvicorn
+
+    args = parse_args()
+    uvicorn.run(build_app(MockConfig(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
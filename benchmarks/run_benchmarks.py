@@ -0,0 +1,221 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+代理性能测试
+
+启动本地模拟上游（benchmarks/mock_upstream.py）和指向它的代理，分别测量流式和非流式请求的
+吞吐量、首个片段延迟（TTFT）相对直连上游的额外开销、每个片段消耗的代理 CPU 时间和内存占用，
+结果写入 JSON 文件，便于不同版本之间对比
+
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --server flask --requests 500 --concurrency 32
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/20260101-120000.json
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import platform
+import subprocess
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import (ROOT, chat_completion, closed_loop, cpu_seconds, free_port, memory_kb, start_mock,
+                     start_proxy, stop, summarize)
+
+MODES = ("stream", "json")
+
+
+async def direct_stream(client: httpx.AsyncClient, upstream: str) -> Dict[str, Any]:
+    """直连模拟上游：创建会话后发送消息，TTFT 从发送消息开始计时"""
+    resp = await client.post(f"{upstream}/api/v1/chat", json={"model": "Orange Cat"})
+    chat_id = resp.json()["chat_id"]
+    result: Dict[str, Any] = {"ok": False, "ttft": None, "latency": None}
+    started = time.perf_counter()
+    async with client.stream("POST", f"{upstream}/api/v1/msg/{chat_id}/stream",
+                             json={"contents": ["benchmark"]}) as stream:
+        async for line in stream.aiter_lines():
+            if line.startswith("data: ") and result["ttft"] is None:
+                result["ttft"] = time.perf_counter() - started
+    result["latency"] = time.perf_counter() - started
+    result["ok"] = result["ttft"] is not None
+    return result
+
+
+def report(results: List[Dict[str, Any]], wall: float, tokens_per_reply: int) -> Dict[str, Any]:
+    """汇总一组请求的结果"""
+    ok = [r for r in results if r["ok"]]
+    errors: Dict[str, int] = {}
+    for r in results:
+        if not r["ok"]:
+            errors[r.get("error") or "unknown"] = errors.get(r.get("error") or "unknown", 0) + 1
+    gaps = [gap for r in ok for gap in r.get("gaps", [])]
+    return {
+        "requests": len(results),
+        "errors": sum(errors.values()),
+        "error_rate": round(sum(errors.values()) / len(results), 4) if results else 0.0,
+        "error_types": errors,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(ok) / wall, 2) if wall else None,
+        "tokens_per_second": round(len(ok) * tokens_per_reply / wall, 1) if wall else None,
+        "ttft_ms": summarize([r["ttft"] for r in ok if r["ttft"] is not None]),
+        "latency_ms": summarize([r["latency"] for r in ok]),
+        "inter_chunk_gap_ms": summarize(gaps),
+    }
+
+
+def overhead(proxy: Dict[str, Optional[float]], direct: Dict[str, Optional[float]]) -> Dict[str, Optional[float]]:
+    """代理相对直连的额外耗时（毫秒）"""
+    return {
+        q: round(proxy[q] - direct[q], 3) if proxy.get(q) is not None and direct.get(q) is not None else None
+        for q in ("p50", "p95", "p99", "mean")
+    }
+
+
+async def run_suite(args: argparse.Namespace, upstream: str, proxy_url: str, proxy_pid: int) -> Dict[str, Any]:
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+    timeout = httpx.Timeout(args.timeout)
+    suite: Dict[str, Any] = {}
+    run_id = uuid.uuid4().hex[:8]
+
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        # 直连上游的基准，扣除后即为代理自身的开销
+        started = time.perf_counter()
+        direct = await closed_loop(lambda i: direct_stream(client, upstream), args.requests, args.concurrency)
+        suite["direct"] = report(direct, time.perf_counter() - started, args.tokens)
+
+        for mode in args.modes:
+            stream = mode == "stream"
+            # 预热：建立连接、填充会话预热池和模型列表缓存
+            await closed_loop(lambda i: chat_completion(client, proxy_url, f"warmup {run_id} {mode} {i}", stream),
+                              args.warmup, args.concurrency)
+            cpu_before = cpu_seconds(proxy_pid)
+            started = time.perf_counter()
+            # 每个请求内容不同，避免命中响应缓存或被合并
+            results = await closed_loop(
+                lambda i: chat_completion(client, proxy_url, f"bench {run_id} {mode} {i}", stream),
+                args.requests, args.concurrency
+            )
+            wall = time.perf_counter() - started
+            cpu_after = cpu_seconds(proxy_pid)
+
+            summary = report(results, wall, args.tokens)
+            reference = suite["direct"]["ttft_ms"] if stream else suite["direct"]["latency_ms"]
+            summary["ttft_overhead_ms" if stream else "latency_overhead_ms"] = overhead(
+                summary["ttft_ms"] if stream else summary["latency_ms"], reference
+            )
+            if cpu_before is not None and cpu_after is not None:
+                tokens = (summary["requests"] - summary["errors"]) * args.tokens
+                summary["proxy_cpu_seconds"] = round(cpu_after - cpu_before, 3)
+                summary["proxy_cpu_us_per_token"] = round((cpu_after - cpu_before) / tokens * 1e6, 2) if tokens else None
+            summary.update(memory_kb(proxy_pid))
+            suite[mode] = summary
+    return suite
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: Dict[str, Any], previous: Dict[str, Any]):
+    """输出与上一次结果的对比"""
+    print(f"\n与 {previous.get('commit') or '上一次'}（{previous.get('timestamp')}）对比：")
+    rows = [
+        ("throughput_rps", lambda m: m.get("throughput_rps")),
+        ("ttft_overhead_p50_ms", lambda m: (m.get("ttft_overhead_ms") or {}).get("p50")),
+        ("latency_overhead_p50_ms", lambda m: (m.get("latency_overhead_ms") or {}).get("p50")),
+        ("proxy_cpu_us_per_token", lambda m: m.get("proxy_cpu_us_per_token")),
+        ("peak_rss_kb", lambda m: m.get("peak_rss_kb")),
+    ]
+    for mode in MODES:
+        if mode not in current["results"] or mode not in previous.get("results", {}):
+            continue
+        for name, pick in rows:
+            now, before = pick(current["results"][mode]), pick(previous["results"][mode])
+            if now is None or before is None:
+                continue
+            change = f"{(now - before) / before * 100:+.1f}%" if before else "-"
+            print(f"  {mode:6} {name:26} {before:>12} -> {now:<12} {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="使用本地模拟上游测量代理的吞吐量与开销")
+    parser.add_argument("--server", choices=("asgi", "flask"), default="asgi", help="被测的服务器模式")
+    parser.add_argument("--modes", default="stream,json", help="测试的模式，逗号分隔：stream、json")
+    parser.add_argument("--requests", type=int, default=200, help="每种模式的请求数")
+    parser.add_argument("--concurrency", type=int, default=16, help="并发客户端数")
+    parser.add_argument("--warmup", type=int, default=20, help="每种模式的预热请求数")
+    parser.add_argument("--timeout", type=float, default=60, help="单个请求的超时（秒）")
+    parser.add_argument("--tokens", type=int, default=50, help="模拟上游每次回复的片段数")
+    parser.add_argument("--tokens-per-second", type=float, default=500, help="模拟上游的输出速度")
+    parser.add_argument("--latency-ms", type=float, default=0, help="模拟上游控制接口的延迟")
+    parser.add_argument("--first-token-ms", type=float, default=0, help="模拟上游首个片段的延迟")
+    parser.add_argument("--branch-every", type=int, default=0, help="模拟上游每隔多少个片段输出多分支片段")
+    parser.add_argument("--output", default=None, help="结果文件，默认 benchmarks/results/<时间>.json")
+    parser.add_argument("--compare", default=None, help="与之前的结果文件对比")
+    args = parser.parse_args()
+    args.modes = [mode for mode in args.modes.split(",") if mode in MODES]
+
+    mock_port, proxy_port = free_port(), free_port()
+    upstream = f"http://127.0.0.1:{mock_port}"
+    proxy_url = f"http://127.0.0.1:{proxy_port}"
+    mock_args = [
+        "--tokens", str(args.tokens), "--tokens-per-second", str(args.tokens_per_second),
+        "--latency-ms", str(args.latency_ms), "--first-token-ms", str(args.first_token_ms),
+        "--branch-every", str(args.branch_every)
+    ]
+
+    mock = proxy = None
+    try:
+        mock = start_mock(mock_port, mock_args)
+        proxy = start_proxy(args.server, proxy_port, upstream)
+        results = asyncio.run(run_suite(args, upstream, proxy_url, proxy.pid))
+    finally:
+        stop(proxy)
+        stop(mock)
+
+    output = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "results": results,
+    }
+
+    path = args.output or os.path.join(ROOT, "benchmarks", "results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(output, f, ensure_ascii=False, indent=2)
+
+    for mode in ("direct", *args.modes):
+        summary = results[mode]
+        line = (f"{mode:6} 吞吐 {summary['throughput_rps']} req/s  TTFT p50 {summary['ttft_ms']['p50']} ms  "
+                f"p99 {summary['ttft_ms']['p99']} ms  错误 {summary['errors']}")
+        if "ttft_overhead_ms" in summary:
+            line += f"  TTFT 开销 p50 {summary['ttft_overhead_ms']['p50']} ms"
+        if "latency_overhead_ms" in summary:
+            line += f"  延迟开销 p50 {summary['latency_overhead_ms']['p50']} ms"
+        if "proxy_cpu_us_per_token" in summary:
+            line += f"  CPU {summary['proxy_cpu_us_per_token']} us/片段  峰值 RSS {summary['peak_rss_kb']} KB"
+        print(line)
+    print(f"\n结果已写入 {path}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(output, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
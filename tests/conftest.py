@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""单元测试公共配置：从仓库根目录导入 app 包"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.admission import AdmissionController  # noqa: E402
+
+
+@pytest.fixture
+def make_admission():
+    """创建不受环境变量影响的准入控制器，默认只有一个名额、排队不超时"""
+    def make(max_concurrency=1, max_queue=8, queue_timeout=0.0, **attrs) -> AdmissionController:
+        ctl = AdmissionController()
+        ctl.max_concurrency = max_concurrency
+        ctl.model_concurrency = 0
+        ctl.model_limits = {}
+        ctl.key_weight = 1.0
+        ctl.key_weights = {}
+        ctl.key_concurrency = 0
+        ctl.key_limits = {}
+        ctl.max_queue = max_queue
+        ctl.queue_timeout = queue_timeout
+        for name, value in attrs.items():
+            setattr(ctl, name, value)
+        return ctl
+    return make
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""准入控制：并发上限、有界队列、排队超时和取消"""
+
+import asyncio
+
+import pytest
+
+from app.services.admission import AdmissionRejected, AdmissionTicket, api_key
+
+
+def test_api_key():
+    assert api_key(None) == "anonymous"
+    assert api_key("Bearer sk-abc") == "sk-abc"
+    assert api_key("sk-raw") == "sk-raw"
+    assert api_key("Bearer ") == "anonymous"
+
+
+def test_waiter_runs_when_slot_released(make_admission):
+    async def main():
+        ctl = make_admission()
+        ticket = AdmissionTicket("m")
+        await ctl.acquire(ticket)
+        waiter = asyncio.ensure_future(ctl.acquire(AdmissionTicket("m")))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        assert ctl.stats()["queue_length"] == 1
+
+        ctl._release(ticket)
+        await waiter
+        stats = ctl.stats()
+        assert stats["active"] == 1
+        assert stats["queue_length"] == 0
+        assert stats["admitted"] == 2
+
+    asyncio.run(main())
+
+
+def test_full_queue_rejects_with_retry_after(make_admission):
+    async def main():
+        ctl = make_admission(max_queue=1)
+        await ctl.acquire(AdmissionTicket("m"))
+        queued = asyncio.ensure_future(ctl.acquire(AdmissionTicket("m")))
+        await asyncio.sleep(0)
+
+        with pytest.raises(AdmissionRejected) as excinfo:
+            ctl.check(AdmissionTicket("m"))
+        assert excinfo.value.retry_after >= 1
+        with pytest.raises(AdmissionRejected):
+            await ctl.acquire(AdmissionTicket("m"))
+        assert ctl.stats()["rejected_full"] == 2
+        queued.cancel()
+
+    asyncio.run(main())
+
+
+def test_queue_timeout_leaves_queue_empty(make_admission):
+    async def main():
+        ctl = make_admission(queue_timeout=0.01)
+        await ctl.acquire(AdmissionTicket("m"))
+        with pytest.raises(AdmissionRejected):
+            await ctl.acquire(AdmissionTicket("m", key="other"))
+        stats = ctl.stats()
+        assert stats["rejected_timeout"] == 1
+        assert stats["queue_length"] == 0
+        # 超时的 Key 不再保留状态
+        assert "other" not in stats["keys"]
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_gives_up_its_place(make_admission):
+    async def main():
+        ctl = make_admission()
+        ticket = AdmissionTicket("m")
+        await ctl.acquire(ticket)
+        waiter = asyncio.ensure_future(ctl.acquire(AdmissionTicket("m")))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert ctl.stats()["cancelled"] == 1
+        assert ctl.stats()["queue_length"] == 0
+
+        # 释放名额后不会分配给已取消的请求
+        ctl._release(ticket)
+        assert ctl.stats()["active"] == 0
+
+    asyncio.run(main())
+
+
+def test_slot_released_after_block(make_admission):
+    async def main():
+        ctl = make_admission()
+        async with ctl.slot(AdmissionTicket("m")):
+            assert ctl.stats()["active"] == 1
+        stats = ctl.stats()
+        assert stats["active"] == 0
+        assert stats["avg_hold_ms"] is not None
+
+    asyncio.run(main())
+
+
+def test_full_model_does_not_block_other_models(make_admission):
+    async def main():
+        ctl = make_admission(max_concurrency=0, model_limits={"a": 1})
+        await ctl.acquire(AdmissionTicket("a"))
+        blocked = asyncio.ensure_future(ctl.acquire(AdmissionTicket("a")))
+        await asyncio.sleep(0)
+        # 排在前面的请求所属模型名额已满，其他模型的请求可以先执行
+        await asyncio.wait_for(ctl.acquire(AdmissionTicket("b")), 1)
+        assert not blocked.done()
+        assert ctl.stats()["active_by_model"] == {"a": 1, "b": 1}
+        blocked.cancel()
+
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""会话轮次队列：同一会话按顺序执行、排队深度上限和超时或取消后不留下被占用的锁"""
+
+import asyncio
+
+import pytest
+
+from app.services.session_service import SessionBusyError, SessionService
+
+SESSION = {"id": "s-1", "anuneko_chat_id": "chat-1"}
+
+
+@pytest.fixture
+def service(monkeypatch):
+    monkeypatch.setenv("SESSION_STORE", "memory")
+    service = SessionService()
+    service.queue_max_depth = 2
+    service.queue_timeout = 0
+    return service
+
+
+async def turn(service, log=None, name=None, hold=0.0):
+    async with service.chat_turn(SESSION):
+        if log is not None:
+            log.append(name)
+        await asyncio.sleep(hold)
+
+
+def queue(service):
+    return service._turn_queues[SESSION["anuneko_chat_id"]]
+
+
+def test_turns_run_in_arrival_order(service):
+    async def main():
+        log = []
+        tasks = []
+        for name in "abc":
+            tasks.append(asyncio.ensure_future(turn(service, log, name, 0.01)))
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        return log
+
+    assert asyncio.run(main()) == ["a", "b", "c"]
+    assert service.queue_stats()["queued"] == 0
+
+
+def test_depth_limit_counts_only_waiting_turns(service):
+    async def main():
+        tasks = [asyncio.ensure_future(turn(service, hold=0.05)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        assert queue(service).waiting == 2
+        with pytest.raises(SessionBusyError):
+            await turn(service)
+
+        # 下一个请求获取到锁的同时离开排队计数，空出的位置立即可用
+        while queue(service).turns < 2:
+            await asyncio.sleep(0)
+        assert queue(service).waiting == 1
+        tasks.append(asyncio.ensure_future(turn(service)))
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    assert queue(service).rejected == 1
+    assert queue(service).turns == 4
+
+
+def test_timeout_does_not_leak_the_lock(service):
+    service.queue_timeout = 0.05
+
+    async def main():
+        for _ in range(10):
+            # 持有者释放锁的时刻与等待者超时的时刻相同
+            holder = asyncio.ensure_future(turn(service, hold=0.05))
+            await asyncio.sleep(0)
+            try:
+                await turn(service)
+            except SessionBusyError:
+                pass
+            await holder
+        await asyncio.sleep(0.01)
+
+    asyncio.run(main())
+    assert not queue(service).lock.locked()
+    assert queue(service).waiting == 0
+
+
+def test_cancelled_waiter_does_not_leak_the_lock(service):
+    async def main():
+        for ticks in range(6):
+            holder = asyncio.ensure_future(turn(service, hold=0.01))
+            await asyncio.sleep(0)
+            waiter = asyncio.ensure_future(turn(service))
+            await asyncio.sleep(0.01)
+            for _ in range(ticks):
+                await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.gather(holder, waiter, return_exceptions=True)
+        await asyncio.sleep(0)
+
+    asyncio.run(main())
+    assert not queue(service).lock.locked()
+    assert queue(service).waiting == 0
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""上游熔断：按失败比例熔断、半开试探、试探失败重新熔断和排队之前的快速失败"""
+
+import pytest
+
+from app.services.circuit_breaker import (
+    CLOSED, HALF_OPEN, OPEN, CircuitBreakerRegistry, CircuitOpenError, _null_breaker
+)
+
+
+@pytest.fixture
+def registry():
+    registry = CircuitBreakerRegistry()
+    registry.enabled = True
+    registry.window = 4
+    registry.min_requests = 4
+    registry.failure_rate = 0.5
+    registry.open_seconds = 30
+    registry.half_open_probes = 2
+    return registry
+
+
+def record(breaker, *results):
+    for ok in results:
+        breaker.release(breaker.acquire(), ok)
+
+
+def expire(breaker):
+    """让熔断时间立即结束"""
+    breaker.opened_at -= breaker.config.open_seconds
+
+
+def test_opens_at_failure_rate_threshold(registry):
+    breaker = registry.get("stream", "a")
+    record(breaker, False, False, False)
+    # 调用次数不足 min_requests 时不熔断
+    assert breaker.state == CLOSED
+    record(breaker, True)
+    assert breaker.state == OPEN
+    assert breaker.stats()["opened"] == 1
+
+
+def test_old_failures_leave_the_window(registry):
+    breaker = registry.get("stream", "a")
+    record(breaker, False, True, True, True, True)
+    # 窗口只保留最近 4 次，最早的失败已移出
+    record(breaker, False)
+    assert breaker.state == CLOSED
+    record(breaker, False)
+    assert breaker.state == OPEN
+
+
+def test_open_breaker_rejects_until_timeout(registry):
+    breaker = registry.get("stream", "a")
+    record(breaker, False, False, False, False)
+    with pytest.raises(CircuitOpenError) as excinfo:
+        breaker.acquire()
+    assert 1 <= excinfo.value.retry_after <= 30
+    assert not breaker.available
+
+    expire(breaker)
+    assert breaker.available
+    assert breaker.acquire() is True
+    assert breaker.state == HALF_OPEN
+
+
+def test_failed_half_open_probe_reopens(registry):
+    breaker = registry.get("stream", "a")
+    record(breaker, False, False, False, False)
+    expire(breaker)
+
+    first = breaker.acquire()
+    second = breaker.acquire()
+    # 试探名额已满
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+    breaker.release(first, True)
+    breaker.release(second, False)
+    assert breaker.state == OPEN
+    assert breaker.stats()["opened"] == 2
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+
+
+def test_successful_probes_close_breaker(registry):
+    breaker = registry.get("stream", "a")
+    record(breaker, False, False, False, False)
+    expire(breaker)
+    record(breaker, True)
+    assert breaker.state == HALF_OPEN
+    record(breaker, True)
+    assert breaker.state == CLOSED
+    # 恢复后重新开始统计，一次失败不会再次熔断
+    record(breaker, False)
+    assert breaker.state == CLOSED
+
+
+def test_cancelled_probe_frees_its_slot(registry):
+    breaker = registry.get("stream", "a")
+    record(breaker, False, False, False, False)
+    expire(breaker)
+    for _ in range(3):
+        breaker.release(breaker.acquire(), None)
+    assert breaker.state == HALF_OPEN
+    assert breaker.stats()["requests"] == 4
+
+
+def test_check_fails_fast_only_when_every_account_is_open(registry):
+    a = registry.get("stream", "a")
+    record(a, False, False, False, False)
+    registry.check("stream", ["a", "b"])
+    with pytest.raises(CircuitOpenError):
+        registry.check("stream", ["a"])
+    assert not registry.account_available("a")
+    assert registry.account_available("b")
+
+    # 熔断时间结束后放行，检查本身不占用试探名额
+    expire(a)
+    for _ in range(3):
+        registry.check("stream", ["a"])
+    assert a.acquire() is True
+    assert a.acquire() is True
+    with pytest.raises(CircuitOpenError):
+        registry.check("stream", ["a"])
+
+
+def test_disabled_registry_never_rejects(registry):
+    registry.enabled = False
+    breaker = registry.get("stream", "a")
+    assert breaker is _null_breaker
+    record(breaker, False, False, False, False)
+    registry.check("stream", ["a"])
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""对话续接索引：按历史消息找到会话，本轮失败时保留记录，成功后移除旧历史"""
+
+import pytest
+
+from app.services.conversation_index import ConversationIndex
+
+
+@pytest.fixture
+def index():
+    index = ConversationIndex()
+    index.max_size = 100
+    index.ttl = 3600
+    return index
+
+
+FIRST = [{"role": "system", "content": "你是猫娘"}, {"role": "user", "content": "你好"}]
+SECOND = FIRST + [{"role": "assistant", "content": "喵"}, {"role": "user", "content": "再见"}]
+
+
+def test_new_conversation_has_no_history(index):
+    assert index.lookup(FIRST) is None
+    assert index.stats()["misses"] == 0
+
+
+def test_lookup_is_not_destructive(index):
+    index.remember(FIRST, "喵", "s-1")
+    # 本轮失败后客户端带着同样的历史重试，仍然续接到同一个会话
+    assert index.lookup(SECOND) == "s-1"
+    assert index.lookup(SECOND) == "s-1"
+
+
+def test_successful_turn_replaces_the_previous_history(index):
+    index.remember(FIRST, "喵", "s-1")
+    index.remember(SECOND, "拜拜", "s-1")
+    assert index.lookup(SECOND) is None
+    third = SECOND + [{"role": "assistant", "content": "拜拜"}, {"role": "user", "content": "还在吗"}]
+    assert index.lookup(third) == "s-1"
+    assert index.stats()["size"] == 1
+
+
+def test_content_parts_and_whitespace_match(index):
+    index.remember(FIRST, "喵", "s-1")
+    messages = [
+        {"role": "system", "content": [{"type": "text", "text": "你是猫娘 "}]},
+        {"role": "user", "content": "你好", "name": "alice"},
+        {"role": "assistant", "content": " 喵"},
+        {"role": "user", "content": "再见"},
+    ]
+    assert index.lookup(messages) == "s-1"
+
+
+def test_capacity_evicts_oldest(index):
+    index.max_size = 1
+    index.remember(FIRST, "喵", "s-1")
+    index.remember([{"role": "user", "content": "别的"}], "嗯", "s-2")
+    assert index.lookup(SECOND) is None
+    assert index.stats()["evicted"] == 1
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""准入控制的加权公平队列：通道优先级、按 Key 加权分配、Key 并发上限和挤出排队请求"""
+
+import asyncio
+
+import pytest
+
+from app.services.admission import BULK, INTERACTIVE, AdmissionRejected, AdmissionTicket
+
+
+async def admitted_order(ctl, tickets):
+    """占满唯一的名额后让 tickets 依次排队，逐个释放名额，返回开始执行的顺序"""
+    holder = AdmissionTicket("m", key="holder")
+    await ctl.acquire(holder)
+    order = []
+
+    async def run(ticket):
+        await ctl.acquire(ticket)
+        order.append(ticket)
+
+    tasks = []
+    for ticket in tickets:
+        tasks.append(asyncio.ensure_future(run(ticket)))
+        await asyncio.sleep(0)
+
+    current = holder
+    for _ in tickets:
+        ctl._release(current)
+        await asyncio.sleep(0)
+        current = order[-1]
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_interactive_lane_runs_before_bulk(make_admission):
+    async def main():
+        ctl = make_admission()
+        bulk = AdmissionTicket("m", key="a", lane=BULK)
+        interactive = AdmissionTicket("m", key="b", lane=INTERACTIVE)
+        order = await admitted_order(ctl, [bulk, interactive])
+        assert order == [interactive, bulk]
+
+    asyncio.run(main())
+
+
+def test_same_key_runs_in_arrival_order(make_admission):
+    async def main():
+        ctl = make_admission()
+        tickets = [AdmissionTicket("m", key="a") for _ in range(3)]
+        assert await admitted_order(ctl, tickets) == tickets
+
+    asyncio.run(main())
+
+
+def test_keys_share_slots_by_weight(make_admission):
+    async def main():
+        ctl = make_admission(key_weights={"heavy": 2.0})
+        tickets = [AdmissionTicket("m", key="heavy") for _ in range(4)]
+        tickets += [AdmissionTicket("m", key="light") for _ in range(2)]
+        order = await admitted_order(ctl, tickets)
+        # 权重为 2 的 Key 每轮得到两个名额，先到的大量请求不会饿死另一个 Key
+        assert [t.key for t in order] == ["heavy", "heavy", "light", "heavy", "heavy", "light"]
+
+    asyncio.run(main())
+
+
+def test_saturated_key_is_skipped(make_admission):
+    async def main():
+        ctl = make_admission(max_concurrency=2, key_limits={"a": 1})
+        await ctl.acquire(AdmissionTicket("m", key="a"))
+        blocked = asyncio.ensure_future(ctl.acquire(AdmissionTicket("m", key="a")))
+        await asyncio.sleep(0)
+        await asyncio.wait_for(ctl.acquire(AdmissionTicket("m", key="b")), 1)
+        assert not blocked.done()
+        assert ctl.stats()["keys"]["a"] == {"weight": 1.0, "limit": 1, "active": 1, "queued": 1}
+        blocked.cancel()
+
+    asyncio.run(main())
+
+
+def test_interactive_request_preempts_queued_bulk(make_admission):
+    async def main():
+        ctl = make_admission(max_queue=2)
+        await ctl.acquire(AdmissionTicket("m", key="holder"))
+        first = asyncio.ensure_future(ctl.acquire(AdmissionTicket("m", key="a", lane=BULK)))
+        last = asyncio.ensure_future(ctl.acquire(AdmissionTicket("m", key="a", lane=BULK)))
+        await asyncio.sleep(0)
+
+        # 队列已满，但交互请求可以挤出批量通道中排队最多的 Key 的最后一个请求
+        ctl.check(AdmissionTicket("m", key="b", lane=INTERACTIVE))
+        interactive = asyncio.ensure_future(ctl.acquire(AdmissionTicket("m", key="b", lane=INTERACTIVE)))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected):
+            await last
+        assert not first.done() and not interactive.done()
+        assert ctl.stats()["rejected_preempted"] == 1
+        assert ctl.stats()["queue_by_lane"] == {INTERACTIVE: 1, BULK: 1}
+        first.cancel()
+        interactive.cancel()
+
+    asyncio.run(main())
+
+
+def test_bulk_request_cannot_preempt_interactive(make_admission):
+    async def main():
+        ctl = make_admission(max_queue=1)
+        await ctl.acquire(AdmissionTicket("m", key="holder"))
+        queued = asyncio.ensure_future(ctl.acquire(AdmissionTicket("m", key="a", lane=INTERACTIVE)))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected):
+            await ctl.acquire(AdmissionTicket("m", key="b", lane=BULK))
+        assert not queued.done()
+        queued.cancel()
+
+    asyncio.run(main())
+
+
+def test_same_lane_preempts_only_a_key_with_a_longer_queue(make_admission):
+    async def main():
+        ctl = make_admission(max_queue=2)
+        await ctl.acquire(AdmissionTicket("m", key="holder"))
+        hog = [asyncio.ensure_future(ctl.acquire(AdmissionTicket("m", key="hog"))) for _ in range(2)]
+        await asyncio.sleep(0)
+
+        # 新 Key 没有排队的请求，占满队列的 Key 比它多出一个以上，挤出其最后一个请求
+        newcomer = asyncio.ensure_future(ctl.acquire(AdmissionTicket("m", key="new")))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected):
+            await hog[1]
+        assert not hog[0].done()
+
+        # 两个 Key 各排队一个，相差不超过一个时直接拒绝新请求
+        with pytest.raises(AdmissionRejected):
+            await ctl.acquire(AdmissionTicket("m", key="new"))
+        assert ctl.stats()["rejected_full"] == 1
+        hog[0].cancel()
+        newcomer.cancel()
+
+    asyncio.run(main())
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""控制接口的重试与对冲：退避重试、对冲落后的尝试被取消、重试预算和熔断时不重试"""
+
+import asyncio
+
+import httpx
+import pytest
+
+from app.services.async_runtime import runtime
+from app.services.circuit_breaker import CircuitOpenError
+from app.services.retry_policy import RetryBudget, RetryPolicy
+
+
+@pytest.fixture
+def policy():
+    policy = RetryPolicy()
+    policy.hedging = True
+    policy.hedge_initial_delay = 0.02
+    policy.min_samples = 20
+    policy.max_attempts = 3
+    policy.request_budget = 3
+    policy.backoff_base = 0.0
+    policy.backoff_max = 0.0
+    return policy
+
+
+def sender(*outcomes):
+    """依次返回给定结果的 send 函数：状态码、异常，或 (延迟秒数, 状态码)"""
+    calls = []
+
+    async def send():
+        outcome = outcomes[len(calls)]
+        calls.append(outcome)
+        if isinstance(outcome, tuple):
+            delay, outcome = outcome
+            await asyncio.sleep(delay)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return httpx.Response(outcome)
+
+    send.calls = calls
+    return send
+
+
+def test_retries_server_errors_until_success(policy):
+    send = sender(503, 500, 200)
+    resp = asyncio.run(policy.call("create_session", send))
+    assert resp.status_code == 200
+    assert len(send.calls) == 3
+    assert policy.stats()["calls"]["create_session"]["retries"] == 2
+
+
+def test_client_errors_are_not_retried(policy):
+    send = sender(404)
+    assert asyncio.run(policy.call("switch_model", send)).status_code == 404
+    assert len(send.calls) == 1
+
+
+def test_returns_last_failure_after_max_attempts(policy):
+    send = sender(500, 502, 503)
+    assert asyncio.run(policy.call("create_session", send)).status_code == 503
+    assert policy.stats()["calls"]["create_session"]["failures"] == 1
+
+    send = sender(httpx.ConnectError("down"), httpx.ConnectError("down"), httpx.ConnectError("down"))
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(policy.call("create_session", send))
+
+
+def test_hedge_wins_and_loser_is_cancelled(policy):
+    cancelled = []
+
+    async def main():
+        calls = 0
+
+        async def send():
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.append(True)
+                    raise
+            return httpx.Response(200)
+
+        resp = await asyncio.wait_for(policy.call("switch_model", send), 1)
+        # 让被取消的尝试运行到结束
+        await asyncio.sleep(0)
+        return resp, calls
+
+    resp, calls = asyncio.run(main())
+    assert resp.status_code == 200
+    assert calls == 2
+    assert cancelled == [True]
+    stats = policy.stats()["calls"]["switch_model"]
+    assert stats["hedges"] == 1
+    assert stats["hedge_wins"] == 1
+
+
+def test_create_session_is_never_hedged(policy):
+    send = sender((0.1, 200))
+    assert asyncio.run(policy.call("create_session", send)).status_code == 200
+    assert len(send.calls) == 1
+    assert policy.stats()["calls"]["create_session"]["hedges"] == 0
+
+
+def test_budget_limits_extra_attempts(policy):
+    budget = RetryBudget(1)
+    send = sender(500, 500, 500)
+    assert asyncio.run(policy.call("create_session", send, budget)).status_code == 500
+    assert len(send.calls) == 2
+    assert policy.stats()["calls"]["create_session"]["budget_exhausted"] == 1
+
+    # 预算已用完，同一请求的下一次调用不再重试
+    send = sender(500, 200)
+    assert asyncio.run(policy.call("create_session", send, budget)).status_code == 500
+    assert len(send.calls) == 1
+
+
+def test_budget_is_taken_from_the_request_context(policy):
+    async def main():
+        policy.request_budget = 0
+        policy.begin_request()
+        send = sender(500, 200)
+        resp = await policy.call("create_session", send)
+        return resp, send.calls
+
+    resp, calls = asyncio.run(main())
+    assert resp.status_code == 500
+    assert len(calls) == 1
+
+
+def test_open_circuit_is_not_retried(policy):
+    send = sender(CircuitOpenError("open", 5), 200)
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(policy.call("create_session", send))
+    assert len(send.calls) == 1
+
+
+def test_background_tasks_do_not_share_the_request_budget(policy):
+    async def background():
+        return RetryPolicy.current_budget()
+
+    async def request():
+        policy.begin_request()
+        return RetryPolicy.current_budget(), await asyncio.wrap_future(runtime.spawn(background()))
+
+    own, spawned = runtime.run(request())
+    assert own is not None
+    assert spawned is None
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""SQLite 会话存储：未提交的写入对读取可见、提交失败后重试、空闲过期和容量淘汰"""
+
+import time
+
+import pytest
+
+from app.services.session_store import SessionStore, SQLiteSessionStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    # 写入只在测试显式调用 flush() 时提交
+    store = SQLiteSessionStore(str(tmp_path / "sessions.db"), flush_interval=3600, batch_size=10000)
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def other(store):
+    """共享同一个数据库文件的另一个工作进程"""
+    other = SQLiteSessionStore(store.path, flush_interval=3600, batch_size=10000)
+    yield other
+    other.close()
+
+
+def test_store_interface_is_abstract():
+    with pytest.raises(TypeError):
+        SessionStore()
+
+
+def test_pending_write_is_visible_before_flush(store, other):
+    store["a"] = {"id": "a"}
+    assert store.stats()["pending"] == 1
+    assert store.get("a") == {"id": "a"}
+    assert "a" in store
+    assert len(store) == 1
+    assert list(store) == ["a"]
+    # 其他进程只能看到已提交的写入
+    assert other.get("a") is None
+
+    store.flush()
+    assert store.stats()["pending"] == 0
+    assert other.get("a") == {"id": "a"}
+    assert len(store) == 1
+
+
+def test_pending_delete_hides_stored_session(store, other):
+    store["a"] = {"id": "a"}
+    store["b"] = {"id": "b"}
+    store.flush()
+    del store["a"]
+    assert "a" not in store
+    assert len(store) == 1
+    assert list(store) == ["b"]
+    assert "a" in other
+
+    store.flush()
+    assert "a" not in other
+    with pytest.raises(KeyError):
+        del store["a"]
+
+
+def test_batch_being_committed_stays_visible(store, monkeypatch):
+    seen = []
+    commit = store._commit
+
+    def observing_commit(*args):
+        # 提交期间待写入队列已清空，读取仍能看到这批写入
+        seen.append((store.stats()["pending"], store.get("a"), len(store)))
+        commit(*args)
+
+    monkeypatch.setattr(store, "_commit", observing_commit)
+    store["a"] = {"id": "a"}
+    store.flush()
+    assert seen == [(0, {"id": "a"}, 1)]
+    assert store._inflight == {}
+
+
+def test_failed_commit_is_requeued(store, other, monkeypatch):
+    def failing_commit(*args):
+        raise RuntimeError("disk full")
+
+    store["a"] = {"id": "a", "v": 1}
+    monkeypatch.setattr(store, "_commit", failing_commit)
+    with pytest.raises(RuntimeError):
+        store.flush()
+    assert store.stats()["pending"] == 1
+    assert store.get("a") == {"id": "a", "v": 1}
+
+    # 失败期间的新写入不会被放回的旧数据覆盖
+    store["a"] = {"id": "a", "v": 2}
+    monkeypatch.undo()
+    store.flush()
+    assert other.get("a") == {"id": "a", "v": 2}
+
+
+def test_sweep_evicts_idle_and_least_recently_used(store):
+    store.max_size = 2
+    for session_id in ("a", "b", "c", "d"):
+        store[session_id] = {"id": session_id}
+    store.flush()
+    with store._db_lock:
+        store._conn.execute("UPDATE sessions SET last_access = ? WHERE id = 'a'", (time.time() - 100,))
+    time.sleep(0.01)
+    store.touch("b")
+    store.touch("d")
+
+    evicted = store.sweep(ttl=50)
+    # a 空闲超时，剩余 3 个中 c 最久未使用，超出容量被淘汰
+    assert [session_id for session_id, _ in evicted] == ["a", "c"]
+    assert sorted(store) == ["b", "d"]
+    stats = store.stats()
+    assert stats["evicted_idle"] == 1
+    assert stats["evicted_capacity"] == 1
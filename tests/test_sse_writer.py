@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""SSE 输出：预编码的数据块、片段转义和按时间窗口与字节数合并片段"""
+
+import asyncio
+import json
+
+from app.services.sse_writer import SSEWriter
+
+
+def decode(data: str):
+    assert data.startswith("data: ") and data.endswith("\n\n")
+    return json.loads(data[6:-2])
+
+
+async def pieces(*items):
+    """依次产出片段，(延迟秒数, 片段) 表示在产出之前等待"""
+    for item in items:
+        if isinstance(item, tuple):
+            await asyncio.sleep(item[0])
+            item = item[1]
+        yield item
+
+
+def coalesced(writer, source):
+    async def main():
+        return [piece async for piece in writer.coalesce(source)]
+    return asyncio.run(main())
+
+
+def test_delta_escapes_content():
+    writer = SSEWriter("mihoyo-orange_cat", session_id="s-1", coalesce_ms=0)
+    content = '引号" 反斜杠\\ 换行\n 控制字符\x01 </script>'
+    chunk = decode(writer.delta(content))
+    assert chunk["id"] == writer.id
+    assert chunk["model"] == "mihoyo-orange_cat"
+    assert chunk["session_id"] == "s-1"
+    assert chunk["choices"] == [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+
+
+def test_end_chunk_and_done():
+    writer = SSEWriter("m", coalesce_ms=0)
+    end, done = writer.end().split("\n\n", 1)
+    chunk = json.loads(end[len("data: "):])
+    assert chunk["id"] == writer.id
+    assert chunk["choices"][0]["finish_reason"] == "stop"
+    assert chunk["choices"][0]["delta"] == {}
+    assert done == "data: [DONE]\n\n"
+
+
+def test_no_coalescing_passes_pieces_through():
+    writer = SSEWriter("m", coalesce_ms=0)
+    assert coalesced(writer, pieces("a", "b", "c")) == ["a", "b", "c"]
+
+
+def test_pieces_within_window_are_merged():
+    writer = SSEWriter("m", coalesce_ms=50, coalesce_bytes=1024)
+    assert coalesced(writer, pieces("a", "b", (0.2, "c"), "d")) == ["ab", "cd"]
+
+
+def test_byte_threshold_flushes_early():
+    writer = SSEWriter("m", coalesce_ms=1000, coalesce_bytes=6)
+    # 中文字符按 UTF-8 字节数计算
+    assert coalesced(writer, pieces("你", "好", "ab", "c")) == ["你好", "abc"]
+
+
+def test_window_flushes_while_upstream_stalls():
+    async def main():
+        writer = SSEWriter("m", coalesce_ms=20, coalesce_bytes=1024)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        merged = writer.coalesce(pieces("a", (0.5, "b")))
+        first = await merged.__anext__()
+        elapsed = loop.time() - started
+        await merged.aclose()
+        return first, elapsed
+
+    first, elapsed = asyncio.run(main())
+    assert first == "a"
+    # 窗口到期即输出，不等待下一个片段
+    assert elapsed < 0.4
+
+
+def test_closing_early_closes_upstream():
+    closed = []
+
+    async def source():
+        try:
+            yield "a"
+            await asyncio.sleep(10)
+            yield "b"
+        finally:
+            closed.append(True)
+
+    async def main():
+        writer = SSEWriter("m", coalesce_ms=20, coalesce_bytes=1024)
+        merged = writer.coalesce(source())
+        assert await merged.__anext__() == "a"
+        await merged.aclose()
+        return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    assert asyncio.run(main()) == []
+    assert closed == [True]
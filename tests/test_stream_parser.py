@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""上游流解析：任意位置切分的字节块、多分支内容、消息 ID、错误行和格式错误的行"""
+
+import asyncio
+
+from app.services.stream_parser import (
+    BranchDelta, ContentDelta, ErrorCode, MessageId, StreamParser, parse_stream
+)
+
+STREAM = (
+    'data: {"v":"你好"}\n\n'
+    'data: {"c":[{"v":"，世界"},{"v":"另一个","c":1}]}\r\n\r\n'
+    'data:{"msg_id":"m-1","v":"！"}\n\n'
+    'data: [DONE]\n\n'
+).encode("utf-8")
+
+EXPECTED = [
+    ContentDelta("你好"),
+    ContentDelta("，世界"),
+    BranchDelta(1, "另一个"),
+    MessageId("m-1"),
+    ContentDelta("！"),
+]
+
+
+def parse_in_chunks(data: bytes, size: int):
+    parser = StreamParser()
+    events = []
+    for start in range(0, len(data), size):
+        events.extend(parser.feed(data[start:start + size]))
+    events.extend(parser.close())
+    return parser, events
+
+
+def test_same_events_for_any_chunk_size():
+    # 1 字节的块会把多字节的中文字符切开
+    for size in (1, 2, 3, 7, len(STREAM)):
+        parser, events = parse_in_chunks(STREAM, size)
+        assert events == EXPECTED, size
+        assert parser.malformed == 1
+
+
+def test_partial_line_waits_for_newline():
+    parser = StreamParser()
+    assert parser.feed(b'data: {"v":"a') == []
+    assert parser.feed(b'b"}') == []
+    assert parser.feed(b"\n") == [ContentDelta("ab")]
+
+
+def test_last_line_without_newline_is_parsed_on_close():
+    parser = StreamParser()
+    assert parser.feed(b'data: {"v":"end"}') == []
+    assert parser.close() == [ContentDelta("end")]
+    assert parser.close() == []
+
+
+def test_error_line_is_reported():
+    parser = StreamParser()
+    events = parser.feed(b'{"code":"chat_choice_shown","msg":"x"}\n')
+    assert events == [ErrorCode("chat_choice_shown", {"code": "chat_choice_shown", "msg": "x"})]
+
+
+def test_malformed_and_unknown_lines_are_skipped():
+    parser = StreamParser()
+    events = parser.feed(b'data: {broken\nevent: ping\ndata: [1, 2]\ndata: {"v": 3}\ndata: {"v":"ok"}\n')
+    assert events == [ContentDelta("ok")]
+    assert parser.malformed == 1
+    assert parser.lines == 5
+
+
+def test_parse_stream():
+    async def chunks():
+        for start in range(0, len(STREAM), 5):
+            yield STREAM[start:start + 5]
+
+    async def main():
+        return [event async for event in parse_stream(chunks())]
+
+    assert asyncio.run(main()) == EXPECTED